@@ -137,6 +137,12 @@ const search = defineAPIMethod(
       };
     }
 
+    await subscriptions.markGlobalSubscriptionSearched(
+      dbClient,
+      +params.fly_from,
+      +params.fly_to,
+    );
+
     const { rows: routeIDRows } = await dbClient.executeQuery(
       `
       SELECT route_id, price, booking_token
@@ -146,14 +152,16 @@ const search = defineAPIMethod(
         atime::date <= $4::date AND
         price <= $5 AND
         subscription_fetch_id IN (
-          SELECT subscriptions_fetches.id
+          SELECT DISTINCT ON (subscriptions_fetches.subscription_id) subscriptions_fetches.id
           FROM subscriptions_fetches
-          LEFT JOIN fetches ON fetches.id = subscriptions_fetches.fetch_id
-          LEFT JOIN subscriptions ON subscriptions.id = subscriptions_fetches.subscription_id
+          JOIN subscriptions ON subscriptions.id = subscriptions_fetches.subscription_id
           WHERE
             subscriptions.airport_from_id = $1 AND
             subscriptions.airport_to_id = $2 AND
-            fetches.fetch_time = (SELECT MAX(fetches.fetch_time) FROM fetches)
+            subscriptions_fetches.completed_at IS NOT NULL
+          ORDER BY
+            subscriptions_fetches.subscription_id,
+            subscriptions_fetches.fetch_id DESC
         )
       GROUP BY route_id, price, booking_token
       ORDER BY price, route_id
@@ -293,6 +293,32 @@ async function globalSubscriptionExists (dbClient, airportFromId, airportToId) {
   ) != null;
 }
 
+async function markGlobalSubscriptionSearched (dbClient, airportFromId, airportToId) {
+  errors.assertApp(_.isObject(dbClient), `got ${typeof dbClient} but expected object`);
+  errors.assertApp(Number.isInteger(airportFromId),
+    `got ${typeof airportFromId} but expected number`,
+  );
+  errors.assertApp(Number.isInteger(airportToId), `got ${typeof airportToId} but expected number`);
+
+  // The fetcher keeps refreshing subscriptions without subscribers for as
+  // long as they are being searched. It plans in hours, so the row is only
+  // written once an hour however often the pair is searched.
+  await dbClient.executeQuery(
+    `
+      UPDATE subscriptions
+      SET last_searched_at = now()
+      WHERE
+        airport_from_id = $1 AND
+        airport_to_id = $2 AND
+        (
+          last_searched_at IS NULL OR
+          last_searched_at < now() - interval '1 hour'
+        )
+    `,
+    [airportFromId, airportToId],
+  );
+}
+
 async function subscribeGloballyIfNotSubscribed (
   dbClient,
   airportFromId,
@@ -398,6 +424,7 @@ module.exports = {
   listUserSubscriptions,
   listAllUserSubscriptions,
   subscribeGlobally,
+  markGlobalSubscriptionSearched,
   listGlobalSubscriptions,
   globalSubscriptionExists,
 };
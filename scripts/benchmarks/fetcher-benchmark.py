@@ -0,0 +1,346 @@
+#!/usr/bin/python3
+from urllib.request import urlopen
+import argparse
+import json
+import os
+import psycopg2
+import random
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+SCRIPTS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STUB = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'kiwi-stub.py')
+FETCHERS = {
+    'sync': os.path.join(SCRIPTS_DIR, 'fetch-data.py'),
+    'async': os.path.join(SCRIPTS_DIR, 'fetch-data-async.py'),
+}
+BENCHMARK_DATABASE = 'freefall_benchmark'
+STUB_STARTUP_TIMEOUT = 10 # seconds
+STATS_COLLECTOR_DELAY = 1 # seconds, pg_stat_database is updated asynchronously
+
+
+def log(msg):
+    print(msg, file=sys.stderr)
+
+
+def connect(args):
+    # PGHOST and PGPORT select the server, the fetchers are pointed at the
+    # same database with --database.
+    conn = psycopg2.connect(dbname=args.database, user='freefall', password='freefall')
+    conn.autocommit = True
+
+    return conn
+
+
+def check_benchmark_database(conn):
+    # The fetchers charge the credits of the users of the database, so it may
+    # only hold the users reset_database creates.
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT to_regclass('users') IS NOT NULL;")
+
+        if not cursor.fetchone()[0]:
+            return
+
+        cursor.execute('''
+
+            SELECT count(*)
+            FROM users
+            WHERE
+                password <> 'benchmark' OR
+                api_key NOT LIKE 'benchmark\\_api\\_key\\_%';
+
+        ''')
+        users = cursor.fetchone()[0]
+
+    if users > 0:
+        raise RuntimeError('Database {0} has {1} users that were not created by the benchmark, refusing to run against it.'.format(
+            conn.get_dsn_parameters()['dbname'],
+            users))
+
+
+def reset_database(conn, args):
+    rng = random.Random(args.seed)
+    airports = sorted(set(
+        ''.join(rng.choice('ABCDEGHJKNPRSTUWYZ') for _ in range(3))
+        for _ in range(args.airports * 4)
+    ))[:args.airports]
+    origins = airports[:args.origins]
+    pairs = rng.sample(
+        [(origin, destination) for origin in origins for destination in airports[args.origins:]],
+        min(args.subscriptions, len(origins) * (len(airports) - len(origins))))
+
+    with conn.cursor() as cursor:
+        cursor.execute('DROP VIEW IF EXISTS search_view;')
+
+        with open(os.path.join(SCRIPTS_DIR, 'create-database.sql')) as f:
+            cursor.execute(f.read())
+
+        cursor.executemany('INSERT INTO airports (iata_code, name) VALUES (%s, %s);', [
+            (code, '{0} Airport'.format(code)) for code in airports
+        ])
+        cursor.executemany('''
+
+            INSERT INTO subscriptions
+                (airport_from_id, airport_to_id)
+            SELECT airport_from.id, airport_to.id
+            FROM airports AS airport_from, airports AS airport_to
+            WHERE airport_from.iata_code = %s AND airport_to.iata_code = %s;
+
+        ''', pairs)
+        cursor.execute('''
+
+            INSERT INTO users
+                (email, password, api_key, role, credits)
+            SELECT 'user' || n || '@freefall.org', 'benchmark', 'benchmark_api_key_' || n, 'customer', 1000000
+            FROM generate_series(1, %s) AS n;
+
+        ''', [args.subscriptions])
+        cursor.execute('''
+
+            INSERT INTO users_subscriptions
+                (user_id, subscription_id, date_from, date_to)
+            SELECT id, id, %s, %s
+            FROM subscriptions;
+
+        ''', [date.today(), date.today() + timedelta(days=30)])
+
+    log('Reset database with {0} airports and {1} subscriptions from {2} origins.'.format(
+        len(airports),
+        len(pairs),
+        len(origins)))
+
+
+def db_counters(conn):
+    counters = {}
+
+    with conn.cursor() as cursor:
+        time.sleep(STATS_COLLECTOR_DELAY)
+        cursor.execute('SELECT pg_stat_clear_snapshot();')
+        cursor.execute('''
+
+            SELECT xact_commit + xact_rollback, tup_inserted, tup_updated, tup_deleted
+            FROM pg_stat_database
+            WHERE datname = current_database();
+
+        ''')
+        counters['transactions'], counters['inserted'], counters['updated'], counters['deleted'] = cursor.fetchone()
+
+        try:
+            cursor.execute('''
+
+                SELECT coalesce(sum(calls), 0)
+                FROM pg_stat_statements
+                WHERE dbid = (SELECT oid FROM pg_database WHERE datname = current_database());
+
+            ''')
+            counters['statements'] = int(cursor.fetchone()[0])
+        except psycopg2.Error:
+            # pg_stat_statements is not installed or not preloaded.
+            counters['statements'] = None
+
+    return counters
+
+
+def count_fetched_routes(conn):
+    with conn.cursor() as cursor:
+        cursor.execute('''
+
+            SELECT count(*)
+            FROM routes
+            JOIN subscriptions_fetches ON routes.subscription_fetch_id = subscriptions_fetches.id
+            WHERE subscriptions_fetches.fetch_id = (SELECT max(id) FROM fetches);
+
+        ''')
+
+        return cursor.fetchone()[0]
+
+
+def start_stub(args):
+    stub = subprocess.Popen([
+        args.python, STUB,
+        '--port', str(args.port),
+        '--seed', args.seed,
+        '--pages', str(args.pages),
+        '--latency', str(args.latency),
+        '--jitter', str(args.jitter),
+        '--error-rate', str(args.error_rate),
+    ])
+    deadline = time.monotonic() + STUB_STARTUP_TIMEOUT
+
+    while True:
+        try:
+            stub_stats(args)
+            return stub
+        except OSError:
+            if stub.poll() is not None or time.monotonic() > deadline:
+                stub.kill()
+                raise RuntimeError('Kiwi API stub did not start on port {0}'.format(args.port))
+
+            time.sleep(0.1)
+
+
+def stub_stats(args):
+    with urlopen('http://127.0.0.1:{0}/_stats'.format(args.port)) as response:
+        return json.loads(response.read().decode('utf-8'))
+
+
+def run_fetcher(args, conn, name, run):
+    if args.reset:
+        reset_database(conn, args)
+
+    before = db_counters(conn)
+    stub = start_stub(args)
+    # Every run starts with an empty response cache of its own, so runs are
+    # comparable and the user's cache is left alone.
+    cache_dir = tempfile.mkdtemp(prefix='freefall-benchmark-cache-')
+    command = [
+        args.python,
+        FETCHERS[name],
+        '--api-url', 'http://127.0.0.1:{0}'.format(args.port),
+        '--database', args.database,
+        '--response-cache-dir', cache_dir,
+    ]
+    command += shlex.split(getattr(args, '{0}_args'.format(name)))
+
+    if args.output_dir:
+        output = open(os.path.join(args.output_dir, '{0}-{1}.log'.format(name, run)), 'w')
+    else:
+        output = subprocess.DEVNULL
+
+    try:
+        started = time.monotonic()
+        fetcher = subprocess.Popen(command, stdout=output, stderr=subprocess.STDOUT)
+        # wait4 reports the resources of this child only, unlike RUSAGE_CHILDREN.
+        _, status, usage = os.wait4(fetcher.pid, 0)
+        elapsed = time.monotonic() - started
+        fetcher.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+        http_calls = stub_stats(args)
+    finally:
+        stub.terminate()
+        stub.wait()
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+        if output is not subprocess.DEVNULL:
+            output.close()
+
+    after = db_counters(conn)
+    routes = count_fetched_routes(conn)
+
+    result = {
+        'fetcher': name,
+        'run': run,
+        'exit_status': fetcher.returncode,
+        'seconds': round(elapsed, 3),
+        'routes': routes,
+        'routes_per_second': round(routes / elapsed, 1),
+        'http_calls': sum(sum(statuses.values()) for statuses in http_calls.values()),
+        'http_calls_by_endpoint': http_calls,
+        'peak_rss_kb': usage.ru_maxrss,
+    }
+
+    for key in after:
+        if after[key] is None or before[key] is None:
+            result['db_' + key] = None
+        else:
+            result['db_' + key] = after[key] - before[key]
+
+    return result
+
+
+def format_result(result):
+    return '{fetcher:>5} #{run}: exit {exit_status}, {seconds}s, {routes} routes, {routes_per_second} routes/s, {http_calls} HTTP calls, {statements} DB statements, {db_transactions} DB transactions, {db_inserted} rows inserted, {db_updated} updated, peak RSS {peak_rss_kb} KB'.format(
+        statements='n/a' if result['db_statements'] is None else result['db_statements'],
+        **result)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Runs the fetchers against a local Kiwi API stub and PostgreSQL. '
+                    'Select the server with PGHOST and PGPORT. The database must only hold benchmark users.')
+    parser.add_argument(
+        '--fetchers',
+        help='comma separated fetchers to benchmark.',
+        default='sync,async')
+    parser.add_argument(
+        '-n',
+        '--runs',
+        help='how many times to run each fetcher.',
+        type=int,
+        default=1)
+    parser.add_argument(
+        '--database',
+        help='database of the fetchers, created beforehand with createdb. Runs are refused if it has users the benchmark did not create.',
+        default=BENCHMARK_DATABASE)
+    parser.add_argument(
+        '--reset',
+        help='drop and recreate the tables with synthetic subscriptions before every run.',
+        action='store_true')
+    parser.add_argument('--seed', help='seed of the synthetic subscriptions and API payloads.', default='freefall')
+    parser.add_argument('--airports', help='how many airports to generate with --reset.', type=int, default=40)
+    parser.add_argument('--origins', help='how many of the airports subscriptions depart from.', type=int, default=8)
+    parser.add_argument('--subscriptions', help='how many subscriptions to generate with --reset.', type=int, default=50)
+    parser.add_argument('--pages', help='how many pages the stub returns for a /flights query over 30 days, shorter date ranges get fewer.', type=int, default=3)
+    parser.add_argument('--latency', help='seconds the stub waits before each response.', type=float, default=0.05)
+    parser.add_argument('--jitter', help='up to how many seconds the stub adds to the latency at random.', type=float, default=0.05)
+    parser.add_argument('--error-rate', help='fraction of stub responses that are 429 or 503.', type=float, default=0)
+    parser.add_argument('-P', '--port', help='port of the stub.', type=int, default=8765)
+    parser.add_argument('--python', help='python interpreter that runs the stub and the fetchers.', default=sys.executable)
+    parser.add_argument('--sync-args', help='extra arguments for fetch-data.py.', default='')
+    parser.add_argument('--async-args', help='extra arguments for fetch-data-async.py.', default='')
+    parser.add_argument('-o', '--output-dir', help='directory for the fetcher logs and report.json.')
+    parser.add_argument('--json', help='print the report as json.', action='store_true')
+
+    args = parser.parse_args()
+    args.fetchers = args.fetchers.split(',')
+
+    for name in args.fetchers:
+        if name not in FETCHERS:
+            parser.error('Unknown fetcher "{0}", expected one of {1}'.format(name, sorted(FETCHERS)))
+
+    if args.origins >= args.airports:
+        parser.error('--origins must be less than --airports')
+
+    return args
+
+
+def main():
+    args = parse_args()
+
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    conn = connect(args)
+    results = []
+
+    try:
+        check_benchmark_database(conn)
+
+        for run in range(1, args.runs + 1):
+            for name in args.fetchers:
+                log('Running {0} fetcher (run {1} of {2})...'.format(name, run, args.runs))
+                result = run_fetcher(args, conn, name, run)
+                results.append(result)
+                log(format_result(result))
+    finally:
+        conn.close()
+
+    if args.output_dir:
+        with open(os.path.join(args.output_dir, 'report.json'), 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for result in results:
+            print(format_result(result))
+
+    return 0 if all(result['exit_status'] == 0 for result in results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
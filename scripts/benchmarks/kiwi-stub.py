@@ -0,0 +1,171 @@
+#!/usr/bin/python3
+from aiohttp import web
+import argparse
+import asyncio
+import math
+import random
+from datetime import datetime, timedelta
+
+AIRLINES = ['FB', 'LH', 'BA', 'AF', 'UA', 'NH', 'W6', 'FR', 'KL', 'OS']
+HUBS = ['FRA', 'MUC', 'CDG', 'AMS', 'VIE', 'IST', 'DXB', 'LHR']
+FLIGHTS_PER_DAY = 6 # per airport pair
+KIWI_API_DATE_FORMAT = '%d/%m/%Y'
+
+
+def page_random(args, *key):
+    # str seeds are hashed by random.Random itself, so payloads stay the same
+    # across processes regardless of PYTHONHASHSEED.
+    return random.Random('|'.join(str(part) for part in (args.seed,) + key))
+
+
+def make_flight(args, airport_from, airport_to, day, slot):
+    rng = page_random(args, 'flight', airport_from, airport_to, day, slot)
+    departure = args.epoch + day * 86400 + slot * (86400 // FLIGHTS_PER_DAY) + rng.randrange(0, 3600)
+
+    return {
+        'id': '{0}{1}-{2}-{3}'.format(airport_from, airport_to, day, slot),
+        'airline': rng.choice(AIRLINES),
+        'flight_no': rng.randrange(100, 9999),
+        'flyFrom': airport_from,
+        'flyTo': airport_to,
+        'dTimeUTC': departure,
+        'aTimeUTC': departure + rng.randrange(3600, 6 * 3600),
+        'return': 0,
+    }
+
+
+def requested_days(args, query):
+    # The first day of the requested range relative to args.epoch and its
+    # length in days. A query without dates gets args.days from the epoch on.
+    if 'dateFrom' not in query or 'dateTo' not in query:
+        return 0, args.days
+
+    epoch = datetime.utcfromtimestamp(args.epoch).date()
+    date_from = datetime.strptime(query['dateFrom'], KIWI_API_DATE_FORMAT).date()
+    date_to = datetime.strptime(query['dateTo'], KIWI_API_DATE_FORMAT).date()
+
+    return (date_from - epoch).days, max(1, (date_to - date_from).days + 1)
+
+
+def make_route(args, query, index):
+    fly_from = query['flyFrom']
+    destinations = query['to'].split(',')
+    rng = page_random(args, 'route', fly_from, query['to'], query.get('dateFrom'), index)
+
+    fly_to = rng.choice(destinations)
+    hubs = [hub for hub in HUBS if hub not in (fly_from, fly_to)]
+    stops = [fly_from] + rng.sample(hubs, rng.randrange(0, 3)) + [fly_to]
+    first_day, days = requested_days(args, query)
+    day = first_day + rng.randrange(0, days)
+
+    route = [
+        make_flight(args, airport_from, airport_to, day + leg, rng.randrange(0, FLIGHTS_PER_DAY))
+        for leg, (airport_from, airport_to) in enumerate(zip(stops, stops[1:]))
+    ]
+
+    return {
+        'booking_token': '{0}:{1}:{2}:{3}:{4}'.format(args.seed, fly_from, query['to'], query.get('dateFrom'), index),
+        'price': rng.randrange(30, 1500),
+        'flyFrom': fly_from,
+        'flyTo': fly_to,
+        'route': route,
+    }
+
+
+def make_handler(args, stats, endpoint, respond):
+    errors = random.Random(args.seed)
+
+    async def handler(request):
+        if args.latency > 0 or args.jitter > 0:
+            await asyncio.sleep(args.latency + errors.uniform(0, args.jitter))
+
+        if errors.random() < args.error_rate:
+            status = errors.choice([429, 503])
+            stats[endpoint][str(status)] = stats[endpoint].get(str(status), 0) + 1
+
+            return web.Response(status=status)
+
+        stats[endpoint]['200'] = stats[endpoint].get('200', 0) + 1
+
+        return web.json_response(respond(request.query))
+
+    return handler
+
+
+def flights(args):
+    def respond(query):
+        offset = int(query.get('offset', 0))
+        limit = int(query.get('limit', 30))
+        # args.pages pages for a range of args.days days, so splitting a
+        # query by date does not multiply the routes.
+        _, days = requested_days(args, query)
+        total = math.ceil(args.pages * limit * days / args.days)
+
+        return {
+            'currency': 'USD',
+            'data': [make_route(args, query, index) for index in range(offset, min(offset + limit, total))],
+            '_next': 'next' if offset + limit < total else None,
+        }
+
+    return respond
+
+
+def locations(args):
+    def respond(query):
+        return {
+            'locations': [{
+                'code': query['term'],
+                'name': '{0} Airport'.format(query['term']),
+            }],
+        }
+
+    return respond
+
+
+def airlines(args):
+    def respond(query):
+        return [{'id': code, 'name': 'Airline'} for code in AIRLINES] + [{'id': '__', 'name': 'FakeAirline'}]
+
+    return respond
+
+
+def statistics(stats):
+    async def handler(request):
+        return web.json_response(stats)
+
+    return handler
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Local stand-in for the Kiwi API used by the fetcher benchmarks.')
+    parser.add_argument('-H', '--host', help='host to listen on.', default='127.0.0.1')
+    parser.add_argument('-P', '--port', help='port to listen on.', type=int, default=8765)
+    parser.add_argument('--seed', help='seed of the generated payloads.', default='freefall')
+    parser.add_argument('--pages', help='how many pages /flights returns for a query over --days days, shorter date ranges get fewer.', type=int, default=3)
+    parser.add_argument('--days', help='length of the date range that gets --pages pages.', type=int, default=30)
+    parser.add_argument('--latency', help='seconds to wait before each response.', type=float, default=0)
+    parser.add_argument('--jitter', help='up to how many seconds to add to the latency at random.', type=float, default=0)
+    parser.add_argument('--error-rate', help='fraction of requests answered with 429 or 503.', type=float, default=0)
+
+    args = parser.parse_args()
+    midnight = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    args.epoch = int((midnight + timedelta(days=1) - datetime(1970, 1, 1)).total_seconds())
+
+    return args
+
+
+def main():
+    args = parse_args()
+    stats = {endpoint: {} for endpoint in ['flights', 'locations', 'airlines']}
+
+    app = web.Application()
+    app.router.add_get('/flights', make_handler(args, stats, 'flights', flights(args)))
+    app.router.add_get('/locations', make_handler(args, stats, 'locations', locations(args)))
+    app.router.add_get('/airlines', make_handler(args, stats, 'airlines', airlines(args)))
+    app.router.add_get('/_stats', statistics(stats))
+
+    web.run_app(app, host=args.host, port=args.port, print=None)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,14 +3,17 @@ DROP TABLE IF EXISTS subscriptions_fetches_account_transfers;
 DROP TABLE IF EXISTS user_subscription_account_transfers;
 DROP TABLE IF EXISTS account_transfers;
 DROP TABLE IF EXISTS routes_flights;
+DROP TABLE IF EXISTS carried_routes;
 DROP TABLE IF EXISTS flights;
 DROP TABLE IF EXISTS routes;
+DROP TABLE IF EXISTS fetch_jobs;
 DROP TABLE IF EXISTS users_subscriptions;
 DROP TABLE IF EXISTS subscriptions_fetches;
 DROP TABLE IF EXISTS fetches;
 DROP TABLE IF EXISTS subscriptions;
 DROP TABLE IF EXISTS airports;
 DROP TABLE IF EXISTS airlines;
+DROP TABLE IF EXISTS fetcher_state;
 DROP TABLE IF EXISTS users;
 DROP TYPE IF EXISTS user_role;
 
@@ -29,11 +32,18 @@ CREATE TABLE airlines (
   logo_url text UNIQUE
 );
 
+CREATE TABLE fetcher_state (
+  name text PRIMARY KEY NOT NULL,
+  value text NOT NULL,
+  updated_at timestamp NOT NULL
+);
+
 CREATE TABLE subscriptions (
   id serial PRIMARY KEY NOT NULL,
   airport_from_id integer NOT NULL,
   airport_to_id integer NOT NULL,
   is_roundtrip boolean NOT NULL DEFAULT FALSE,
+  last_searched_at timestamp,
   UNIQUE(airport_from_id, airport_to_id, is_roundtrip),
   CHECK(airport_from_id <> airport_to_id),
   FOREIGN KEY(airport_from_id) REFERENCES airports(id),
@@ -49,7 +59,8 @@ ON subscriptions(is_roundtrip);
 
 CREATE TABLE fetches (
   id serial PRIMARY KEY NOT NULL,
-  fetch_time timestamp NOT NULL
+  fetch_time timestamp NOT NULL,
+  runs integer NOT NULL DEFAULT 1 -- incremented when the fetch is resumed
 );
 
 CREATE INDEX fetches_fetch_time_idx
@@ -59,6 +70,7 @@ CREATE TABLE subscriptions_fetches (
   id serial PRIMARY KEY NOT NULL,
   subscription_id integer NOT NULL,
   fetch_id integer NOT NULL,
+  completed_at timestamp, -- NULL until all routes of the subscription are written
   FOREIGN KEY(subscription_id) REFERENCES subscriptions(id) ON DELETE RESTRICT,
   FOREIGN KEY(fetch_id) REFERENCES fetches(id) ON DELETE RESTRICT,
   UNIQUE(subscription_id, fetch_id)
@@ -118,6 +130,18 @@ ON users_subscriptions(date_to);
 CREATE INDEX users_subscriptions_active_idx
 ON users_subscriptions(active);
 
+CREATE TABLE fetch_jobs (
+  id serial PRIMARY KEY NOT NULL,
+  subscription_fetch_id integer NOT NULL UNIQUE,
+  attempts integer NOT NULL DEFAULT 0,
+  leased_until timestamp, -- NULL while queued, claimable again once expired
+  done_at timestamp,
+  FOREIGN KEY(subscription_fetch_id) REFERENCES subscriptions_fetches(id) ON DELETE RESTRICT
+);
+
+CREATE INDEX fetch_jobs_queued_idx
+ON fetch_jobs(id) WHERE done_at IS NULL;
+
 CREATE TABLE routes (
   id serial PRIMARY KEY NOT NULL,
   booking_token text NOT NULL UNIQUE,
@@ -132,6 +156,17 @@ ON routes(subscription_fetch_id);
 CREATE INDEX routes_price_idx
 ON routes(price);
 
+CREATE TABLE carried_routes (
+  route_id integer PRIMARY KEY NOT NULL,
+  subscription_fetch_id integer NOT NULL, -- the route is moved here once it is completed
+  booking_token text NOT NULL,
+  FOREIGN KEY(route_id) REFERENCES routes(id) ON DELETE CASCADE,
+  FOREIGN KEY(subscription_fetch_id) REFERENCES subscriptions_fetches(id) ON DELETE CASCADE
+);
+
+CREATE INDEX carried_routes_subscription_fetch_id_idx
+ON carried_routes(subscription_fetch_id);
+
 CREATE TABLE flights (
   id serial PRIMARY KEY NOT NULL,
   airline_id integer NOT NULL,
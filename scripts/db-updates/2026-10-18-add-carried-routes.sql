@@ -0,0 +1,10 @@
+CREATE TABLE carried_routes (
+  route_id integer PRIMARY KEY NOT NULL,
+  subscription_fetch_id integer NOT NULL, -- the route is moved here once it is completed
+  booking_token text NOT NULL,
+  FOREIGN KEY(route_id) REFERENCES routes(id) ON DELETE CASCADE,
+  FOREIGN KEY(subscription_fetch_id) REFERENCES subscriptions_fetches(id) ON DELETE CASCADE
+);
+
+CREATE INDEX carried_routes_subscription_fetch_id_idx
+ON carried_routes(subscription_fetch_id);
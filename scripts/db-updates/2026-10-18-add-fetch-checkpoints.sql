@@ -0,0 +1,11 @@
+ALTER TABLE fetches
+ADD COLUMN runs integer NOT NULL DEFAULT 1;
+
+ALTER TABLE subscriptions_fetches
+ADD COLUMN completed_at timestamp;
+
+-- Earlier fetches are not resumed.
+UPDATE subscriptions_fetches
+SET completed_at = fetches.fetch_time
+FROM fetches
+WHERE fetches.id = subscriptions_fetches.fetch_id;
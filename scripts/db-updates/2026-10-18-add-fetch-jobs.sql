@@ -0,0 +1,11 @@
+CREATE TABLE fetch_jobs (
+  id serial PRIMARY KEY NOT NULL,
+  subscription_fetch_id integer NOT NULL UNIQUE,
+  attempts integer NOT NULL DEFAULT 0,
+  leased_until timestamp, -- NULL while queued, claimable again once expired
+  done_at timestamp,
+  FOREIGN KEY(subscription_fetch_id) REFERENCES subscriptions_fetches(id) ON DELETE RESTRICT
+);
+
+CREATE INDEX fetch_jobs_queued_idx
+ON fetch_jobs(id) WHERE done_at IS NULL;
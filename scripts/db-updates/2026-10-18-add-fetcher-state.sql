@@ -0,0 +1,5 @@
+CREATE TABLE fetcher_state (
+  name text PRIMARY KEY NOT NULL,
+  value text NOT NULL,
+  updated_at timestamp NOT NULL
+);
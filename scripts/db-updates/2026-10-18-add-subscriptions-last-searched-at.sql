@@ -0,0 +1,2 @@
+ALTER TABLE subscriptions
+ADD COLUMN last_searched_at timestamp;
@@ -1,78 +1,362 @@
 from urllib.parse import urlencode
+from collections import OrderedDict
+import argparse
 import asyncio
 import aiohttp
 import asyncpg
+import hashlib
+import json
+import math
+import os
+import shutil
+import signal
 import sys
-import re
-from datetime import date, datetime
+import tempfile
+import time
+import traceback
+from datetime import date, datetime, timedelta
+from aiohttp import web
 from dateutil.relativedelta import relativedelta
-
-ROUTES_LIMIT = 30
-SERVER_TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
-KIWI_API_DATE_FORMAT = '%d/%m/%Y'
-TIMEOUT = 15
+import fetcher_common
+from fetcher_common import (
+    ROUTES_LIMIT, SERVER_TIME_FORMAT, KIWI_API_DATE_FORMAT, TIMEOUT, KIWI_API_URL, DATABASE, ENDPOINT_RATE_LIMITS,
+    RESPONSE_CACHE_DIR, RESPONSE_CACHE_TTLS, RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_MEMORY_ENTRIES, LOG_LEVELS,
+    PROGRESS_INTERVAL, AIRLINE_REFRESH_INTERVAL, AIRLINE_CATALOG_STATE, FETCH_LOCK_KEY, AIRPORT_LOCATIONS_LIMIT,
+    BaseError, AppError, assert_app, assert_peer, handle_error, logger, pick_location, RateController,
+    ResponseCache, ResponseRecorder, ResponseReplayer, record_response, check_flights_response,
+    check_locations_response, check_airlines_response, airport_reference_version, airport_reference,
+    stringify_columns, to_smallest_currency_unit, parse_routes,
+)
+
+SUBSCRIPTION_CONCURRENCY = 8
+DB_CONNECTIONS_PER_SUBSCRIPTION = 2
+PREFETCH_PAGES = 2
+PAGES_PER_DATE_SHARD = 3
+MAX_DATE_SHARDS = 4
+MAX_DESTINATIONS_PER_QUERY = 10
+WORKERS = 1
+FETCH_JOB_LEASE = 300 # seconds
+FETCH_JOB_MAX_ATTEMPTS = 3
+FETCH_MAX_RUNS = 3 # a fetch left unfinished is resumed by at most FETCH_MAX_RUNS - 1 later runs
+SEARCH_WINDOW = 7 * 24 # hours
+DORMANT_REFRESH_INTERVAL = 24 # hours
+DAEMON_INTERVAL = 15 * 60 # seconds, the interval of the cron job the daemon replaces
+DAEMON_MAX_CACHED_FLIGHTS = 200000
+STATUS_STALE_CYCLES = 3
+STATUS_SHUTDOWN_TIMEOUT = 5 # seconds
+AIRPORT_LOOKUP_CONCURRENCY = 4 # /locations requests in flight for one page
 
 loop = None
 
-class BaseError(Exception):
-    def __init__(self, msg):
-        super().__init__(msg)
-        self.msg = msg
-        handle_error(self.msg)
+# Set when the daemon is asked to stop, no more queries are started after.
+stop_requested = False
+rate_controller = RateController(ENDPOINT_RATE_LIMITS)
+
+# Set up from the command line arguments.
+response_cache = None
+response_recorder = None
+response_replayer = None
+
+# asyncio.Task.current_task was removed in Python 3.9.
+current_task = asyncio.current_task if hasattr(asyncio, 'current_task') else asyncio.Task.current_task
+
+
+class PhaseTimer:
+    def __init__(self, metrics, phase, scope):
+        self.metrics = metrics
+        self.phase = phase
+        self.scope = scope
+
+    def __enter__(self):
+        self.started = time.monotonic()
+        self.metrics.enter((self.phase, self.scope))
+
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.leave()
+        self.metrics.add(self.phase, self.scope, seconds=time.monotonic() - self.started, calls=1)
+
+
+class Metrics:
+    # Durations, item counts, bytes received and statements executed per phase
+    # of a run. Everything is also recorded per query (scope). Work done while
+    # a phase is active in a task is attributed to the innermost phase of that
+    # task. Seconds are summed over concurrent tasks, so they can add up to
+    # more than the duration of the run.
+    PHASE_FIELDS = ['seconds', 'calls', 'items', 'bytes', 'statements']
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.started = time.monotonic()
+        self.finished = None
+        self.fetch_id = None
+        self.phases = {}
+        self.scopes = {}
+        self.workers = []
+        self.active = {} # task -> stack of (phase, scope)
+
+    def phase(self, phase, scope=None):
+        if scope is None:
+            scope = self.current()[1]
+
+        return PhaseTimer(self, phase, scope)
+
+    def add_scope(self, scope, destinations):
+        self.scopes[scope] = {
+            'destinations': destinations,
+            'phases': {},
+        }
+
+    def current(self):
+        stack = self.active.get(current_task(loop=loop))
+
+        if not stack:
+            return (None, None)
 
+        return stack[-1]
 
-class AppError(BaseError):
-    def __init__(self, msg):
-        super().__init__(msg)
+    def enter(self, target):
+        self.active.setdefault(current_task(loop=loop), []).append(target)
 
+    def leave(self):
+        task = current_task(loop=loop)
+        self.active[task].pop()
 
-class PeerError(BaseError):
-    def __init__(self, msg):
-        super().__init__(msg)
+        if len(self.active[task]) == 0:
+            del self.active[task]
 
+    def create_task(self, coroutine, scope=None):
+        # Tasks started inside a phase keep counting towards it.
+        target = self.current()
 
-class UserError(BaseError):
-    def __init__(self, msg):
-        super().__init__(msg)
+        if scope is not None:
+            target = (None, scope)
 
+        return loop.create_task(self.run_in(target, coroutine))
 
-def assert_app(condition, msg):
-    if not condition:
-        raise AppError(msg)
+    async def run_in(self, target, coroutine):
+        self.enter(target)
 
+        try:
+            return await coroutine
+        finally:
+            self.leave()
 
-def assert_peer(condition, msg):
-    if not condition:
-        raise PeerError(msg)
+    def add(self, phase, scope, **values):
+        if phase is None:
+            phase = 'other'
 
+        records = [self.phases.setdefault(phase, dict.fromkeys(self.PHASE_FIELDS, 0))]
 
-def assert_user(condition, msg):
-    if not condition:
-        raise UserError(msg)
+        if scope is not None:
+            records.append(self.scopes[scope]['phases'].setdefault(phase, dict.fromkeys(self.PHASE_FIELDS, 0)))
 
+        for record in records:
+            for field, value in values.items():
+                record[field] += value
 
-def handle_error(error):
-    log(error)
-    sys.exit()
+    def count(self, items):
+        phase, scope = self.current()
+        self.add(phase, scope, items=items)
 
+    def count_bytes(self, size):
+        phase, scope = self.current()
+        self.add(phase, scope, bytes=size)
 
-def log(msg):
-    print(msg)
+    def count_statement(self):
+        phase, scope = self.current()
+        self.add(phase, scope, statements=1)
 
+    def merge_worker(self, shard, exit_code, worker_metrics):
+        # worker_metrics is the json summary of the worker, None if it exited
+        # before writing one.
+        if worker_metrics is not None:
+            for phase, record in worker_metrics['phases'].items():
+                self.add(phase, None, **record)
 
-async def request(http_client, URL, params=None, max_retries=5):
+            self.scopes.update(worker_metrics['queries'])
+
+        self.workers.append({
+            'shard': shard,
+            'exit_code': exit_code,
+            'success': worker_metrics is not None and worker_metrics['success'],
+            'seconds': None if worker_metrics is None else worker_metrics['seconds'],
+        })
+
+    def finish(self):
+        self.finished = time.monotonic()
+
+    def summary(self):
+        return ', '.join(
+            '{0}: {1:.2f}s/{2} items/{3} statements'.format(phase, record['seconds'], record['items'], record['statements'])
+            for phase, record in sorted(self.phases.items()))
+
+    def to_json(self, success):
+        return {
+            'fetch_id': self.fetch_id,
+            'success': success,
+            'started_at': datetime.utcfromtimestamp(self.started_at).strftime(SERVER_TIME_FORMAT),
+            'seconds': (self.finished or time.monotonic()) - self.started,
+            'phases': self.phases,
+            'queries': self.scopes,
+            'workers': self.workers,
+        }
+
+    def to_prometheus(self, success):
+        lines = [
+            '# HELP freefall_fetch_success Whether the last fetch run completed.',
+            '# TYPE freefall_fetch_success gauge',
+            'freefall_fetch_success {0}'.format(int(success)),
+            '# HELP freefall_fetch_last_run_timestamp_seconds When the last fetch run started.',
+            '# TYPE freefall_fetch_last_run_timestamp_seconds gauge',
+            'freefall_fetch_last_run_timestamp_seconds {0:.3f}'.format(self.started_at),
+            '# HELP freefall_fetch_duration_seconds Duration of the last fetch run.',
+            '# TYPE freefall_fetch_duration_seconds gauge',
+            'freefall_fetch_duration_seconds {0:.3f}'.format((self.finished or time.monotonic()) - self.started),
+            '# HELP freefall_fetch_queries Queries sent to the Kiwi API by the last fetch run.',
+            '# TYPE freefall_fetch_queries gauge',
+            'freefall_fetch_queries {0}'.format(len(self.scopes)),
+        ]
+
+        # Per query metrics stay in the json summary, as labels they would
+        # create a series for every origin and destination list.
+        for field in self.PHASE_FIELDS:
+            lines.append('# HELP freefall_fetch_phase_{0} {0} of each phase of the last fetch run.'.format(field))
+            lines.append('# TYPE freefall_fetch_phase_{0} gauge'.format(field))
+
+            for phase, record in sorted(self.phases.items()):
+                lines.append('freefall_fetch_phase_{0}{{phase="{1}"}} {2}'.format(field, phase, record[field]))
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self, json_path, prometheus_path, success):
+        # Written to a temporary file first, so collectors never read a half
+        # written file.
+        outputs = [
+            (json_path, lambda: json.dumps(self.to_json(success), indent=2, sort_keys=True)),
+            (prometheus_path, lambda: self.to_prometheus(success)),
+        ]
+
+        for path, render in outputs:
+            if path is None:
+                continue
+
+            with open(path + '.tmp', 'w') as f:
+                f.write(render())
+
+            os.rename(path + '.tmp', path)
+
+
+metrics = Metrics()
+
+
+class DaemonStatus:
+    # What the status endpoint reports about a running daemon. It is healthy
+    # while cycles keep completing, at most STATUS_STALE_CYCLES intervals
+    # apart.
+    def __init__(self, interval):
+        self.interval = interval
+        self.started_at = time.time()
+        self.state = 'starting'
+        self.cycles = 0
+        self.cycle_started_at = None
+        self.last_cycle = None
+        self.completed_at = self.started_at
+        self.next_cycle_at = None
+
+    def start_cycle(self):
+        self.state = 'fetching'
+        self.cycles += 1
+        self.cycle_started_at = time.time()
+        self.next_cycle_at = None
+
+    def finish_cycle(self, cycle_metrics, error):
+        self.last_cycle = {
+            'cycle': self.cycles,
+            'fetch_id': cycle_metrics.fetch_id,
+            'finished_at': time.time(),
+            'seconds': cycle_metrics.finished - cycle_metrics.started,
+            'error': error,
+        }
+
+        if error is None:
+            self.completed_at = self.last_cycle['finished_at']
+
+    def wait(self, seconds):
+        self.state = 'waiting'
+        self.next_cycle_at = time.time() + max(0, seconds)
+
+    def is_healthy(self):
+        # Failed cycles do not count, a daemon that keeps failing turns
+        # unhealthy like one that hangs.
+        return time.time() - self.completed_at <= STATUS_STALE_CYCLES * self.interval
+
+    def to_json(self):
+        last_cycle = None
+
+        if self.last_cycle is not None:
+            last_cycle = dict(self.last_cycle, finished_at=format_timestamp(self.last_cycle['finished_at']))
+
+        return {
+            'healthy': self.is_healthy(),
+            'state': self.state,
+            'pid': os.getpid(),
+            'started_at': format_timestamp(self.started_at),
+            'cycles': self.cycles,
+            'cycle_started_at': format_timestamp(self.cycle_started_at),
+            'last_cycle': last_cycle,
+            'next_cycle_at': format_timestamp(self.next_cycle_at),
+        }
+
+
+def format_timestamp(seconds):
+    if seconds is None:
+        return None
+
+    return datetime.utcfromtimestamp(seconds).strftime(SERVER_TIME_FORMAT)
+
+
+class InstrumentedConnection(asyncpg.connection.Connection):
+    # Counts every statement towards the current phase of the running task.
+    async def execute(self, *args, **kwargs):
+        metrics.count_statement()
+        return await super().execute(*args, **kwargs)
+
+    async def executemany(self, *args, **kwargs):
+        metrics.count_statement()
+        return await super().executemany(*args, **kwargs)
+
+    async def fetch(self, *args, **kwargs):
+        metrics.count_statement()
+        return await super().fetch(*args, **kwargs)
+
+    async def fetchrow(self, *args, **kwargs):
+        metrics.count_statement()
+        return await super().fetchrow(*args, **kwargs)
+
+    async def fetchval(self, *args, **kwargs):
+        metrics.count_statement()
+        return await super().fetchval(*args, **kwargs)
+
+    async def copy_records_to_table(self, *args, **kwargs):
+        metrics.count_statement()
+        return await super().copy_records_to_table(*args, **kwargs)
+
+
+async def request(http_client, URL, params=None, max_retries=5, check_response=None, max_age=None):
     assert_app(
         isinstance(http_client, aiohttp.client.ClientSession),
-        'Expected http_client to be aiohttp.client.ClientSession, but was "{0}"'.format(type(http_client)))
+        'Expected http_client to be aiohttp.client.ClientSession, but was "{0}"', type(http_client))
     assert_app(
         isinstance(URL, str),
-        'Expected url to be str, but was {0}, value "{1}"'.format(type(URL), URL))
+        'Expected url to be str, but was {0}, value "{1}"', type(URL), URL)
     assert_app(
         params is None or isinstance(params, dict),
-        'Expected params to be None or dict, but was {0}, value "{1}"'.format(type(params), params))
+        'Expected params to be None or dict, but was {0}, value "{1}"', type(params), params)
     assert_app(
         isinstance(max_retries, int),
-        'Expected max_retries to be int, but was "{0}"'.format(type(max_retries)))
+        'Expected max_retries to be int, but was "{0}"', type(max_retries))
 
     uri = URL;
 
@@ -82,15 +366,97 @@ async def request(http_client, URL, params=None, max_retries=5):
     if params is not None:
         uri += urlencode(params)
 
-    log(uri)
+    if response_replayer is not None:
+        parsed = response_replayer.response(URL, params)
 
-    try:
-        async with http_client.get(uri) as response:
-            parsed = await response.json()
-    except aiohttp.ClientError as e:
-        raise PeerError(e) # TODO timeout
+        if check_response is not None:
+            check_response(parsed)
+
+        return parsed
+
+    # max_age overrides the TTL of the endpoint, 0 always revalidates.
+    cache_key = None
+    cached = None
+
+    if response_cache is not None and response_cache.caches(URL):
+        cache_key = response_cache.key(URL, params)
+        cached = response_cache.get(cache_key)
+
+        if cached is not None and response_cache.is_fresh(URL, cached, max_age):
+            response_cache.hits += 1
+            record_response(response_recorder, URL, params, time.time(), time.monotonic(), None, json.dumps(cached['body']))
+
+            return cached['body']
 
-    return parsed
+    headers = {} if cache_key is None else response_cache.conditional_headers(cached)
+    bucket = rate_controller.get_bucket(URL)
+
+    for attempt in range(max_retries + 1):
+        wait_time = bucket.reserve()
+
+        if wait_time > 0:
+            rate_controller.throttled_time += wait_time
+            await asyncio.sleep(wait_time)
+
+        logger.debug(uri)
+
+        started_at = time.time()
+        started = time.monotonic()
+        network_error = False
+
+        try:
+            async with http_client.get(uri, headers=headers, timeout=TIMEOUT) as response:
+                if response.status == 429 or response.status >= 500:
+                    reason = 'status {0}'.format(response.status)
+                    record_response(response_recorder, URL, params, started_at, started, response.status, None)
+                elif response.status == 304 and cached is not None:
+                    bucket.on_success()
+                    response_cache.revalidated += 1
+                    response_cache.put(cache_key, cached['body'], response.headers, cached)
+                    record_response(response_recorder, URL, params, started_at, started, response.status, json.dumps(cached['body']))
+
+                    return cached['body']
+                else:
+                    assert_peer(response.status == 200, 'Request to {0} failed with status {1}', uri, response.status)
+
+                    body = await response.read()
+                    metrics.count_bytes(len(body))
+
+                    parsed = await response.json()
+                    bucket.on_success()
+                    record_response(response_recorder, URL, params, started_at, started, response.status, body.decode('utf-8'))
+
+                    if check_response is not None:
+                        check_response(parsed)
+
+                    if cache_key is not None:
+                        response_cache.misses += 1
+                        response_cache.put(cache_key, parsed, response.headers, cached)
+
+                    return parsed
+        except asyncio.TimeoutError:
+            reason = 'timeout'
+            record_response(response_recorder, URL, params, started_at, started, None, None, reason)
+        except aiohttp.ClientError as e:
+            # Connection resets, DNS failures and disconnects are retried too,
+            # but they do not mean that the API wants fewer requests.
+            reason = '{0}: {1}'.format(type(e).__name__, e)
+            network_error = True
+            record_response(response_recorder, URL, params, started_at, started, None, None, reason)
+
+        if not network_error:
+            bucket.on_throttle()
+
+        if attempt >= max_retries and response_cache is not None and response_cache.is_usable_stale(cached):
+            return response_cache.serve_stale(uri, cached, reason)
+
+        assert_peer(attempt < max_retries, 'Request to {0} failed after {1} retries ({2})', uri, max_retries, reason)
+
+        retry_delay = rate_controller.retry_delay(attempt)
+
+        logger.warning('Request to {0} failed ({1}). Retrying in {2:.2f}s', uri, reason, retry_delay)
+
+        await asyncio.sleep(retry_delay)
 
 
 def assert_db_connection(conn, msg):
@@ -98,20 +464,88 @@ def assert_db_connection(conn, msg):
     assert_app(not conn.is_closed(), msg)
 
 
-def stringify_columns(columns):
-    assert_app(isinstance(columns, list), 'Expected argument "columns" in stringify_columns function to be list, but was {0}'.format(type(columns)))
-    assert_app(len(columns) > 0, 'Expected list "columns" to have a length > 0, but length was {0}'.format(len(columns)))
-    assert_app(all(isinstance(col, str) for col in columns), 'All elements in arg "columns" in stringify_columns function are required to be str.')
+class DimensionCache:
+    # Id lookups for airports, airlines and flights, kept for the whole run or
+    # daemon. Preloaded once from the database and filled write-through as new
+    # rows are inserted.
+    def __init__(self):
+        self.airport_ids = {}
+        self.airline_ids = {}
+        self.flight_ids = {}
+        self.pending_airports = {}
+        self.airline_sync = None # task syncing the airline catalog in this cycle
+        self.hits = {'airports': 0, 'airlines': 0, 'flights': 0}
+        self.misses = {'airports': 0, 'airlines': 0, 'flights': 0}
+
+    async def preload(self, conn):
+        assert_db_connection(conn, 'DimensionCache.preload called without connection to db.')
+
+        for airport in await select(conn, 'airports', ['id', 'iata_code']):
+            self.add_airport(airport['id'], airport['iata_code'])
+
+        for airline in await select(conn, 'airlines', ['id', 'code']):
+            self.add_airline(airline['id'], airline['code'])
+
+        logger.info('Preloaded {0} airports and {1} airlines into dimension cache.', len(self.airport_ids), len(self.airline_ids))
+        logger.info('Airport reference {0} knows {1} airports.', airport_reference_version, len(airport_reference))
+
+    def _lookup(self, dimension, mapping, key):
+        if key in mapping:
+            self.hits[dimension] += 1
+            return mapping[key]
+
+        self.misses[dimension] += 1
+
+        return None
+
+    def get_airport_id(self, iata_code):
+        return self._lookup('airports', self.airport_ids, iata_code)
+
+    def get_airline_id(self, code):
+        return self._lookup('airlines', self.airline_ids, code)
+
+    def get_flight_id(self, remote_id):
+        return self._lookup('flights', self.flight_ids, remote_id)
+
+    def add_airport(self, airport_id, iata_code):
+        assert_app(isinstance(airport_id, int), 'Expected airport_id to be int, but was "{0}"', type(airport_id))
+        assert_app(isinstance(iata_code, str), 'Expected iata_code to be str, but was "{0}"', type(iata_code))
+
+        self.airport_ids[iata_code] = airport_id
+
+    def add_airline(self, airline_id, code):
+        assert_app(isinstance(airline_id, int), 'Expected airline_id to be int, but was "{0}"', type(airline_id))
+        assert_app(isinstance(code, str), 'Expected code to be str, but was "{0}"', type(code))
+
+        self.airline_ids[code] = airline_id
 
-    return ', '.join(columns)
+    def add_flight(self, flight_id, remote_id):
+        if fetcher_common.internal_checks:
+            assert_app(isinstance(flight_id, int), 'Expected flight_id to be int, but was "{0}"', type(flight_id))
+            assert_app(isinstance(remote_id, str), 'Expected remote_id to be str, but was "{0}"', type(remote_id))
 
-def to_smallest_currency_unit(quantity):
-    return quantity * 100
+        self.flight_ids[remote_id] = flight_id
+
+    def unknown_airlines(self, codes):
+        return [code for code in codes if code not in self.airline_ids]
+
+    def start_cycle(self, max_flights):
+        # The same flights come back in every cycle of the daemon, so their
+        # ids are kept until there are more than max_flights of them.
+        if len(self.flight_ids) > max_flights:
+            self.flight_ids = {}
+
+        self.airline_sync = None
+        self.hits = dict.fromkeys(self.hits, 0)
+        self.misses = dict.fromkeys(self.misses, 0)
+
+    def stats(self):
+        return 'hits: {0}, misses: {1}'.format(self.hits, self.misses)
 
 
 async def select(conn, table, columns):
-    assert_app(isinstance(table, str), 'Expected argument "table" in select function to be str, but was {0}'.format(type(table)))
-    assert_app(isinstance(columns, list), 'Expected argument "columns" in select function to be list, but was {0}'.format(type(columns)))
+    assert_app(isinstance(table, str), 'Expected argument "table" in select function to be str, but was {0}', type(table))
+    assert_app(isinstance(columns, list), 'Expected argument "columns" in select function to be list, but was {0}', type(columns))
     assert_db_connection(conn, 'select function called without connection to db.')
 
     result = await conn.fetch('SELECT {0} FROM {1};'.format(stringify_columns(columns), table))
@@ -120,24 +554,24 @@ async def select(conn, table, columns):
 
 
 async def select_where(conn, table, columns, where):
-    assert_app(isinstance(table, str), 'Expected argument "table" in select_where function to be str, but was {0}'.format(type(table)))
-    assert_app(isinstance(columns, list), 'Expected argument "columns" in select_where function to be list, but was {0}'.format(type(columns)))
-    assert_app(isinstance(where, dict), 'Expected argument "where" in select_where function to be a dict, but was {0}'.format(type(where)))
-    assert_app(len(where) == 1, 'Expected argument "where" in select_where function to be a dict of length=1, but length={0}'.format(len(where)))
+    assert_app(isinstance(table, str), 'Expected argument "table" in select_where function to be str, but was {0}', type(table))
+    assert_app(isinstance(columns, list), 'Expected argument "columns" in select_where function to be list, but was {0}', type(columns))
+    assert_app(isinstance(where, dict), 'Expected argument "where" in select_where function to be a dict, but was {0}', type(where))
+    assert_app(len(where) == 1, 'Expected argument "where" in select_where function to be a dict of length=1, but length={0}', len(where))
     assert_db_connection(conn, 'select_where function called without connection to db.')
 
     whereCol = list(where.keys())[0]
 
     result = await conn.fetch('SELECT {0} FROM {1} WHERE {2} = $1;'.format(stringify_columns(columns), table, whereCol), where[whereCol])
 
-    assert_app(isinstance(result, list), 'Expected result in select_where function to be a list, but was {0}'.format(type(result)))
+    assert_app(isinstance(result, list), 'Expected result in select_where function to be a list, but was {0}', type(result))
 
     return result
 
 
 async def insert(conn, table, data):
-    assert_app(isinstance(table, str), 'Expected argument "table" in insert function to be str, but was {0}'.format(type(table)))
-    assert_app(isinstance(data, dict), 'Expected argument "data" in insert function to be dict, but was {0}'.format(type(data)))
+    assert_app(isinstance(table, str), 'Expected argument "table" in insert function to be str, but was {0}', type(table))
+    assert_app(isinstance(data, dict), 'Expected argument "data" in insert function to be dict, but was {0}', type(data))
     assert_db_connection(conn, 'insert function called without connection to db.')
 
     columns = []
@@ -151,14 +585,14 @@ async def insert(conn, table, data):
 
     insert_result = await conn.fetch('INSERT INTO {0} ({1}) VALUES ({2}) RETURNING *;'.format(table, stringify_columns(columns), rowStringified), *values)
 
-    assert_app(isinstance(insert_result, list), 'Expected insert_result to be list, but was {0}'.format(type(insert_result)))
-    assert_app(len(insert_result) == 1, 'Expected insert_result to have length=1, but got length={0}'.format(len(insert_result)))
+    assert_app(isinstance(insert_result, list), 'Expected insert_result to be list, but was {0}', type(insert_result))
+    assert_app(len(insert_result) == 1, 'Expected insert_result to have length=1, but got length={0}', len(insert_result))
 
     inserted_item = insert_result[0]
 
-    assert_app(isinstance(inserted_item, asyncpg.Record), 'Expected inserted_item to be a asyncpg.Record, but was {0}'.format(type(inserted_item)))
+    assert_app(isinstance(inserted_item, asyncpg.Record), 'Expected inserted_item to be a asyncpg.Record, but was {0}', type(inserted_item))
     assert_app('id' in inserted_item, 'inserted_item does not have a key "id"')
-    assert_app(isinstance(inserted_item['id'], int), 'Expected inserted_item["id"] to be an int, but was {0}'.format(type(inserted_item['id'])))
+    assert_app(isinstance(inserted_item['id'], int), 'Expected inserted_item["id"] to be an int, but was {0}', type(inserted_item['id']))
 
     return inserted_item
 
@@ -168,439 +602,1141 @@ async def insert_data_fetch(conn):
 
     insert_result = await conn.fetch('INSERT INTO fetches(fetch_time) VALUES (now()) RETURNING id;');
 
-    assert_app(isinstance(insert_result, list), 'Expected insert_result to be list, but was {0}'.format(type(insert_result)))
-    assert_app(len(insert_result) == 1, 'Expected insert_result to have length=1, but got length={0}'.format(len(insert_result)))
+    assert_app(isinstance(insert_result, list), 'Expected insert_result to be list, but was {0}', type(insert_result))
+    assert_app(len(insert_result) == 1, 'Expected insert_result to have length=1, but got length={0}', len(insert_result))
 
     inserted_item = insert_result[0]
 
-    assert_app(isinstance(inserted_item, asyncpg.Record), 'Expected inserted_item to be a asyncpg.Record, but was {0}'.format(type(inserted_item)))
+    assert_app(isinstance(inserted_item, asyncpg.Record), 'Expected inserted_item to be a asyncpg.Record, but was {0}', type(inserted_item))
     assert_app('id' in inserted_item, 'inserted_item does not have a key "id"')
-    assert_app(isinstance(inserted_item['id'], int), 'Expected inserted_item["id"] to be an int, but was {0}'.format(type(inserted_item['id'])))
+    assert_app(isinstance(inserted_item['id'], int), 'Expected inserted_item["id"] to be an int, but was {0}', type(inserted_item['id']))
 
     return inserted_item['id']
 
 
-async def insert_if_not_exists(conn, table, data, exists_check):
-    # TODO ask if transaction needed
-    assert_db_connection(conn, 'insert_if_not_exists function called without connection to db.')
-    assert_app(isinstance(table, str), 'Expected argument "table" in insert_if_not_exists function to be str, but was {0}'.format(type(table)))
-    assert_app(isinstance(data, dict), 'Expected argument "data" in insert_if_not_exists function to be dict, but was {0}'.format(type(data)))
-    assert_app(isinstance(exists_check, dict), 'Expected argument "exists_check" in insert_if_not_exists function to be dict, but was {0}'.format(type(exists_check)))
+async def insert_flights(conn, cache, flights):
+    assert_db_connection(conn, 'insert_flights function called without connection to db.')
+    assert_app(conn.is_in_transaction(), 'Connection not in transaction, in insert_flights')
+    assert_app(isinstance(cache, DimensionCache), 'Expected cache to be DimensionCache, but was "{0}"', type(cache))
+    assert_app(isinstance(flights, list), 'Expected flights to be a list, but was "{0}"', type(flights))
 
-    found = await select_where(conn, table, list(data.keys()), exists_check)
+    flight_ids = {}
+    records = []
 
-    assert_app(isinstance(found, list), 'Expected result after exist check in insert_if_not_exists function to be list, but was {0}'.format(type(found)))
+    for flight in flights:
+        flight_id = cache.get_flight_id(flight.remote_id)
 
-    if len(found) > 0:
-        assert_app(len(found) == 1, 'Expected length of found in insert_if_not_exists function to be 1, but was {0}'.format(len(found)))
+        if flight_id is not None:
+            flight_ids[flight.remote_id] = flight_id
+            continue
 
-        return False
+        airline_id = cache.get_airline_id(flight.airline)
+        airport_from_id = cache.get_airport_id(flight.airport_from)
+        airport_to_id = cache.get_airport_id(flight.airport_to)
 
-    inserted = await insert(conn, table, data)
+        if fetcher_common.internal_checks:
+            assert_app(isinstance(airline_id, int), 'Airline {0} of flight {1} not found', flight.airline, flight.remote_id)
+            assert_app(isinstance(airport_from_id, int), 'Airport {0} of flight {1} not found', flight.airport_from, flight.remote_id)
+            assert_app(isinstance(airport_to_id, int), 'Airport {0} of flight {1} not found', flight.airport_to, flight.remote_id)
 
-    assert_app(isinstance(inserted, asyncpg.Record), 'Expected inserted to be an asyncpg.Record, but was {0}'.format(type(inserted)))
+        records.append((
+            airline_id,
+            flight.flight_no,
+            airport_from_id,
+            airport_to_id,
+            datetime.fromtimestamp(flight.dtime),
+            datetime.fromtimestamp(flight.atime),
+            flight.remote_id
+        ))
 
-    return True
+    if len(records) == 0:
+        return flight_ids
+
+    await conn.execute('''
 
+        CREATE TEMPORARY TABLE flights_batch (
+            airline_id integer NOT NULL,
+            flight_number text NOT NULL,
+            airport_from_id integer NOT NULL,
+            airport_to_id integer NOT NULL,
+            dtime timestamp NOT NULL,
+            atime timestamp NOT NULL,
+            remote_id text NOT NULL
+        ) ON COMMIT DROP;
+
+    ''')
+
+    await conn.copy_records_to_table(
+        'flights_batch',
+        records=records,
+        columns=['airline_id', 'flight_number', 'airport_from_id', 'airport_to_id', 'dtime', 'atime', 'remote_id']
+    )
+
+    # Rows are inserted in remote_id order, so workers inserting overlapping
+    # batches wait for each other instead of deadlocking.
+    await conn.execute('''
 
-async def get_airport_id(pool, iata_code):
-    assert_app(isinstance(pool, asyncpg.pool.Pool), 'Expected pool to be asyncpg.pool.Pool, but was "{0}"'.format(type(pool)))
-    assert_app(isinstance(iata_code, str), 'Expected iata_code to be a string, but was "{0}"'.format(type(iata_code)))
+        INSERT INTO flights
+            (airline_id, flight_number, airport_from_id, airport_to_id, dtime, atime, remote_id)
+        SELECT airline_id, flight_number, airport_from_id, airport_to_id, dtime, atime, remote_id
+        FROM flights_batch
+        ORDER BY remote_id
+        ON CONFLICT (remote_id) DO NOTHING;
 
-    try:
-        conn = await pool.acquire()
-        select_result = await select_where(conn, 'airports', ['id'], {
-            'iata_code': iata_code
-        })
+    ''')
 
-        assert_app(isinstance(select_result, list), 'Expected airports select result to be a list, but was {0}'.format(type(select_result)))
-        assert_app(len(select_result) == 1, 'Expected only one airports select result, but got {0}'.format(len(select_result)))
-        assert_app(isinstance(select_result[0], asyncpg.Record), 'Expected element in airport select result to be asyncpg.Record, but was {0}'.format(select_result[0]))
-        assert_app('id' in select_result[0].keys(), 'Key "id" not found in airport select result.')
-        assert_app(isinstance(select_result[0]['id'], int), 'Expected id in airport select result element to be int, but was {0}'.format(select_result[0]['id']))
+    flight_id_results = await conn.fetch('''
 
-        return select_result[0]['id']
-    finally:
-        await pool.release(conn)
+        SELECT flights.id, flights.remote_id
+        FROM flights
+        JOIN flights_batch ON flights_batch.remote_id = flights.remote_id;
+
+    ''')
+
+    assert_app(isinstance(flight_id_results, list), 'Expected flight_id_results to be a list, but was {0}', type(flight_id_results))
+    if len(flight_id_results) != len(records):
+        raise AppError('Expected {0} flight ids after batch insert, but got {1}'.format(len(records), len(flight_id_results)))
 
+    for row in flight_id_results:
+        flight_ids[row['remote_id']] = row['id']
 
-async def get_flight(pool, flight):
-    assert_app(isinstance(pool, asyncpg.pool.Pool), 'Expected pool to be asyncpg.pool.Pool, but was "{0}"'.format(type(pool)))
-    assert_app(isinstance(flight, dict), 'Expected flight to be a dict, but was "{0}"'.format(type(flight)))
+    return flight_ids
 
-    expect_flight_keys = ['flight_no', 'dTimeUTC', 'aTimeUTC', 'return', 'flyFrom', 'flyTo', 'airline', 'id']
 
-    for key in expect_flight_keys:
-        assert_app(key in flight, 'Key {0} not found in flight'.format(key))
+async def insert_routes(conn, routes_by_subscription_fetch):
+    assert_db_connection(conn, 'insert_routes function called without connection to db.')
+    assert_app(conn.is_in_transaction(), 'Connection not in transaction, in insert_routes')
+    assert_app(isinstance(routes_by_subscription_fetch, dict), 'Expected routes_by_subscription_fetch to be a dict, but was "{0}"', type(routes_by_subscription_fetch))
 
-    integer_keys = ['flight_no', 'dTimeUTC', 'aTimeUTC']
+    booking_tokens = []
+    prices = []
+    subscription_fetch_ids = []
 
-    for key in integer_keys:
-        assert_app(isinstance(flight[key], int), 'Expected {0} in flight to be int, but was {1}'.format(key, type(flight[key])))
+    for subscription_fetch_id, routes in routes_by_subscription_fetch.items():
+        for route in routes:
+            booking_tokens.append(route.booking_token)
+            prices.append(to_smallest_currency_unit(route.price))
+            subscription_fetch_ids.append(subscription_fetch_id)
 
-    string_keys = ['flyFrom', 'flyTo', 'airline', 'id']
+    if len(booking_tokens) == 0:
+        return {}
 
-    for key in string_keys:
-        assert_app(isinstance(flight[key], str), 'Expected {0} in flight to be str, but was {1}'.format(key, type(flight[key])))
+    # A changed offer can come back with a booking_token that is already
+    # stored. Its row is taken over and its flights are rewritten. Rows are
+    # inserted in booking_token order, so writers with overlapping batches
+    # wait for each other instead of deadlocking.
+    route_id_results = await conn.fetch('''
 
-    assert_app(flight['return'] in [0, 1], 'Expected return in flight to be 0 or 1, but was {0}'.format(flight['return']))
-    assert_app(flight['flyFrom'] != flight['flyTo'], 'Expected different values for flyFrom and flyTo, but got {0} and {1}'.format(flight['flyFrom'], flight['flyTo']))
+        INSERT INTO routes
+            (booking_token, price, subscription_fetch_id)
+        SELECT batch.booking_token, batch.price, batch.subscription_fetch_id
+        FROM unnest($1::text[], $2::integer[], $3::integer[]) AS batch(booking_token, price, subscription_fetch_id)
+        ORDER BY batch.booking_token
+        ON CONFLICT (booking_token) DO UPDATE
+        SET
+            price = EXCLUDED.price,
+            subscription_fetch_id = EXCLUDED.subscription_fetch_id
+        RETURNING id, booking_token;
 
-    airport_codes = [
-        flight['flyFrom'],
-        flight['flyTo']
+    ''', booking_tokens, prices, subscription_fetch_ids)
+
+    assert_app(isinstance(route_id_results, list), 'Expected route_id_results to be a list, but was {0}', type(route_id_results))
+    if len(route_id_results) != len(booking_tokens):
+        raise AppError('Expected {0} inserted routes, but got {1}'.format(len(booking_tokens), len(route_id_results)))
+
+    return {row['booking_token']: row['id'] for row in route_id_results}
+
+
+async def insert_routes_flights(conn, routes_by_subscription_fetch, route_ids, flight_ids):
+    assert_db_connection(conn, 'insert_routes_flights function called without connection to db.')
+    assert_app(isinstance(route_ids, dict), 'Expected route_ids to be a dict, but was "{0}"', type(route_ids))
+    assert_app(isinstance(flight_ids, dict), 'Expected flight_ids to be a dict, but was "{0}"', type(flight_ids))
+
+    records = [
+        (flight_ids[flight.remote_id], route_ids[route.booking_token], flight.is_return)
+        for routes in routes_by_subscription_fetch.values()
+        for route in routes
+        for flight in route.flights
     ]
 
-    airport_id_tasks = [loop.create_task(get_airport_id(pool, iata_code)) for iata_code in airport_codes]
+    if len(records) == 0:
+        return
+
+    await conn.execute('''
+
+        DELETE FROM routes_flights
+        WHERE route_id = ANY($1::integer[]);
 
-    if len(airport_id_tasks) > 0:
-        await asyncio.wait(airport_id_tasks)
+    ''', list(route_ids.values()))
 
-    airport_ids = [task.result() for task in airport_id_tasks]
+    await conn.copy_records_to_table(
+        'routes_flights',
+        records=records,
+        columns=['flight_id', 'route_id', 'is_return']
+    )
 
-    for airport_id in airport_ids:
-        assert_app(isinstance(airport_id, int), 'Expected airport_id to be int, but was "{0}"'.format(type(airport_id)))
+
+async def carry_routes_forward(conn, carried_routes):
+    assert_db_connection(conn, 'carry_routes_forward function called without connection to db.')
+    assert_app(isinstance(carried_routes, dict), 'Expected carried_routes to be a dict, but was "{0}"', type(carried_routes))
+
+    if len(carried_routes) == 0:
+        return {}
+
+    route_ids = sorted(carried_routes.keys())
+
+    # The stored route stays with the previous fetch, which search keeps
+    # serving, until the current subscription_fetch is completed, see
+    # complete_subscriptions_fetches. It then takes the booking_token of the
+    # current offer, an old token would be taken over by the next offer that
+    # comes back with it. When another route already holds or is going to
+    # take the current token, the route is not carried and is written like a
+    # changed one.
+    carried_results = await conn.fetch('''
+
+        INSERT INTO carried_routes
+            (route_id, subscription_fetch_id, booking_token)
+        SELECT carried.route_id, carried.subscription_fetch_id, carried.booking_token
+        FROM unnest($1::integer[], $2::integer[], $3::text[]) AS carried(route_id, subscription_fetch_id, booking_token)
+        WHERE
+            NOT EXISTS (
+                SELECT 1
+                FROM routes AS taken
+                WHERE
+                    taken.booking_token = carried.booking_token AND
+                    taken.id <> carried.route_id
+            ) AND
+            NOT EXISTS (
+                SELECT 1
+                FROM carried_routes AS taken
+                WHERE
+                    taken.booking_token = carried.booking_token AND
+                    taken.route_id <> carried.route_id
+            )
+        ORDER BY carried.route_id
+        ON CONFLICT (route_id) DO UPDATE
+        SET
+            subscription_fetch_id = EXCLUDED.subscription_fetch_id,
+            booking_token = EXCLUDED.booking_token
+        RETURNING route_id AS id;
+
+    ''',
+        route_ids,
+        [carried_routes[route_id][0] for route_id in route_ids],
+        [carried_routes[route_id][1].booking_token for route_id in route_ids])
+
+    assert_app(isinstance(carried_results, list), 'Expected carried_results to be a list, but was {0}', type(carried_results))
+
+    carried_ids = {row['id'] for row in carried_results}
+
+    return {
+        route_id: subscription_fetch_and_route
+        for route_id, subscription_fetch_and_route in carried_routes.items()
+        if route_id not in carried_ids
+    }
+
+
+def route_fingerprint(price, flights):
+    # price is in the smallest currency unit, flights are (remote_id, is_return) pairs.
+    fingerprint = '{0}|{1}'.format(price, ','.join(sorted(
+        '{0}:{1}'.format(remote_id, int(is_return)) for remote_id, is_return in flights)))
+
+    return hashlib.sha1(fingerprint.encode('utf-8')).hexdigest()
+
+
+async def select_previous_routes(pool, subscription_fetch_ids):
+    assert_app(isinstance(pool, asyncpg.pool.Pool), 'Expected pool to be asyncpg.pool.Pool, but was "{0}"', type(pool))
+    assert_app(isinstance(subscription_fetch_ids, list), 'Expected subscription_fetch_ids to be a list, but was "{0}"', type(subscription_fetch_ids))
 
     try:
         conn = await pool.acquire()
-        airline_id_result = await select_where(conn, 'airlines', ['id'], {
-            'code': flight['airline']
-        })
 
-        assert_app(isinstance(airline_id_result, list), 'Expected airline select result to be a list, but was {0}'.format(type(airline_id_result)))
-        assert_app(len(airline_id_result) == 1, 'Expected only one airline select result, but got {0}'.format(len(airline_id_result)))
-        assert_app(isinstance(airline_id_result[0], asyncpg.Record), 'Expected element in airline select result to be asyncpg.Record, but was {0}'.format(airline_id_result[0]))
-        assert_app('id' in airline_id_result[0].keys(), 'Key "id" not found in airline id result.')
-        assert_app(isinstance(airline_id_result[0]['id'], int), 'Expected id in airline select result element to be int, but was {0}'.format(airline_id_result[0]['id']))
-
-        log('Inserting if not exists flight {0} {1} from {2} to {3} departure time {4} ...'.format(
-            flight['airline'],
-            flight['flight_no'],
-            flight['flyFrom'],
-            flight['flyTo'],
-            datetime.fromtimestamp(flight['dTimeUTC'])))
-
-        # TODO ask if transaction needed
-        await insert_if_not_exists(conn, 'flights', {
-            'airline_id': airline_id_result[0]['id'],
-            'airport_from_id': airport_ids[0],
-            'airport_to_id': airport_ids[1],
-            'dtime': datetime.fromtimestamp(flight['dTimeUTC']),
-            'atime': datetime.fromtimestamp(flight['aTimeUTC']),
-            'flight_number': str(flight['flight_no']),
-            'remote_id': flight['id']
-        }, {
-            'remote_id': flight['id']
-        })
-    #except: # TODO
+        # Routes of the latest earlier completed fetch of the same
+        # subscription, the one search serves, keyed by the
+        # subscription_fetch of this run.
+        previous_routes = await conn.fetch('''
+
+            SELECT
+                current.id AS subscription_fetch_id,
+                routes.id AS route_id,
+                routes.price,
+                array_agg(flights.remote_id) AS remote_ids,
+                array_agg(routes_flights.is_return) AS is_return
+            FROM subscriptions_fetches AS current
+            JOIN LATERAL (
+                SELECT id
+                FROM subscriptions_fetches
+                WHERE
+                    subscriptions_fetches.subscription_id = current.subscription_id AND
+                    subscriptions_fetches.id < current.id AND
+                    subscriptions_fetches.completed_at IS NOT NULL
+                ORDER BY subscriptions_fetches.id DESC
+                LIMIT 1
+            ) AS previous ON TRUE
+            JOIN routes ON routes.subscription_fetch_id = previous.id
+            JOIN routes_flights ON routes_flights.route_id = routes.id
+            JOIN flights ON flights.id = routes_flights.flight_id
+            WHERE current.id = ANY($1::integer[])
+            GROUP BY current.id, routes.id;
+
+        ''', subscription_fetch_ids)
     finally:
         await pool.release(conn)
 
+    assert_app(isinstance(previous_routes, list), 'Expected previous_routes to be a list, but was {0}', type(previous_routes))
 
-async def insert_route_flight(pool, inserted_route, flight):
-    assert_app(isinstance(pool, asyncpg.pool.Pool), 'Expected pool to be asyncpg.pool.Pool, but was "{0}"'.format(type(pool)))
-    assert_app(isinstance(inserted_route, asyncpg.Record), 'Expected inserted_route to be asyncpg.Record, but was "{0}"'.format(type(inserted_route)))
+    fingerprints = {subscription_fetch_id: {} for subscription_fetch_id in subscription_fetch_ids}
 
-    expect_inserted_route_int_keys = ['id']
+    for row in previous_routes:
+        fingerprint = route_fingerprint(row['price'], zip(row['remote_ids'], row['is_return']))
+        fingerprints[row['subscription_fetch_id']][fingerprint] = row['route_id']
 
-    for key in expect_inserted_route_int_keys:
-        assert_app(key in inserted_route, 'Key "{0}" not found in inserted_route'.format(key))
-        assert_app(isinstance(inserted_route[key], int), 'Expected "{0}" in inserted_route to be int, but was "{1}"'.format(inserted_route[key], type(inserted_route[key])))
+    return fingerprints
 
-    assert_app(isinstance(flight, dict), 'Expected flight to be a dict, but was "{0}"'.format(type(flight)))
 
-    expect_flight_keys = ['flight_no', 'dTimeUTC', 'return', 'flyFrom', 'flyTo', 'airline', 'id']
+def split_changed_routes(routes_by_subscription_fetch, previous_routes):
+    assert_app(isinstance(previous_routes, dict), 'Expected previous_routes to be a dict, but was "{0}"', type(previous_routes))
 
-    for key in expect_flight_keys:
-        assert_app(key in flight, 'Key {0} not found in flight'.format(key))
+    changed_routes = {}
+    carried_routes = {}
 
-    integer_keys = ['flight_no', 'dTimeUTC']
+    for subscription_fetch_id, routes in routes_by_subscription_fetch.items():
+        fingerprints = previous_routes.get(subscription_fetch_id, {})
 
-    for key in integer_keys:
-        assert_app(isinstance(flight[key], int), 'Expected {0} in flight to be int, but was {1}'.format(key, type(flight[key])))
+        for route in routes:
+            fingerprint = route_fingerprint(
+                to_smallest_currency_unit(route.price),
+                [(flight.remote_id, flight.is_return) for flight in route.flights])
 
-    string_keys = ['flyFrom', 'flyTo', 'airline', 'id']
+            # Each stored route is carried forward at most once.
+            route_id = fingerprints.pop(fingerprint, None)
 
-    for key in string_keys:
-        assert_app(isinstance(flight[key], str), 'Expected {0} in flight to be str, but was {1}'.format(key, type(flight[key])))
+            if route_id is None:
+                changed_routes.setdefault(subscription_fetch_id, []).append(route)
+            else:
+                carried_routes[route_id] = (subscription_fetch_id, route)
 
-    assert_app(flight['return'] in [0, 1], 'Expected return in flight to be 0 or 1, but was {0}'.format(flight['return']))
-    assert_app(flight['flyFrom'] != flight['flyTo'], 'Expected different values for flyFrom and flyTo, but got {0} and {1}'.format(flight['flyFrom'], flight['flyTo']))
+    return changed_routes, carried_routes
 
-    log('Inserting route {0} flight {1} {2} from {3} to {4} departure time {5} ...'.format(
-        inserted_route['id'],
-        flight['airline'],
-        flight['flight_no'],
-        flight['flyFrom'],
-        flight['flyTo'],
-        datetime.fromtimestamp(flight['dTimeUTC']).strftime(SERVER_TIME_FORMAT)))
+
+async def write_routes(pool, cache, routes_by_subscription_fetch, previous_routes):
+    assert_app(isinstance(pool, asyncpg.pool.Pool), 'Expected pool to be asyncpg.pool.Pool, but was "{0}"', type(pool))
+    assert_app(isinstance(cache, DimensionCache), 'Expected cache to be DimensionCache, but was "{0}"', type(cache))
+    assert_app(isinstance(routes_by_subscription_fetch, dict), 'Expected routes_by_subscription_fetch to be a dict, but was "{0}"', type(routes_by_subscription_fetch))
+
+    # Offers that are identical to the previous fetch of their subscription are
+    # not written again, their stored routes are moved to this fetch when it
+    # is completed instead.
+    routes_by_subscription_fetch, carried_routes = split_changed_routes(routes_by_subscription_fetch, previous_routes)
 
     try:
         conn = await pool.acquire()
 
-        flight_id_results = await select_where(conn, 'flights', ['id'], {
-            'remote_id': flight['id']
-        })
+        async with conn.transaction():
+            with metrics.phase('route_carry'):
+                uncarried_routes = await carry_routes_forward(conn, carried_routes)
+                metrics.count(len(carried_routes) - len(uncarried_routes))
 
-        assert_app(isinstance(flight_id_results, list), 'Expected flight_id_results to be a list, but was {0}'.format(type(flight_id_results)))
-        assert_app(len(flight_id_results) == 1, 'Expected only one flight_id_result, but got {0}'.format(len(flight_id_results)))
-        assert_app(isinstance(flight_id_results[0], asyncpg.Record), 'Expected element in flight_id_results to be asyncpg.Record, but was {0}'.format(type(flight_id_results[0])))
-        assert_app('id' in flight_id_results[0].keys(), 'Key "id" not found in flight_id_results element')
-        assert_app(isinstance(flight_id_results[0]['id'], int), 'Flight id is not an int, but a {0}'.format(flight_id_results[0]['id']))
+            for route_id, (subscription_fetch_id, route) in uncarried_routes.items():
+                del carried_routes[route_id]
+                routes_by_subscription_fetch.setdefault(subscription_fetch_id, []).append(route)
 
-        await insert(conn, 'routes_flights', {
-            'flight_id': flight_id_results[0]['id'],
-            'route_id': inserted_route['id'],
-            'is_return': bool(flight['return'])
-        })
-    #except: # TODO
+            flights_dict = {}
+
+            for routes in routes_by_subscription_fetch.values():
+                for route in routes:
+                    for flight in route.flights:
+                        if flight.remote_id not in flights_dict:
+                            flights_dict[flight.remote_id] = flight
+
+            with metrics.phase('flight_upsert'):
+                flight_ids = await insert_flights(conn, cache, list(flights_dict.values()))
+                metrics.count(len(flights_dict))
+
+            with metrics.phase('route_insert'):
+                route_ids = await insert_routes(conn, routes_by_subscription_fetch)
+                await insert_routes_flights(conn, routes_by_subscription_fetch, route_ids, flight_ids)
+                metrics.count(len(route_ids))
     finally:
         await pool.release(conn)
 
+    # Only publish flight ids once the transaction that inserted them is committed.
+    for remote_id, flight_id in flight_ids.items():
+        cache.add_flight(flight_id, remote_id)
+
+    # The list of ids is only built when it is going to be logged.
+    if logger.is_enabled(LOG_LEVELS['debug']):
+        logger.debug(
+            'Inserted {0} routes with {1} flights and carried {2} unchanged routes forward for subscription_fetch_ids {3}',
+            len(route_ids),
+            len(flight_ids),
+            len(carried_routes),
+            sorted(set(routes_by_subscription_fetch.keys()) | {subscription_fetch_id for subscription_fetch_id, route in carried_routes.values()}))
+
+
+async def run_bounded(semaphore, coroutine):
+    async with semaphore:
+        return await coroutine
+
+
+async def fetch_pages(http_client, api_url, query_params, pages):
+    assert_app(isinstance(query_params, dict), 'Expected query_params to be dict, but was "{0}"', type(query_params))
+    assert_app(isinstance(pages, asyncio.Queue), 'Expected pages to be asyncio.Queue, but was "{0}"', type(pages))
+
+    try:
+        next_page_available = True
+
+        while next_page_available:
+            offset = query_params['offset']
+
+            with metrics.phase('http_wait'):
+                response = await request(http_client, api_url + '/flights', query_params, check_response=check_flights_response)
+
+            routes = parse_routes(response['data'])
+            next_page_available = isinstance(response['_next'], str)
+            # Only the records are held while waiting for the consumer.
+            response = None
+
+            metrics.add('http_wait', metrics.current()[1], items=len(routes))
+
+            query_params['offset'] += ROUTES_LIMIT
+
+            # Blocks while the consumer is the configured number of pages behind.
+            await pages.put((offset, routes))
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        # Wake the consumer up, it reraises the error when awaiting this task.
+        await pages.put(None)
+        raise
+
+    await pages.put(None)
+
 
-async def insert_route(pool, route, subscription_fetch_id):
-    assert_app(isinstance(pool, asyncpg.pool.Pool), 'Expected pool to be asyncpg.pool.Pool, but was "{0}"'.format(type(pool)))
-    assert_app(isinstance(route, dict), 'Expected route to be a dict, but was "{0}"'.format(type(route)))
+def split_date_window(date_from, date_to, parts):
+    # Splits the inclusive window into at most parts consecutive windows of
+    # about the same number of days.
+    days = (date_to - date_from).days + 1
+    parts = max(1, min(parts, days))
+    windows = []
+    start = date_from
 
-    expect_route_keys = ['booking_token', 'price', 'route']
+    for part in range(1, parts + 1):
+        end = date_from + timedelta(days=days * part // parts - 1)
+        windows.append((start, end))
+        start = end + timedelta(days=1)
 
-    for key in expect_route_keys:
-        assert_app(key in route, 'Key "{0}" not found in route'.format(key))
+    return windows
 
-    assert_app(isinstance(route['booking_token'], str), 'Expected booking_token in route to be str, but was "{0}"'.format(type(route['booking_token'])))
-    assert_app(isinstance(route['price'], int), 'Expected price in route to be int, but was "{0}"'.format(type(route['price'])))
-    assert_app(isinstance(route['route'], list), 'Expected route in route to be list, but was "{0}"'.format(type(route['route'])))
 
-    assert_app(isinstance(subscription_fetch_id, int), 'Expected subscription_fetch_id to be int, but was "{0}"'.format(type(subscription_fetch_id)))
+def date_shard_count(previous_route_count, max_date_shards):
+    # The routes of the previous fetch of a query are the offers Kiwi returned
+    # for it then, so they tell how many pages to expect this time.
+    expected_pages = math.ceil(previous_route_count / ROUTES_LIMIT)
 
-    price_smallest_currency_unit = to_smallest_currency_unit(route['price'])
+    return max(1, min(max_date_shards, math.ceil(expected_pages / PAGES_PER_DATE_SHARD)))
 
-    assert_app(isinstance(price_smallest_currency_unit, int), 'Expected price_smallest_currency_unit to be int, but was "{0}"'.format(type(price_smallest_currency_unit)))
+
+def get_route_destination(route):
+    outbound_flights = [flight for flight in route.flights if not flight.is_return]
+
+    assert_peer(len(outbound_flights) > 0, 'Route {0} has no outbound flights', route.booking_token)
+
+    return outbound_flights[-1].airport_to
+
+
+def get_route_departure(route):
+    outbound_flights = [flight for flight in route.flights if not flight.is_return]
+
+    assert_peer(len(outbound_flights) > 0, 'Route {0} has no outbound flights', route.booking_token)
+
+    return date.fromtimestamp(outbound_flights[0].dtime)
+
+
+def merge_date_windows(windows, today):
+    # windows are (date_from, date_to) pairs, both inclusive. Returns the
+    # disjoint windows covering their union from today on, in order.
+    merged = []
+
+    for date_from, date_to in sorted(windows):
+        if date_to < today:
+            continue
+
+        date_from = max(date_from, today)
+
+        if len(merged) > 0 and date_from <= merged[-1][1] + timedelta(days=1):
+            merged[-1] = (merged[-1][0], max(merged[-1][1], date_to))
+        else:
+            merged.append((date_from, date_to))
+
+    return merged
+
+
+async def select_date_windows(pool, subscription_fetch_ids):
+    assert_app(isinstance(pool, asyncpg.pool.Pool), 'Expected pool to be asyncpg.pool.Pool, but was "{0}"', type(pool))
+    assert_app(isinstance(subscription_fetch_ids, list), 'Expected subscription_fetch_ids to be a list, but was "{0}"', type(subscription_fetch_ids))
+
+    today = date.today()
 
     try:
         conn = await pool.acquire()
-        inserted_route = await insert(conn, 'routes', {
-            'booking_token': route['booking_token'],
-            'price': price_smallest_currency_unit,
-            'subscription_fetch_id': subscription_fetch_id
-        })
 
-        assert_app(isinstance(inserted_route, asyncpg.Record), 'Expected inserted_route to be asyncpg.Record, but was "{0}"'.format(type(inserted_route)))
+        # Subscribers who paid for the subscription_fetch count even if
+        # charging has deactivated them for the next fetch since.
+        windows = await conn.fetch('''
+
+            SELECT
+                subscriptions_fetches.id AS subscription_fetch_id,
+                users_subscriptions.date_from,
+                users_subscriptions.date_to
+            FROM subscriptions_fetches
+            JOIN users_subscriptions ON users_subscriptions.subscription_id = subscriptions_fetches.subscription_id
+            WHERE
+                subscriptions_fetches.id = ANY($1::integer[]) AND
+                users_subscriptions.date_to >= $2 AND
+                (
+                    users_subscriptions.active = TRUE OR
+                    users_subscriptions.user_id IN (
+                        SELECT account_transfers.user_id
+                        FROM subscriptions_fetches_account_transfers
+                        JOIN account_transfers ON account_transfers.id = subscriptions_fetches_account_transfers.account_transfer_id
+                        WHERE subscriptions_fetches_account_transfers.subscription_fetch_id = subscriptions_fetches.id
+                    )
+                );
 
-    #except: # TODO
+        ''', subscription_fetch_ids, today)
     finally:
         await pool.release(conn)
 
-    insert_route_flight_tasks = [loop.create_task(insert_route_flight(pool, inserted_route, flight)) for flight in route['route']]
+    assert_app(isinstance(windows, list), 'Expected windows to be a list, but was {0}', type(windows))
 
-    if len(insert_route_flight_tasks) > 0:
-        await asyncio.wait(insert_route_flight_tasks)
+    windows_by_subscription_fetch = {}
 
+    for row in windows:
+        windows_by_subscription_fetch.setdefault(row['subscription_fetch_id'], []).append((row['date_from'], row['date_to']))
 
-async def get_subscription_data(pool, http_client, airport_end_points, subscription_fetch_id):
-    assert_app(isinstance(pool, asyncpg.pool.Pool), 'Expected pool to be asyncpg.pool.Pool, but was "{0}"'.format(type(pool)))
-    assert_app(
-        isinstance(http_client, aiohttp.client.ClientSession),
-        'Expected http_client to be aiohttp.client.ClientSession, but was "{0}"'.format(type(http_client)))
+    # Subscriptions without subscribers are fetched for the default window
+    # of a search.
+    default_window = [(today, today + relativedelta(months=+1))]
+
+    return {
+        subscription_fetch_id: merge_date_windows(windows_by_subscription_fetch.get(subscription_fetch_id, []), today) or default_window
+        for subscription_fetch_id in subscription_fetch_ids
+    }
+
+
+def coalesces(query, date_from, date_to):
+    # The pages of a query follow its routes, roughly its destinations times
+    # its days. A destination only joins a query when that asks for no more
+    # destination-days than querying it on its own.
+    span_from = min(query['date_from'], date_from)
+    span_to = max(query['date_to'], date_to)
+    together = (len(query['destinations']) + 1) * ((span_to - span_from).days + 1)
+    apart = len(query['destinations']) * ((query['date_to'] - query['date_from']).days + 1) + (date_to - date_from).days + 1
+
+    return together <= apart
+
+
+def plan_queries(subscriptions, date_windows, max_destinations):
+    assert_app(isinstance(subscriptions, list), 'Expected subscriptions to be a list, but was "{0}"', type(subscriptions))
+    assert_app(isinstance(date_windows, dict), 'Expected date_windows to be a dict, but was "{0}"', type(date_windows))
+    assert_app(isinstance(max_destinations, int) and max_destinations > 0, 'Expected max_destinations to be a positive int, but was "{0}"', max_destinations)
+
+    subscriptions_by_origin = OrderedDict()
+
+    for priority, sub in enumerate(subscriptions):
+        subscriptions_by_origin.setdefault(sub['airport_from'], []).append((priority, sub))
 
-    assert_app(isinstance(airport_end_points, dict), 'Expected airport_end_points to be dict, but was "{0}"'.format(type(airport_end_points)))
+    queries = []
 
-    for label, end_point in airport_end_points.items():
-        assert_app(
-            isinstance(end_point, str),
-            'Expected {0} to be str, but got value "{1}" of type "{2}"'.format(label, end_point, type(end_point)))
+    # Subscriptions that share an origin and whose date windows overlap
+    # enough are fetched with one multi-destination query, which spans the
+    # windows of the subscriptions it got. The routes of a query are split
+    # back to their subscription_fetch by destination and by the
+    # subscription's own date windows, so a query never lists the same
+    # destination twice.
+    for airport_from, origin_subscriptions in subscriptions_by_origin.items():
+        sub_windows = [window for _, sub in origin_subscriptions for window in date_windows[sub['subscription_fetch_id']]]
 
-    assert_app(isinstance(subscription_fetch_id, int), 'Expected subscription_fetch_id to be int, but was "{0}"'.format(type(subscription_fetch_id)))
+        if len(sub_windows) == 0:
+            continue
 
-    offset = 0
-    next_page_available = True
+        # The windows are already clipped to today by select_date_windows.
+        merged_windows = merge_date_windows(sub_windows, min(date_from for date_from, _ in sub_windows))
 
+        for date_from, date_to in merged_windows:
+            window_queries = []
+
+            for priority, sub in origin_subscriptions:
+                windows = [
+                    (window_from, window_to) for window_from, window_to in date_windows[sub['subscription_fetch_id']]
+                    if window_from <= date_to and window_to >= date_from
+                ]
+
+                if len(windows) == 0:
+                    continue
+
+                sub_from = max(date_from, min(window_from for window_from, _ in windows))
+                sub_to = min(date_to, max(window_to for _, window_to in windows))
+
+                query = next((
+                    query for query in window_queries
+                    if len(query['destinations']) < max_destinations and
+                    sub['airport_to'] not in query['destinations'] and
+                    coalesces(query, sub_from, sub_to)
+                ), None)
+
+                if query is None:
+                    query = {
+                        'airport_from': airport_from,
+                        'date_from': sub_from,
+                        'date_to': sub_to,
+                        'destinations': {},
+                        'windows': {},
+                        'priority': priority
+                    }
+                    window_queries.append(query)
+
+                query['date_from'] = min(query['date_from'], sub_from)
+                query['date_to'] = max(query['date_to'], sub_to)
+                query['destinations'][sub['airport_to']] = sub['subscription_fetch_id']
+                query['windows'][sub['subscription_fetch_id']] = windows
+
+            queries.extend(window_queries)
+
+    # Subscriptions come most important first and every query is started in
+    # the order of its most important subscription.
+    return sorted(queries, key=lambda query: query['priority'])
+
+
+async def get_subscription_data(pool, http_client, api_url, cache, db_slots, airport_from, destinations, windows, date_from, date_to, prefetch_pages, max_date_shards):
+    assert_app(isinstance(pool, asyncpg.pool.Pool), 'Expected pool to be asyncpg.pool.Pool, but was "{0}"', type(pool))
+    assert_app(isinstance(db_slots, asyncio.Semaphore), 'Expected db_slots to be asyncio.Semaphore, but was "{0}"', type(db_slots))
+    assert_app(
+        isinstance(http_client, aiohttp.client.ClientSession),
+        'Expected http_client to be aiohttp.client.ClientSession, but was "{0}"', type(http_client))
+    assert_app(isinstance(airport_from, str), 'Expected airport_from to be str, but was "{0}"', type(airport_from))
+    assert_app(isinstance(destinations, dict), 'Expected destinations to be dict, but was "{0}"', type(destinations))
+
+    for airport_to, subscription_fetch_id in destinations.items():
+        assert_app(isinstance(airport_to, str), 'Expected destination to be str, but was "{0}"', type(airport_to))
+        assert_app(isinstance(subscription_fetch_id, int), 'Expected subscription_fetch_id to be int, but was "{0}"', type(subscription_fetch_id))
+        assert_app(isinstance(windows.get(subscription_fetch_id), list), 'Expected date windows of subscription_fetch_id {0} to be a list', subscription_fetch_id)
+
+    assert_app(isinstance(date_from, date), 'Expected date_from to be date, but was "{0}"', type(date_from))
+    assert_app(isinstance(date_to, date), 'Expected date_to to be date, but was "{0}"', type(date_to))
+    assert_app(isinstance(prefetch_pages, int) and prefetch_pages > 0, 'Expected prefetch_pages to be a positive int, but was "{0}"', prefetch_pages)
+    assert_app(isinstance(max_date_shards, int) and max_date_shards > 0, 'Expected max_date_shards to be a positive int, but was "{0}"', max_date_shards)
+
+    airport_to = ','.join(sorted(destinations.keys()))
     query_params = {
-        'flyFrom': airport_end_points['airport_from'],
-        'to': airport_end_points['airport_to'],
-        'dateFrom': date.today().strftime(KIWI_API_DATE_FORMAT),
-        'dateTo': (date.today() + relativedelta(months=+1)).strftime(KIWI_API_DATE_FORMAT),
+        'flyFrom': airport_from,
+        'to': airport_to,
+        'dateFrom': date_from.strftime(KIWI_API_DATE_FORMAT),
+        'dateTo': date_to.strftime(KIWI_API_DATE_FORMAT),
         'typeFlight': 'oneway',
         'partner': 'picky',
         'v': '2',
         'xml': '0',
         'locale': 'en',
         'curr': 'USD',
-        'offset': offset,
+        'offset': 0,
         'limit': ROUTES_LIMIT,
     }
 
-    while next_page_available:
-        next_page_available = False
+    with metrics.phase('previous_routes'):
+        previous_routes = await run_bounded(db_slots, select_previous_routes(pool, list(destinations.values())))
+
+    # Long pagination chains are split by departure date into ranges that are
+    # paginated at the same time.
+    previous_route_count = sum(len(fingerprints) for fingerprints in previous_routes.values())
+    date_windows = split_date_window(date_from, date_to, date_shard_count(previous_route_count, max_date_shards))
+
+    if len(date_windows) > 1:
+        logger.debug(
+            'From {0} to {1}: splitting {2}..{3} into {4} date ranges for {5} routes in the previous fetch',
+            airport_from,
+            airport_to,
+            date_from,
+            date_to,
+            len(date_windows),
+            previous_route_count)
+
+    # Every producer stays up to prefetch_pages pages ahead of the database writes.
+    pages = asyncio.Queue(maxsize=prefetch_pages * len(date_windows))
+    producers = []
+
+    for window_from, window_to in date_windows:
+        window_params = dict(query_params)
+        window_params['dateFrom'] = window_from.strftime(KIWI_API_DATE_FORMAT)
+        window_params['dateTo'] = window_to.strftime(KIWI_API_DATE_FORMAT)
+        producers.append(metrics.create_task(fetch_pages(http_client, api_url, window_params, pages)))
+
+    running_producers = len(producers)
+    seen_booking_tokens = set()
 
-        flights_dict = {}
-        airports_set = set()
+    try:
+        while running_producers > 0:
+            page = await pages.get()
+
+            if page is None:
+                running_producers -= 1
+
+                # A failed producer is reraised below, without waiting for the others.
+                if any(producer.done() and not producer.cancelled() and producer.exception() is not None for producer in producers):
+                    break
+
+                continue
+
+            offset, routes = page
+            flights_dict = {}
+            airports_set = set()
+            routes_by_subscription_fetch = {}
+
+            for route in routes:
+                # Neighbouring date ranges can return the same offer.
+                if route.booking_token in seen_booking_tokens:
+                    continue
+
+                seen_booking_tokens.add(route.booking_token)
+                destination = get_route_destination(route)
+
+                if destination in destinations:
+                    subscription_fetch_id = destinations[destination]
+                elif len(destinations) == 1:
+                    subscription_fetch_id = next(iter(destinations.values()))
+                else:
+                    logger.debug(
+                        'From {0} to {1} (offset: {2}): skipping route {3} to unrequested destination {4}',
+                        airport_from,
+                        airport_to,
+                        offset,
+                        route.booking_token,
+                        destination)
+                    continue
+
+                # The query covers the date windows of all of its
+                # subscriptions, a route only belongs to one of them if it
+                # departs in one of its own windows.
+                departure = get_route_departure(route)
+
+                if not any(window_from <= departure <= window_to for window_from, window_to in windows[subscription_fetch_id]):
+                    continue
+
+                routes_by_subscription_fetch.setdefault(subscription_fetch_id, []).append(route)
+
+                for flight in route.flights:
+                    if flight.remote_id not in flights_dict:
+                        flights_dict[flight.remote_id] = flight
+                    airports_set.add(flight.airport_from)
+                    airports_set.add(flight.airport_to)
+
+            # The daemon downloads the airline catalog only every few hours.
+            # Airlines added since then are synced once they are flown.
+            unknown_airlines = cache.unknown_airlines({flight.airline for flight in flights_dict.values()})
+
+            if len(unknown_airlines) > 0:
+                with metrics.phase('airline_sync'):
+                    if cache.airline_sync is None:
+                        logger.info('Syncing the airline catalog for unknown airlines {0}.', sorted(unknown_airlines))
+                        cache.airline_sync = metrics.create_task(sync_airlines(pool, http_client, api_url, cache, None))
+
+                    await cache.airline_sync
+
+                    # The catalog is downloaded at most once a cycle. Airlines
+                    # it does not have are stored under their code.
+                    unknown_airlines = cache.unknown_airlines(unknown_airlines)
+
+                    if len(unknown_airlines) > 0:
+                        await run_bounded(db_slots, insert_placeholder_airlines(pool, cache, unknown_airlines))
+
+            logger.debug(
+                'From {0} to {1} (offset: {2}): data for {3} airports. Getting data...',
+                airport_from,
+                airport_to,
+                offset,
+                len(airports_set))
+
+            with metrics.phase('airport_resolution'):
+                await get_airports_if_not_exist(pool, http_client, api_url, cache, db_slots, list(airports_set))
+
+                metrics.count(len(airports_set))
+
+            logger.debug('Finished getting data for airports.')
+            logger.debug(
+                'From {0} to {1} (offset: {2}): data for {3} routes with {4} flights. Writing batch...',
+                airport_from,
+                airport_to,
+                offset,
+                len(routes),
+                len(flights_dict))
+
+            await run_bounded(db_slots, write_routes(pool, cache, routes_by_subscription_fetch, previous_routes))
+    finally:
+        for producer in producers:
+            if not producer.done():
+                producer.cancel()
 
-        response = await request(http_client, 'https://api.skypicker.com/flights', query_params)
-        query_params['offset'] += ROUTES_LIMIT
+        # The cancelled producers are waited for without letting their
+        # CancelledError replace the error that is being raised.
+        results = await asyncio.gather(*producers, return_exceptions=True)
 
-        assert_peer(
-            isinstance(response, dict),
-            'API sent invalid data response. Expected type dict but got {0}'.format(type(response)))
-        expect_response_keys = ['data', 'currency', '_next']
+    for result in results:
+        if isinstance(result, Exception) and not isinstance(result, asyncio.CancelledError):
+            raise result
 
-        for key in expect_response_keys:
-            assert_peer(key in response, 'Key {0} not found in response'.format(key))
-        assert_peer(isinstance(response['currency'], str), 'Expected currency in response to be str, but was {0}'.format(type(response['currency'])))
-        assert_peer(isinstance(response['data'], list), 'Expected data in response to be list, but was {0}'.format(type(response['data'])))
 
-        for route in response['data']:
-            assert_peer(isinstance(route, dict), 'Expected route in data to be dict, but was {0}'.format(type(route)))
-            expect_route_keys = ['route', 'booking_token', 'price']
+async def get_airports_if_not_exist(pool, http_client, api_url, cache, db_slots, iata_codes):
+    assert_app(isinstance(pool, asyncpg.pool.Pool), 'Expected pool to be asyncpg.pool.Pool, but was "{0}"', type(pool))
+    assert_app(isinstance(cache, DimensionCache), 'Expected cache to be DimensionCache, but was "{0}"', type(cache))
+    assert_app(isinstance(iata_codes, list), 'Expected iata_codes to be list, but was "{0}"', type(iata_codes))
 
-            for key in expect_route_keys:
-                assert_peer(key in route, 'Key {0} not found in route'.format(key))
+    missing = [iata_code for iata_code in iata_codes if cache.get_airport_id(iata_code) is None]
 
-            assert_peer(isinstance(route['booking_token'], str), 'Expected booking_token in route to be str, but was {0}'.format(type(route['booking_token'])))
-            assert_peer(isinstance(route['price'], int), 'Expected price in route to be int but was {0}'.format(type(route['price'])))
-            assert_peer(isinstance(route['route'], list), 'Expected route in route to be list, but was {0}'.format(type(route['route'])))
+    # Subscriptions fetched concurrently can discover the same new airport at
+    # the same time. Only the first one resolves it, the rest wait for it.
+    new = [iata_code for iata_code in missing if iata_code not in cache.pending_airports]
 
-            for flight in route['route']:
-                assert_peer(isinstance(flight, dict), 'Expected flight in route item to be dict, but was {0}'.format(type(flight)))
-                expect_flight_keys = ['flight_no', 'aTimeUTC', 'dTimeUTC', 'return', 'flyFrom', 'flyTo', 'airline', 'id']
+    if len(new) > 0:
+        resolution = metrics.create_task(resolve_airports(pool, http_client, api_url, cache, db_slots, new))
 
-                for key in expect_flight_keys:
-                    assert_peer(key in flight, 'Key {0} not found in flight'.format(key))
+        for iata_code in new:
+            cache.pending_airports[iata_code] = resolution
 
-                integer_keys = ['flight_no', 'aTimeUTC', 'dTimeUTC']
+    resolutions = {cache.pending_airports[iata_code] for iata_code in missing}
 
-                for key in integer_keys:
-                    assert_peer(isinstance(flight[key], int), 'Expected {0} in flight to be int, but was {1}'.format(key, type(flight[key])))
+    if len(resolutions) > 0:
+        await asyncio.wait(resolutions)
 
-                string_keys = ['flyFrom', 'flyTo', 'airline', 'id']
+    failed = [resolution for resolution in resolutions if not resolution.cancelled() and resolution.exception() is not None]
 
-                for key in string_keys:
-                    assert_peer(isinstance(flight[key], str), 'Expected {0} in flight to be str, but was {1}'.format(key, type(flight[key])))
+    if len(failed) > 0:
+        # The airports of a failed resolution are tried again by the next
+        # page that needs them.
+        for iata_code in missing:
+            if cache.pending_airports.get(iata_code) in failed:
+                del cache.pending_airports[iata_code]
 
-                assert_peer(flight['return'] in [0, 1], 'Expected return in flight to be 0 or 1, but was {0}'.format(flight['return']))
-                assert_peer(flight['flyFrom'] != flight['flyTo'], 'Expected different values for flyFrom and flyTo, but got {0} and {1}'.format(flight['flyFrom'], flight['flyTo']))
+        raise failed[0].exception()
 
-                if flight['id'] not in flights_dict:
-                    flights_dict[flight['id']] = flight
-                airports_set.add(flight['flyFrom'])
-                airports_set.add(flight['flyTo'])
 
-        log('From {0} to {1} (offset: {2}): data for {3} airports. Getting data...'.format(
-            airport_end_points['airport_from'],
-            airport_end_points['airport_to'],
-            offset,
-            len(airports_set)))
+async def resolve_airports(pool, http_client, api_url, cache, db_slots, iata_codes):
+    assert_app(
+        isinstance(http_client, aiohttp.client.ClientSession),
+        'Expected http_client to be aiohttp.client.ClientSession, but was "{0}"', type(http_client))
+    assert_app(isinstance(db_slots, asyncio.Semaphore), 'Expected db_slots to be asyncio.Semaphore, but was "{0}"', type(db_slots))
 
-        get_airport_if_not_exists_tasks = [loop.create_task(get_airport_if_not_exists(pool, http_client, airport_iata_code)) for airport_iata_code in airports_set]
+    names = {iata_code: airport_reference[iata_code] for iata_code in iata_codes if iata_code in airport_reference}
+    unknown = [iata_code for iata_code in iata_codes if iata_code not in names]
 
-        if len(get_airport_if_not_exists_tasks) > 0:
-            await asyncio.wait(get_airport_if_not_exists_tasks)
+    if len(unknown) > 0:
+        # Another worker or an earlier cycle may have stored them already.
+        stored = await run_bounded(db_slots, select_airports(pool, unknown))
 
-        log('Finished getting data for airports.')
-        log('From {0} to {1} (offset: {2}): data for {3} flights. Getting data...'.format(
-            airport_end_points['airport_from'],
-            airport_end_points['airport_to'],
-            offset,
-            len(flights_dict)))
+        for iata_code, airport_id in stored.items():
+            cache.add_airport(airport_id, iata_code)
 
-        get_flight_tasks = [loop.create_task(get_flight(pool, flight)) for flight in flights_dict.values()]
+        unknown = [iata_code for iata_code in unknown if iata_code not in stored]
 
-        if len(get_flight_tasks) > 0:
-            await asyncio.wait(get_flight_tasks)
+    if len(unknown) > 0:
+        # No connection is held while waiting for /locations.
+        lookup_slots = asyncio.Semaphore(AIRPORT_LOOKUP_CONCURRENCY)
+        lookups = [run_bounded(lookup_slots, lookup_airport(http_client, api_url, iata_code)) for iata_code in unknown]
 
-        log('Finished getting data for flights')
-        log('From {0} to {1} (offset: {2}): data for {3} routes. Getting data...'.format(
-            airport_end_points['airport_from'],
-            airport_end_points['airport_to'],
-            offset,
-            len(response['data'])))
+        for iata_code, name in zip(unknown, await asyncio.gather(*lookups)):
+            names[iata_code] = name
 
-        insert_route_tasks = [loop.create_task(insert_route(pool, route, subscription_fetch_id)) for route in response['data']]
+    if len(names) == 0:
+        return
 
-        if len(insert_route_tasks) > 0:
-            await asyncio.wait(insert_route_tasks)
+    airport_ids = await run_bounded(db_slots, upsert_airports(pool, names))
 
-        if isinstance(response['_next'], str):
-            next_page_available = True
+    for iata_code, airport_id in airport_ids.items():
+        cache.add_airport(airport_id, iata_code)
 
 
-async def get_airport_if_not_exists(pool, http_client, iata_code):
-    assert_app(isinstance(pool, asyncpg.pool.Pool), 'Expected pool to be asyncpg.pool.Pool, but was "{0}"'.format(type(pool)))
-    # TODO ask if transaction here is necessary
-    assert_app(
-        isinstance(http_client, aiohttp.client.ClientSession),
-        'Expected http_client to be aiohttp.client.ClientSession, but was "{0}"'.format(type(http_client)))
-    assert_app(isinstance(iata_code, str), 'Expected iata_code to be str, but was "{0}"'.format(type(iata_code)))
+async def select_airports(pool, iata_codes):
+    try:
+        conn = await pool.acquire()
+        airports = await conn.fetch('SELECT id, iata_code FROM airports WHERE iata_code = ANY($1::text[]);', iata_codes)
+    finally:
+        await pool.release(conn)
+
+    return {airport['iata_code']: airport['id'] for airport in airports}
+
+
+async def lookup_airport(http_client, api_url, iata_code):
+    response = await request(http_client, api_url + '/locations', {
+        'term': iata_code,
+        'locale': 'en-US',
+        'location_types': 'airport',
+        'limit': AIRPORT_LOCATIONS_LIMIT
+    }, check_response=check_locations_response)
+
+    return pick_location(response['locations'], iata_code)
+
+
+async def upsert_airports(pool, names):
+    assert_app(isinstance(names, dict), 'Expected names to be dict, but was "{0}"', type(names))
+
+    iata_codes = sorted(names.keys())
 
     try:
         conn = await pool.acquire()
-        airports = await select_where(conn, 'airports', ['id'], {
-            'iata_code': iata_code
-        })
 
-        assert_app(isinstance(airports, list), 'Expected array of airports from database but got {0}'.format(type(airports)))
+        # Another worker may have inserted some of the airports in the
+        # meantime, the no-op update makes RETURNING include them.
+        airports = await conn.fetch('''
+
+            INSERT INTO airports
+                (iata_code, name)
+            SELECT batch.iata_code, batch.name
+            FROM unnest($1::text[], $2::text[]) AS batch(iata_code, name)
+            ORDER BY batch.iata_code
+            ON CONFLICT (iata_code) DO UPDATE
+            SET iata_code = EXCLUDED.iata_code
+            RETURNING id, iata_code;
+
+        ''', iata_codes, [
+            iata_code if names[iata_code] is None else '{0}, {1}'.format(names[iata_code], iata_code)
+            for iata_code in iata_codes
+        ])
+    finally:
+        await pool.release(conn)
+
+    if len(airports) != len(iata_codes):
+        raise AppError('Expected {0} upserted airports, but got {1}'.format(len(iata_codes), len(airports)))
 
-        if len(airports) > 0:
-            assert_app(len(airports) == 1, 'Expected one airport, but got {0}'.format(len(airports)))
-            assert_app(isinstance(airports[0], asyncpg.Record), 'Expected airport data to be asyncpg.Record, but got {0}'.format(type(airports[0])))
-            assert_app('id' in airports[0].keys(), 'Key "id" not found in dict airports[0]')
-            assert_app(
-                isinstance(airports[0]['id'], int),
-                'Expected id of airport data to be int, but got {0}'.format(type(airports[0]['id'])))
+    return {airport['iata_code']: airport['id'] for airport in airports}
 
-            return airports[0]['id']
 
-        response = await request(http_client, 'https://api.skypicker.com/locations', {
-            'term': iata_code,
-            'locale': 'en-US',
-            'location_types': 'airport',
-            'limit': 1
-        })
+async def insert_subscriptions_fetches(conn, fetch_id, subscription_ids):
+    assert_db_connection(conn, 'insert_subscriptions_fetches called without connection to db')
+    assert_app(isinstance(fetch_id, int), 'Expected fetch_id to be int, but was "{0}"', type(fetch_id))
+    assert_app(isinstance(subscription_ids, list), 'Expected subscription_ids to be list, but was "{0}"', type(subscription_ids))
 
-        assert_peer(isinstance(response, dict), 'Expected airports response to be dict, but was {0}'.format(type(response)))
-        assert_peer('locations' in response, 'Key "locations" not found in dict airports response')
-        assert_peer(isinstance(response['locations'], list), 'Expected airports["locations"] to be list, but was {0}'.format(type(response['locations'])))
-        assert_peer(len(response['locations']) == 1, 'Expected only one location found for airport search but got {0}'.format(len(response['locations'])))
-        assert_peer(isinstance(response['locations'][0], dict), 'Expected location to be a dict, but was {0}'.format(type(response['locations'][0])))
+    subscriptions_fetches = await conn.fetch('''
 
-        location = response['locations'][0]
-        expect_location_keys = ['code', 'name']
+        INSERT INTO subscriptions_fetches
+            (subscription_id, fetch_id)
+        SELECT subscription_id, $2
+        FROM unnest($1::integer[]) AS subscription_id
+        RETURNING id, subscription_id;
 
-        for key in expect_location_keys:
-            assert_peer(key in location, 'Key {0} not found in location')
-            assert_peer(isinstance(location[key], str), 'Expected location["{0}"] to be str, but was {1}'.format(key, type(location[key])))
+    ''', subscription_ids, fetch_id)
 
-        inserted_airport = await insert(conn, 'airports', {
-            'iata_code': location['code'],
-            'name': '{0}, {1}'.format(location['name'], location['code'])
-        })
+    assert_app(isinstance(subscriptions_fetches, list), 'Expected subscriptions_fetches to be list, but was {0}', type(subscriptions_fetches))
+    if len(subscriptions_fetches) != len(subscription_ids):
+        raise AppError('Expected {0} inserted subscriptions_fetches, but got {1}'.format(len(subscription_ids), len(subscriptions_fetches)))
 
-        assert_app(isinstance(inserted_airport, asyncpg.Record), 'Expected inserted_airport to be asyncpg.Record, but was "{0}"'.format(type(inserted_airport)))
+    return {row['subscription_id']: row['id'] for row in subscriptions_fetches}
 
-        return inserted_airport
-    #except: # TODO
+
+async def complete_subscriptions_fetches(pool, subscription_fetch_ids):
+    assert_app(isinstance(pool, asyncpg.pool.Pool), 'Expected pool to be asyncpg.pool.Pool, but was "{0}"', type(pool))
+    assert_app(isinstance(subscription_fetch_ids, list), 'Expected subscription_fetch_ids to be a list, but was "{0}"', type(subscription_fetch_ids))
+
+    try:
+        conn = await pool.acquire()
+
+        # The checkpoint of a fetch, subscriptions_fetches without completed_at
+        # are fetched again when the fetch is resumed. Search switches to a
+        # subscription_fetch once it is completed, so its carried routes are
+        # moved to it in the same transaction.
+        async with conn.transaction():
+            carried = await conn.fetchval('''
+
+                WITH carried AS (
+                    UPDATE routes
+                    SET
+                        subscription_fetch_id = carried_routes.subscription_fetch_id,
+                        booking_token = carried_routes.booking_token
+                    FROM carried_routes
+                    WHERE
+                        carried_routes.subscription_fetch_id = ANY($1::integer[]) AND
+                        routes.id = carried_routes.route_id AND
+                        NOT EXISTS (
+                            SELECT 1
+                            FROM routes AS taken
+                            WHERE
+                                taken.booking_token = carried_routes.booking_token AND
+                                taken.id <> carried_routes.route_id
+                        )
+                    RETURNING routes.id
+                )
+                SELECT count(*) FROM carried;
+
+            ''', subscription_fetch_ids)
+
+            pending = await conn.fetchval('''
+
+                WITH pending AS (
+                    DELETE FROM carried_routes
+                    WHERE subscription_fetch_id = ANY($1::integer[])
+                    RETURNING route_id
+                )
+                SELECT count(*) FROM pending;
+
+            ''', subscription_fetch_ids)
+
+            await conn.execute('''
+
+                UPDATE subscriptions_fetches
+                SET completed_at = now()
+                WHERE id = ANY($1::integer[]);
+
+            ''', subscription_fetch_ids)
     finally:
         await pool.release(conn)
 
+    if carried < pending:
+        logger.warning(
+            '{0} carried routes of subscription_fetch_ids {1} were not moved, their booking_token was taken by another route.',
+            pending - carried,
+            subscription_fetch_ids)
 
-async def charge_fetch_tax(conn, subscription_fetch, fetch_tax):
-    assert_db_connection(conn, 'charge_fetch_tax called without connection to db')
-    assert_app(conn.is_in_transaction(), 'Connection not in transaction, in charge_fetch_tax')
-    assert_app(
-        isinstance(subscription_fetch, asyncpg.Record),
-        'Expected subscription_fetch to be asyncpg.Record, but was "{0}"'.format(type(subscription_fetch)))
-    assert_app(isinstance(fetch_tax, int), 'Expected fetch_tax to be int, but was "{0}"'.format(type(fetch_tax)))
 
-    expect_subscription_fetch_keys = ['id', 'subscription_id']
+async def insert_fetch_jobs(conn, subscription_fetch_ids):
+    assert_db_connection(conn, 'insert_fetch_jobs called without connection to db')
+    assert_app(conn.is_in_transaction(), 'Connection not in transaction, in insert_fetch_jobs')
+    assert_app(isinstance(subscription_fetch_ids, list), 'Expected subscription_fetch_ids to be list, but was "{0}"', type(subscription_fetch_ids))
+
+    await conn.execute('''
+
+        INSERT INTO fetch_jobs
+            (subscription_fetch_id)
+        SELECT subscription_fetch_id
+        FROM unnest($1::integer[]) AS subscription_fetch_id;
+
+    ''', subscription_fetch_ids)
+
+    logger.info('Queued {0} fetch jobs.', len(subscription_fetch_ids))
+
+
+async def claim_fetch_jobs(pool, limit, lease):
+    assert_app(isinstance(pool, asyncpg.pool.Pool), 'Expected pool to be asyncpg.pool.Pool, but was "{0}"', type(pool))
+    assert_app(isinstance(limit, int) and limit > 0, 'Expected limit to be a positive int, but was "{0}"', limit)
+    assert_app(isinstance(lease, int) and lease > 0, 'Expected lease to be a positive int, but was "{0}"', lease)
+
+    try:
+        conn = await pool.acquire()
+
+        # Jobs locked by another fetcher that is claiming at the same time are
+        # skipped. Jobs of a fetcher that died are claimed again once their
+        # lease expires, until they run out of attempts. Jobs are claimed by
+        # origin, so they can still share queries.
+        jobs = await conn.fetch('''
+
+            WITH claimed AS (
+                UPDATE fetch_jobs
+                SET
+                    leased_until = now() + $2 * interval '1 second',
+                    attempts = attempts + 1
+                WHERE id IN (
+                    SELECT fetch_jobs.id
+                    FROM fetch_jobs
+                    JOIN subscriptions_fetches ON subscriptions_fetches.id = fetch_jobs.subscription_fetch_id
+                    JOIN subscriptions ON subscriptions.id = subscriptions_fetches.subscription_id
+                    WHERE
+                        fetch_jobs.done_at IS NULL AND
+                        (fetch_jobs.leased_until IS NULL OR fetch_jobs.leased_until < now()) AND
+                        fetch_jobs.attempts < $3
+                    ORDER BY subscriptions.airport_from_id, fetch_jobs.id
+                    LIMIT $1
+                    FOR UPDATE OF fetch_jobs SKIP LOCKED
+                )
+                RETURNING id, subscription_fetch_id, attempts
+            )
+            SELECT
+                claimed.id,
+                claimed.subscription_fetch_id,
+                claimed.attempts,
+                airport_from.iata_code AS airport_from,
+                airport_to.iata_code AS airport_to
+            FROM claimed
+            JOIN subscriptions_fetches ON subscriptions_fetches.id = claimed.subscription_fetch_id
+            JOIN subscriptions ON subscriptions.id = subscriptions_fetches.subscription_id
+            JOIN airports AS airport_from ON airport_from.id = subscriptions.airport_from_id
+            JOIN airports AS airport_to ON airport_to.id = subscriptions.airport_to_id
+            ORDER BY claimed.id;
+
+        ''', limit, lease, FETCH_JOB_MAX_ATTEMPTS)
+    finally:
+        await pool.release(conn)
+
+    assert_app(isinstance(jobs, list), 'Expected jobs to be a list, but was {0}', type(jobs))
+
+    return jobs
 
-    for key in expect_subscription_fetch_keys:
-        assert_app(key in subscription_fetch.keys(), 'Key "{0}" not found in subscription_fetch'.format(key))
-        assert_app(
-            isinstance(subscription_fetch[key], int),
-            'Expected subscription_fetch[{0}] "{1}" to be int, but was "{2}"'.format(key, subscription_fetch[key], type(subscription_fetch[key])))
 
-    log('Beginning transaction. Charging fetch_tax {0} for subscription_id {1}'.format(fetch_tax, subscription_fetch['subscription_id']))
+async def renew_fetch_jobs(pool, job_ids, lease):
+    # Keeps the claimed jobs from being handed to another fetcher while they
+    # take longer than a lease.
+    while True:
+        await asyncio.sleep(lease / 3)
 
+        try:
+            conn = await pool.acquire()
+
+            await conn.execute('''
+
+                UPDATE fetch_jobs
+                SET leased_until = now() + $2 * interval '1 second'
+                WHERE id = ANY($1::integer[]) AND done_at IS NULL;
+
+            ''', job_ids, lease)
+        finally:
+            await pool.release(conn)
+
+
+async def finish_fetch_jobs(pool, job_ids):
+    assert_app(isinstance(job_ids, list), 'Expected job_ids to be a list, but was "{0}"', type(job_ids))
+
+    try:
+        conn = await pool.acquire()
+
+        await conn.execute('''
+
+            UPDATE fetch_jobs
+            SET
+                done_at = now(),
+                leased_until = NULL
+            WHERE id = ANY($1::integer[]);
+
+        ''', job_ids)
+    finally:
+        await pool.release(conn)
+
+
+async def release_fetch_jobs(pool, job_ids, untouched_job_ids):
+    assert_app(isinstance(job_ids, list), 'Expected job_ids to be a list, but was "{0}"', type(job_ids))
+    assert_app(isinstance(untouched_job_ids, list), 'Expected untouched_job_ids to be a list, but was "{0}"', type(untouched_job_ids))
+
+    try:
+        conn = await pool.acquire()
+
+        # Jobs left over at the deadline before any of their queries started
+        # do not use up an attempt. A job that ran part of its queries does,
+        # so one that keeps running out of time is given up on.
+        await conn.execute('''
+
+            UPDATE fetch_jobs
+            SET
+                leased_until = NULL,
+                attempts = attempts - CASE WHEN id = ANY($2::integer[]) THEN 1 ELSE 0 END
+            WHERE id = ANY($1::integer[]) AND done_at IS NULL;
+
+        ''', job_ids, untouched_job_ids)
+    finally:
+        await pool.release(conn)
+
+
+async def deactivate_users_subscriptions(conn, fetch_tax):
+    assert_db_connection(conn, 'deactivate_users_subscriptions called without connection to db')
+    assert_app(isinstance(fetch_tax, int), 'Expected fetch_tax to be int, but was "{0}"', type(fetch_tax))
+
+    # Runs before the fetch is planned, so subscriptions whose subscribers
+    # can no longer pay or have expired are not fetched for them.
     await conn.execute('''
 
         UPDATE users_subscriptions
@@ -617,198 +1753,1236 @@ async def charge_fetch_tax(conn, subscription_fetch, fetch_tax):
 
     ''', fetch_tax)
 
+
+async def select_subscription_demand(conn, search_window, dormant_refresh_interval):
+    assert_db_connection(conn, 'select_subscription_demand called without connection to db')
+    assert_app(isinstance(search_window, int), 'Expected search_window to be int, but was "{0}"', type(search_window))
+    assert_app(isinstance(dormant_refresh_interval, int), 'Expected dormant_refresh_interval to be int, but was "{0}"', type(dormant_refresh_interval))
+
+    subscriptions = await conn.fetch('''
+
+        SELECT
+            subscriptions.id,
+            subscriptions.airport_from_id,
+            subscriptions.airport_to_id,
+            EXISTS (
+                SELECT 1
+                FROM users_subscriptions
+                WHERE
+                    users_subscriptions.subscription_id = subscriptions.id AND
+                    users_subscriptions.active = TRUE
+            ) AS has_subscribers,
+            coalesce(subscriptions.last_searched_at > now() - $1 * interval '1 hour', FALSE) AS recently_searched,
+            coalesce(last_fetch.fetch_time > now() - $2 * interval '1 hour', FALSE) AS recently_fetched
+        FROM subscriptions
+        LEFT JOIN LATERAL (
+            SELECT fetches.fetch_time
+            FROM subscriptions_fetches
+            JOIN fetches ON fetches.id = subscriptions_fetches.fetch_id
+            WHERE subscriptions_fetches.subscription_id = subscriptions.id
+            ORDER BY subscriptions_fetches.fetch_id DESC
+            LIMIT 1
+        ) AS last_fetch ON TRUE;
+
+    ''', search_window, dormant_refresh_interval)
+
+    assert_app(isinstance(subscriptions, list), 'Expected subscriptions to be a list, but was "{0}"', type(subscriptions))
+
+    return subscriptions
+
+
+def plan_subscriptions(subscriptions, search_window, dormant_refresh_interval):
+    # Subscriptions with active subscribers pay for the fetch and those that
+    # were searched recently are served by it. All the others are dormant and
+    # only refreshed every dormant_refresh_interval hours.
+    planned = []
+    subscribed = 0
+    searched = 0
+    refreshed = 0
+
+    for sub in subscriptions:
+        if sub['has_subscribers']:
+            subscribed += 1
+        elif sub['recently_searched']:
+            searched += 1
+        elif not sub['recently_fetched']:
+            refreshed += 1
+        else:
+            continue
+
+        planned.append(sub)
+
+    logger.info(
+        'Planned {0} of {1} subscriptions: {2} with active subscribers, {3} searched in the last {4} hours, {5} dormant refreshed after {6} hours. Skipping {7} dormant subscriptions.',
+        len(planned),
+        len(subscriptions),
+        subscribed,
+        searched,
+        search_window,
+        refreshed,
+        dormant_refresh_interval,
+        len(subscriptions) - len(planned))
+
+    return planned
+
+
+async def charge_fetch_tax(conn, fetch_id, fetch_tax):
+    assert_db_connection(conn, 'charge_fetch_tax called without connection to db')
+    assert_app(conn.is_in_transaction(), 'Connection not in transaction, in charge_fetch_tax')
+    assert_app(isinstance(fetch_id, int), 'Expected fetch_id to be int, but was "{0}"', type(fetch_id))
+    assert_app(isinstance(fetch_tax, int), 'Expected fetch_tax to be int, but was "{0}"', type(fetch_tax))
+
+    logger.info('Beginning transaction. Charging fetch_tax {0} for all subscriptions of fetch_id {1}', fetch_tax, fetch_id)
+
+    # Every user pays once per subscription_fetch they have an active
+    # subscription for, in subscription_fetch order, for as long as their
+    # credits last. Account transfer ids are taken from the sequence up front
+    # so the transfers and their subscription_fetch links can be inserted
+    # from the same rows.
+    await conn.execute('''
+
+        CREATE TEMPORARY TABLE fetch_charges ON COMMIT DROP AS
+        SELECT
+            nextval(pg_get_serial_sequence('account_transfers', 'id')) AS account_transfer_id,
+            charges.user_id,
+            charges.subscription_fetch_id
+        FROM (
+            SELECT
+                users.id AS user_id,
+                users.credits,
+                subscriptions_fetches.id AS subscription_fetch_id,
+                row_number() OVER (
+                    PARTITION BY users.id
+                    ORDER BY subscriptions_fetches.id
+                ) AS charge_number
+            FROM subscriptions_fetches
+            JOIN (
+                SELECT DISTINCT user_id, subscription_id
+                FROM users_subscriptions
+                WHERE active = TRUE
+            ) AS subscribers ON subscribers.subscription_id = subscriptions_fetches.subscription_id
+            JOIN users ON users.id = subscribers.user_id
+            WHERE subscriptions_fetches.fetch_id = $1
+        ) AS charges
+        WHERE charges.charge_number * $2 <= charges.credits;
+
+    ''', fetch_id, fetch_tax)
+
+    await conn.execute('''
+
+        INSERT INTO account_transfers
+            (id, user_id, transfer_amount, transferred_at)
+        SELECT account_transfer_id, user_id, $1, now()
+        FROM fetch_charges;
+
+    ''', fetch_tax * -1)
+
+    await conn.execute('''
+
+        INSERT INTO subscriptions_fetches_account_transfers
+            (account_transfer_id, subscription_fetch_id)
+        SELECT account_transfer_id, subscription_fetch_id
+        FROM fetch_charges;
+
+    ''')
+
     users = await conn.fetch('''
 
         UPDATE users
-        SET credits = credits - $1
-        WHERE id IN (
-            SELECT user_id
-            FROM users_subscriptions
-            WHERE
-                active = TRUE AND
-                subscription_id = $2
-        )
-        RETURNING *;
+        SET credits = credits - charged.amount
+        FROM (
+            SELECT user_id, count(*) * $1 AS amount
+            FROM fetch_charges
+            GROUP BY user_id
+        ) AS charged
+        WHERE users.id = charged.user_id
+        RETURNING users.id, charged.amount;
 
-    ''', fetch_tax, subscription_fetch['subscription_id'])
+    ''', fetch_tax)
 
-    assert_app(isinstance(users, list), 'Expected users to be list, but was {0}'.format(type(users)))
+    assert_app(isinstance(users, list), 'Expected users to be list, but was {0}', type(users))
 
-    log('Charged {0} users with fetch_tax {1} for subscription_id {2}'.format(len(users), fetch_tax, subscription_fetch['subscription_id']))
+    # Users who can no longer pay are deactivated right away, as they would
+    # have been had their subscriptions been charged one at a time.
+    await conn.execute('''
 
-    for user in users:
-        assert_app(isinstance(user, asyncpg.Record), 'Expected user to be asyncpg.Record, but was {0}'.format(type(user)))
+        UPDATE users_subscriptions
+        SET active = FALSE
+        WHERE user_id IN (
+            SELECT id
+            FROM users
+            WHERE credits < $1
+        );
 
-        expect_user_keys = ['id']
+    ''', fetch_tax)
 
-        for key in expect_user_keys:
-            assert_app(key in user, 'Key "{0}" not found in user'.format(key))
+    logger.info(
+        'End of transaction. Charged {0} users {1} in total with fetch_tax {2} for fetch_id {3}',
+        len(users),
+        sum(user['amount'] for user in users),
+        fetch_tax,
+        fetch_id)
 
-        log('Saving account transfer transfer_amount={0} for user_id={1}'.format(fetch_tax * -1, user['id']))
 
-        insert_result = await conn.fetch('''
+def catalog_airlines(airlines):
+    return {
+        airline['id']: {
+            'name': '{0} {1}'.format(airline['name'], airline['id']),
+            'logo_url': 'https://images.kiwi.com/airlines/64/{0}.png'.format(airline['id'])
+        }
+        for airline in airlines
+        # check for FakeAirline:
+        if airline['id'] != '__'
+    }
+
+
+async def upsert_airlines(conn, airlines):
+    assert_db_connection(conn, 'upsert_airlines function called without connection to db.')
+    assert_app(isinstance(airlines, dict), 'Expected airlines to be a dict, but was "{0}"', type(airlines))
+
+    codes = sorted(airlines.keys())
 
-            INSERT INTO account_transfers
-                (user_id, transfer_amount, transferred_at)
-            VALUES
-                ($1, $2, now())
-            RETURNING *;
+    if len(codes) == 0:
+        return {}
 
-        ''', user['id'], fetch_tax * -1)
+    # Rows are inserted in code order, so concurrent fetchers wait for each
+    # other instead of deadlocking.
+    airline_id_results = await conn.fetch('''
 
-        assert_app(isinstance(insert_result, list), 'Expected insert_result to be a list, but was {0}'.format(type(insert_result)))
-        assert_app(len(insert_result) == 1, 'Expected insert_result to have length=1, but got length={0}'.format(len(insert_result)))
+        INSERT INTO airlines
+            (name, code, logo_url)
+        SELECT batch.name, batch.code, batch.logo_url
+        FROM unnest($1::text[], $2::text[], $3::text[]) AS batch(name, code, logo_url)
+        ORDER BY batch.code
+        ON CONFLICT (code) DO UPDATE
+        SET
+            name = EXCLUDED.name,
+            logo_url = EXCLUDED.logo_url
+        RETURNING id, code;
 
-        inserted_account_transfer = insert_result[0]
+    ''', [airlines[code]['name'] for code in codes], codes, [airlines[code]['logo_url'] for code in codes])
 
-        assert_app(isinstance(inserted_account_transfer, asyncpg.Record), 'Expected inserted_account_transfer to be asyncpg.Record, but was {0}'.format(type(inserted_account_transfer)))
+    assert_app(isinstance(airline_id_results, list), 'Expected airline_id_results to be a list, but was {0}', type(airline_id_results))
+    if len(airline_id_results) != len(codes):
+        raise AppError('Expected {0} upserted airlines, but got {1}'.format(len(codes), len(airline_id_results)))
 
-        expect_inserted_account_transfer_keys = ['id']
+    return {row['code']: row['id'] for row in airline_id_results}
 
-        for key in expect_inserted_account_transfer_keys:
-            assert_app(key in inserted_account_transfer, 'Key "{0}" not found in inserted_account_transfer')
 
-        log('Saving account transfer with id={0} as subscription-related fetch')
+async def insert_placeholder_airlines(pool, cache, codes):
+    assert_app(isinstance(pool, asyncpg.pool.Pool), 'Expected pool to be asyncpg.pool.Pool, but was "{0}"', type(pool))
+    assert_app(isinstance(cache, DimensionCache), 'Expected cache to be DimensionCache, but was "{0}"', type(cache))
+    assert_app(isinstance(codes, list), 'Expected codes to be a list, but was "{0}"', type(codes))
+
+    logger.warning('Airlines {0} are not in the airline catalog, storing them under their code.', sorted(codes))
+
+    # A later sync of a catalog that has them fills in their name and logo.
+    try:
+        conn = await pool.acquire()
 
         await conn.execute('''
 
-            INSERT INTO subscriptions_fetches_account_transfers
-                (account_transfer_id, subscription_fetch_id)
-            VALUES
-                ($1, $2);
+            INSERT INTO airlines
+                (name, code)
+            SELECT batch.code, batch.code
+            FROM unnest($1::text[]) AS batch(code)
+            ORDER BY batch.code
+            ON CONFLICT DO NOTHING;
+
+        ''', codes)
+
+        airlines = await conn.fetch('SELECT id, code FROM airlines WHERE code = ANY($1::text[]);', codes)
+    finally:
+        await pool.release(conn)
 
-        ''', inserted_account_transfer['id'], subscription_fetch['id'])
+    if len(airlines) != len(codes):
+        raise AppError('Expected {0} airlines after inserting placeholders, but got {1}'.format(len(codes), len(airlines)))
 
-    log('End of transaction. Charged fetch taxes for subscription_id {0}'.format(subscription_fetch['subscription_id']))
+    for airline in airlines:
+        cache.add_airline(airline['id'], airline['code'])
 
 
-async def insert_airline(pool, airline):
-    assert_app(isinstance(pool, asyncpg.pool.Pool), 'Expected pool to be asyncpg.pool.Pool, but was "{0}"'.format(type(pool)))
-    # TODO ask if transaction is necessary
+async def select_fetcher_state(pool, name):
     try:
         conn = await pool.acquire()
-        assert_peer(
-            isinstance(airline, dict),
-            'Expected airline to be a dict, but was "{0}"'.format(type(airline)))
+        state = await conn.fetchrow('''
 
-        expect_airline_keys = ['id', 'name']
+            SELECT value, extract(epoch FROM now() - updated_at) AS age
+            FROM fetcher_state
+            WHERE name = $1;
 
-        for key in expect_airline_keys:
-            assert_peer(key in airline, 'Key "{0}" not found in airline'.format(key))
-            assert_peer(
-                isinstance(airline[key], str),
-                'Expected airline[{0}] "{1}" to be str, but was "{2}"'.format(key, airline[key], type(airline[key])))
+        ''', name)
+    finally:
+        await pool.release(conn)
 
-        # check for FakeAirline:
-        if airline['id'] == '__':
-            return;
+    return state
 
-        iata_code_pattern = re.compile('^[A-Z0-9]+$')
 
-        assert_peer(iata_code_pattern.match(airline['id']), 'Invalid iata code "{0}"'.format(airline['id']))
+async def save_fetcher_state(conn, name, value):
+    assert_db_connection(conn, 'save_fetcher_state function called without connection to db.')
 
-        log('Inserting if not exists airline {0} ({1})...'.format(airline['name'], airline['id']))
+    await conn.execute('''
 
-        await insert_if_not_exists(conn, 'airlines', {
-            'name': '{0} {1}'.format(airline['name'], airline['id']),
-            'code': airline['id'],
-            'logo_url': 'https://images.kiwi.com/airlines/64/{0}.png'.format(airline['id'])
-        }, {
-            'code': airline['id']
-        })
-    #except: # TODO
+        INSERT INTO fetcher_state
+            (name, value, updated_at)
+        VALUES ($1, $2, now())
+        ON CONFLICT (name) DO UPDATE
+        SET
+            value = EXCLUDED.value,
+            updated_at = EXCLUDED.updated_at;
+
+    ''', name, value)
+
+
+async def sync_airlines(pool, http_client, api_url, cache, refresh_interval):
+    assert_app(isinstance(pool, asyncpg.pool.Pool), 'Expected pool to be asyncpg.pool.Pool, but was "{0}"', type(pool))
+    assert_app(isinstance(cache, DimensionCache), 'Expected cache to be DimensionCache, but was "{0}"', type(cache))
+
+    # refresh_interval is None when flown airlines are missing, then the
+    # catalog is downloaded regardless of when it was synced last.
+    state = await select_fetcher_state(pool, AIRLINE_CATALOG_STATE)
+
+    if refresh_interval is not None and state is not None and state['age'] < refresh_interval * 3600:
+        logger.info('Airline catalog was synced {0:.1f} hours ago, not downloading it.', state['age'] / 3600)
+        return False
+
+    airlines = await request(
+        http_client,
+        api_url + '/airlines',
+        check_response=check_airlines_response,
+        max_age=None if refresh_interval is not None else 0)
+    catalog_hash = hashlib.sha1(json.dumps(airlines, sort_keys=True).encode('utf-8')).hexdigest()
+
+    metrics.count(len(airlines))
+
+    try:
+        conn = await pool.acquire()
+
+        async with conn.transaction():
+            stored = await conn.fetch('SELECT id, code, name, logo_url FROM airlines;')
+
+            for airline in stored:
+                cache.add_airline(airline['id'], airline['code'])
+
+            if state is not None and state['value'] == catalog_hash:
+                logger.info('Airline catalog is unchanged.')
+                changed = {}
+            else:
+                stored_by_code = {airline['code']: airline for airline in stored}
+                changed = {
+                    code: airline for code, airline in catalog_airlines(airlines).items()
+                    if code not in stored_by_code or
+                        stored_by_code[code]['name'] != airline['name'] or
+                        stored_by_code[code]['logo_url'] != airline['logo_url']
+                }
+
+                logger.info('Airline catalog changed, writing {0} of {1} airlines.', len(changed), len(airlines))
+
+            airline_ids = await upsert_airlines(conn, changed)
+            await save_fetcher_state(conn, AIRLINE_CATALOG_STATE, catalog_hash)
     finally:
         await pool.release(conn)
 
+    for code, airline_id in airline_ids.items():
+        cache.add_airline(airline_id, code)
+
+    return True
 
-async def start():
-    fetch_tax = 500 # cents
+
+async def report_progress(fetch_tasks):
+    # Summaries instead of a line per page, and a flush of the log buffer in
+    # case nothing else has been logged for a while.
+    while True:
+        await asyncio.sleep(PROGRESS_INTERVAL)
+
+        logger.info(
+            'Progress: {0} of {1} queries done, {2} pages received, {3} routes inserted, {4} routes carried forward, {5} retries.',
+            sum(1 for task in fetch_tasks if task.done()),
+            len(fetch_tasks),
+            metrics.phases.get('http_wait', {}).get('calls', 0),
+            metrics.phases.get('route_insert', {}).get('items', 0),
+            metrics.phases.get('route_carry', {}).get('items', 0),
+            rate_controller.retries)
+        logger.flush()
+
+
+async def fetch_query(pool, subscription_slots, deadline, pending_queries, query, coroutine):
+    async with subscription_slots:
+        # Queries that would start after the deadline or once the daemon is
+        # stopping are left to the next run.
+        if out_of_time(deadline):
+            coroutine.close()
+            return False
+
+        await coroutine
+
+    completed = []
+
+    for subscription_fetch_id in query['destinations'].values():
+        pending_queries[subscription_fetch_id] -= 1
+
+        if pending_queries[subscription_fetch_id] == 0:
+            completed.append(subscription_fetch_id)
+
+    if len(completed) > 0:
+        with metrics.phase('checkpoint'):
+            await complete_subscriptions_fetches(pool, completed)
+            metrics.count(len(completed))
+
+    return True
+
+
+async def fetch_subscriptions(pool, http_client, api_url, cache, queries, concurrency, db_connections, prefetch_pages, max_date_shards, deadline):
+    assert_app(isinstance(queries, list), 'Expected queries to be a list, but was "{0}"', type(queries))
+    assert_app(isinstance(concurrency, int) and concurrency > 0, 'Expected concurrency to be a positive int, but was "{0}"', concurrency)
+    assert_app(isinstance(db_connections, int) and db_connections > 0, 'Expected db_connections to be a positive int, but was "{0}"', db_connections)
+
+    logger.info(
+        'Fetching {0} subscriptions with {1} queries, {2} at a time.',
+        sum(len(query['destinations']) for query in queries),
+        len(queries),
+        concurrency)
+
+    subscription_slots = asyncio.Semaphore(concurrency)
+    fetch_tasks = []
+    # A subscription with several date windows is complete once all of its
+    # queries are.
+    pending_queries = {}
+
+    for query in queries:
+        for subscription_fetch_id in query['destinations'].values():
+            pending_queries[subscription_fetch_id] = pending_queries.get(subscription_fetch_id, 0) + 1
+
+    for query in queries:
+        scope = '{0}->{1} {2}..{3}'.format(
+            query['airport_from'],
+            ','.join(sorted(query['destinations'])),
+            query['date_from'].isoformat(),
+            query['date_to'].isoformat())
+        metrics.add_scope(scope, query['destinations'])
+
+        fetch_tasks.append(metrics.create_task(fetch_query(pool, subscription_slots, deadline, pending_queries, query, get_subscription_data(
+            pool,
+            http_client,
+            api_url,
+            cache,
+            asyncio.Semaphore(db_connections),
+            query['airport_from'],
+            query['destinations'],
+            query['windows'],
+            query['date_from'],
+            query['date_to'],
+            prefetch_pages,
+            max_date_shards
+        )), scope))
+
+    progress = loop.create_task(report_progress(fetch_tasks))
 
     try:
-        pool = await asyncpg.create_pool(database='freefall', user='freefall', password='freefall')
+        if len(fetch_tasks) > 0:
+            await asyncio.wait(fetch_tasks)
+    finally:
+        progress.cancel()
 
-        async with aiohttp.ClientSession(conn_timeout=15) as http_client:
-            airlines = await request(http_client, 'https://api.skypicker.com/airlines')
+    # The other queries are finished and checkpointed before a failed one is
+    # reraised, its subscriptions are left for the next run.
+    failed = [task for task in fetch_tasks if task.exception() is not None]
 
-            assert_peer(
-                isinstance(airlines, list),
-                'Expected airlines to be a list, but was "{0}"'.format(type(airlines)))
+    for task in failed[1:]:
+        logger.error('Query failed: {0}', task.exception())
 
-            insert_airline_tasks = [loop.create_task(insert_airline(pool, airline)) for airline in airlines]
+    if len(failed) > 0:
+        raise failed[0].exception()
 
-            if len(insert_airline_tasks) > 0:
-                await asyncio.wait(insert_airline_tasks)
+    skipped = [query for query, task in zip(queries, fetch_tasks) if not task.result()]
+    unfinished = [subscription_fetch_id for subscription_fetch_id, pending in pending_queries.items() if pending > 0]
+    started = set(
+        subscription_fetch_id
+        for query, task in zip(queries, fetch_tasks) if task.result()
+        for subscription_fetch_id in query['destinations'].values())
+    untouched = [subscription_fetch_id for subscription_fetch_id in unfinished if subscription_fetch_id not in started]
 
-            try:
-                conn = await pool.acquire()
-                subscriptions = await select(conn, 'subscriptions', ['id', 'airport_from_id', 'airport_to_id'])
+    if len(skipped) > 0:
+        logger.warning(
+            'Out of time, left {0} of {1} queries with {2} unfinished subscriptions for the next run.',
+            len(skipped),
+            len(queries),
+            len(unfinished))
 
-                assert_app(
-                    isinstance(subscriptions, list),
-                    'Expected subscriptions to be a list, but was "{0}"'.format(type(subscriptions)))
+    return unfinished, untouched
 
-                fetch_id = await insert_data_fetch(conn)
+
+async def work_queue(pool, http_client, api_url, cache, args, deadline):
+    # Claims batches of fetch jobs until there are none left that can be
+    # claimed. A batch is about as many subscriptions as are fetched at once.
+    batch_size = args.concurrency * args.max_destinations
+    done_jobs = 0
+
+    while True:
+        if out_of_time(deadline):
+            logger.warning('Out of time, leaving the remaining fetch jobs queued.')
+            break
+
+        with metrics.phase('job_queue'):
+            jobs = await claim_fetch_jobs(pool, batch_size, args.job_lease)
+            metrics.count(len(jobs))
+
+        if len(jobs) == 0:
+            logger.info('No fetch jobs left to claim.')
+            break
+
+        job_ids = [job['id'] for job in jobs]
+        retried = [job['id'] for job in jobs if job['attempts'] > 1]
+
+        if len(retried) > 0:
+            logger.warning('Retrying fetch jobs {0}, their previous lease expired.', retried)
+
+        planned_subscriptions = [{
+            'subscription_fetch_id': job['subscription_fetch_id'],
+            'airport_from': job['airport_from'],
+            'airport_to': job['airport_to']
+        } for job in jobs]
+
+        with metrics.phase('job_queue'):
+            date_windows = await select_date_windows(pool, [sub['subscription_fetch_id'] for sub in planned_subscriptions])
+
+        queries = plan_queries(planned_subscriptions, date_windows, args.max_destinations)
+        renewal = loop.create_task(renew_fetch_jobs(pool, job_ids, args.job_lease))
+
+        try:
+            unfinished, untouched = await fetch_subscriptions(pool, http_client, api_url, cache, queries, args.concurrency, args.db_connections, args.prefetch_pages, args.max_date_shards, deadline)
+        finally:
+            renewal.cancel()
+
+        finished_job_ids = [job['id'] for job in jobs if job['subscription_fetch_id'] not in unfinished]
+        unfinished_job_ids = [job['id'] for job in jobs if job['subscription_fetch_id'] in unfinished]
+        untouched_job_ids = [job['id'] for job in jobs if job['subscription_fetch_id'] in untouched]
+
+        with metrics.phase('job_queue'):
+            await finish_fetch_jobs(pool, finished_job_ids)
+
+            if len(unfinished_job_ids) > 0:
+                await release_fetch_jobs(pool, unfinished_job_ids, untouched_job_ids)
+
+        done_jobs += len(finished_job_ids)
+
+    logger.info('Finished {0} fetch jobs.', done_jobs)
+
+
+async def open_fetch(pool, fetch_tax, enqueue, search_window, dormant_refresh_interval):
+    assert_app(isinstance(pool, asyncpg.pool.Pool), 'Expected pool to be asyncpg.pool.Pool, but was "{0}"', type(pool))
+
+    try:
+        conn = await pool.acquire()
+
+        # The plan, the subscriptions_fetches and the charges are made from
+        # the same state of users_subscriptions.
+        async with conn.transaction():
+            with metrics.phase('subscription_load'):
+                await deactivate_users_subscriptions(conn, fetch_tax)
+
+                subscriptions = await select_subscription_demand(conn, search_window, dormant_refresh_interval)
 
                 for sub in subscriptions:
                     assert_app(
                         isinstance(sub, asyncpg.Record),
-                        'Expected subscription to be asyncpg.Record, but was "{0}"'.format(type(sub)))
+                        'Expected subscription to be asyncpg.Record, but was "{0}"', type(sub))
 
                     expect_subscription_keys = ['id', 'airport_from_id', 'airport_to_id']
 
                     for key in expect_subscription_keys:
-                        assert_app(key in sub.keys(), 'Key "{0}" not found in subscription'.format(key))
+                        assert_app(key in sub.keys(), 'Key "{0}" not found in subscription', key)
                         assert_app(
                             isinstance(sub[key], int),
-                            'Expected sub[{0}] "{1}" to be int, but was "{2}"'.format(key, sub[key], type(sub[key])))
-
-                    subscription_fetch = await insert(conn, 'subscriptions_fetches', {
-                        'subscription_id': sub['id'],
-                        'fetch_id': fetch_id
-                    });
-
-                    assert_app(isinstance(subscription_fetch, asyncpg.Record), 'Expected subscription_fetch to be a asyncpg.Record, but was {0}'.format(type(subscription_fetch)))
-                    async with conn.transaction():
-                        await charge_fetch_tax(conn, subscription_fetch, fetch_tax)
-
-                    # TODO take airport_from and airport_to in paralel
-                    airport_from = await select_where(conn, 'airports', ['id', 'iata_code', 'name'], {
-                        'id': sub['airport_from_id']
-                    })
-                    airport_to = await select_where(conn, 'airports', ['id', 'iata_code', 'name'], {
-                        'id': sub['airport_to_id']
-                    })
-
-                    assert_app(isinstance(airport_from, list), 'Expected airport_from to be a list, but was {0}'.format(type(airport_from)))
-                    assert_app(len(airport_from) == 1, 'Expected the length of airport_from list to be 1, but was {0}'.format(len(airport_from)))
-                    assert_app('iata_code' in airport_from[0], 'Key "iata_code" not found in airport_from[0]')
-                    assert_app(isinstance(airport_from[0]['iata_code'], str), 'Expected airport_from[0]["iata_code"] to be str, but was {0}'.format(type(airport_from[0]['iata_code'])))
-                    assert_app(isinstance(airport_to, list), 'Expected airport_to to be a list, but was {0}'.format(type(airport_to)))
-                    assert_app(len(airport_to) == 1, 'Expected the length of airport_to list to be 1, but was {0}'.format(len(airport_to)))
-                    assert_app('iata_code' in airport_to[0], 'Key "iata_code" not found in airport_to[0]')
-                    assert_app(isinstance(airport_to[0]['iata_code'], str), 'Expected airport_to[0]["iata_code"] to be str, but was {0}'.format(type(airport_to[0]['iata_code'])))
-
-                    await get_subscription_data(
-                        pool,
-                        http_client,
-                        {
-                            'airport_from': airport_from[0]['iata_code'],
-                            'airport_to': airport_to[0]['iata_code']
-                        },
-                        subscription_fetch['id']
-                    )
+                            'Expected sub[{0}] "{1}" to be int, but was "{2}"', key, sub[key], type(sub[key]))
+
+                subscriptions = plan_subscriptions(subscriptions, search_window, dormant_refresh_interval)
+
+                fetch_id = await insert_data_fetch(conn)
+                metrics.fetch_id = fetch_id
+                metrics.count(len(subscriptions))
+
+            with metrics.phase('charging'):
+                subscription_fetch_ids = await insert_subscriptions_fetches(conn, fetch_id, [sub['id'] for sub in subscriptions])
+
+                if enqueue:
+                    await insert_fetch_jobs(conn, list(subscription_fetch_ids.values()))
+
+                await charge_fetch_tax(conn, fetch_id, fetch_tax)
+
+                metrics.count(len(subscriptions))
+    finally:
+        await pool.release(conn)
+
+    return fetch_id
+
+
+async def resume_fetch(pool):
+    assert_app(isinstance(pool, asyncpg.pool.Pool), 'Expected pool to be asyncpg.pool.Pool, but was "{0}"', type(pool))
+
+    try:
+        conn = await pool.acquire()
+
+        # Only the latest fetch is resumed, its subscribers have already been
+        # charged. Subscriptions of the job queue are resumed through their
+        # jobs instead.
+        unfinished = await conn.fetchrow('''
+
+            SELECT
+                fetches.id,
+                fetches.runs,
+                count(*) AS subscriptions
+            FROM fetches
+            JOIN subscriptions_fetches ON subscriptions_fetches.fetch_id = fetches.id
+            WHERE
+                fetches.id = (SELECT max(id) FROM fetches) AND
+                subscriptions_fetches.completed_at IS NULL AND
+                NOT EXISTS (
+                    SELECT 1
+                    FROM fetch_jobs
+                    WHERE fetch_jobs.subscription_fetch_id = subscriptions_fetches.id
+                )
+            GROUP BY fetches.id;
+
+        ''')
+
+        if unfinished is None:
+            return None
+
+        if unfinished['runs'] >= FETCH_MAX_RUNS:
+            logger.warning(
+                'Giving up on {0} unfinished subscriptions of fetch_id {1} after {2} runs.',
+                unfinished['subscriptions'],
+                unfinished['id'],
+                unfinished['runs'])
 
-            #except: # TODO
+            return None
+
+        await conn.execute('''
+
+            UPDATE fetches
+            SET runs = runs + 1
+            WHERE id = $1;
+
+        ''', unfinished['id'])
+    finally:
+        await pool.release(conn)
+
+    logger.info(
+        'Resuming fetch_id {0} with {1} unfinished subscriptions, run {2} of at most {3}.',
+        unfinished['id'],
+        unfinished['subscriptions'],
+        unfinished['runs'] + 1,
+        FETCH_MAX_RUNS)
+
+    metrics.fetch_id = unfinished['id']
+
+    return unfinished['id']
+
+
+async def select_planned_subscriptions(pool, cache, fetch_id, shard, shards):
+    assert_app(isinstance(pool, asyncpg.pool.Pool), 'Expected pool to be asyncpg.pool.Pool, but was "{0}"', type(pool))
+    assert_app(isinstance(cache, DimensionCache), 'Expected cache to be DimensionCache, but was "{0}"', type(cache))
+    assert_app(isinstance(fetch_id, int), 'Expected fetch_id to be int, but was "{0}"', type(fetch_id))
+    assert_app(0 <= shard < shards, 'Expected shard to be between 0 and {0}, but was {1}', shards - 1, shard)
+
+    try:
+        conn = await pool.acquire()
+
+        with metrics.phase('subscription_load'):
+            # Subscriptions are split between workers by id, so a subscription
+            # is fetched by the same shard in every run. Completed ones are
+            # left out when the fetch is resumed. The subscriptions with the
+            # most paying subscribers and then the stalest data come first, so
+            # they are fetched before a deadline. The airport codes are read
+            # here, the cache of a daemon does not know airports added since
+            # it started.
+            subscriptions = await conn.fetch('''
+
+                SELECT
+                    subscriptions_fetches.id AS subscription_fetch_id,
+                    subscriptions.airport_from_id,
+                    subscriptions.airport_to_id,
+                    airport_from.iata_code AS airport_from,
+                    airport_to.iata_code AS airport_to
+                FROM subscriptions_fetches
+                JOIN subscriptions ON subscriptions.id = subscriptions_fetches.subscription_id
+                JOIN airports AS airport_from ON airport_from.id = subscriptions.airport_from_id
+                JOIN airports AS airport_to ON airport_to.id = subscriptions.airport_to_id
+                WHERE
+                    subscriptions_fetches.fetch_id = $1 AND
+                    subscriptions_fetches.completed_at IS NULL AND
+                    subscriptions.id % $2 = $3
+                ORDER BY
+                    (
+                        SELECT count(*)
+                        FROM subscriptions_fetches_account_transfers
+                        WHERE subscriptions_fetches_account_transfers.subscription_fetch_id = subscriptions_fetches.id
+                    ) DESC,
+                    (
+                        SELECT max(previous.completed_at)
+                        FROM subscriptions_fetches AS previous
+                        WHERE
+                            previous.subscription_id = subscriptions_fetches.subscription_id AND
+                            previous.id < subscriptions_fetches.id
+                    ) ASC NULLS FIRST,
+                    subscriptions.id;
+
+            ''', fetch_id, shards, shard)
+
+            metrics.count(len(subscriptions))
+    finally:
+        await pool.release(conn)
+
+    assert_app(isinstance(subscriptions, list), 'Expected subscriptions to be a list, but was "{0}"', type(subscriptions))
+
+    planned_subscriptions = []
+
+    for sub in subscriptions:
+        cache.add_airport(sub['airport_from_id'], sub['airport_from'])
+        cache.add_airport(sub['airport_to_id'], sub['airport_to'])
+
+        planned_subscriptions.append({
+            'subscription_fetch_id': sub['subscription_fetch_id'],
+            'airport_from': sub['airport_from'],
+            'airport_to': sub['airport_to']
+        })
+
+    return planned_subscriptions
+
+
+def worker_command(args, fetch_id, shard, metrics_path, deadline):
+    command = [
+        sys.executable,
+        os.path.abspath(__file__),
+        '--workers', str(args.workers),
+        '--shard', str(shard),
+        '--fetch-id', str(fetch_id),
+        '--concurrency', str(args.concurrency),
+        '--db-connections', str(args.db_connections),
+        '--prefetch-pages', str(args.prefetch_pages),
+        '--max-date-shards', str(args.max_date_shards),
+        '--max-destinations', str(args.max_destinations),
+        '--api-url', args.api_url,
+        '--database', args.database,
+        '--response-cache-dir', args.response_cache_dir,
+        '--log-level', args.log_level,
+        '--metrics-json', metrics_path,
+    ]
+
+    if args.skip_internal_checks:
+        command.append('--skip-internal-checks')
+
+    if args.no_response_cache:
+        command.append('--no-response-cache')
+
+    if args.record is not None:
+        command += ['--record', args.record]
+
+    if args.replay is not None:
+        command += ['--replay'] + args.replay
+
+    if deadline is not None:
+        command += ['--deadline', str(max(1, math.ceil(deadline - time.monotonic())))]
+
+    return command
+
+
+async def lock_fetches(database):
+    # A session level advisory lock on a connection of its own, so it is
+    # released when the fetcher exits, however it exits.
+    conn = await asyncpg.connect(database=database, user='freefall', password='freefall')
+    locked = await conn.fetchval('SELECT pg_try_advisory_lock($1);', FETCH_LOCK_KEY)
+
+    if not locked:
+        await conn.close()
+
+        return None
+
+    return conn
+
+
+async def run_workers(args, fetch_id, deadline):
+    # Every worker is a separate process running this script for its shard of
+    # the subscriptions, with its own event loop, database pool and http
+    # session. Their metrics are merged into the metrics of this run.
+    metrics_dir = tempfile.mkdtemp(prefix='freefall-fetch-')
+    workers = []
+
+    try:
+        for shard in range(args.workers):
+            metrics_path = os.path.join(metrics_dir, 'worker-{0}.json'.format(shard))
+            process = await asyncio.create_subprocess_exec(*worker_command(args, fetch_id, shard, metrics_path, deadline))
+            workers.append((shard, process, metrics_path))
+
+        logger.info('Started {0} workers for fetch_id {1}.', len(workers), fetch_id)
+        logger.flush()
+
+        with metrics.phase('workers'):
+            exit_codes = await asyncio.gather(*[process.wait() for _, process, _ in workers])
+    finally:
+        for _, process, _ in workers:
+            if process.returncode is None:
+                process.kill()
+
+    try:
+        for (shard, _, metrics_path), exit_code in zip(workers, exit_codes):
+            worker_metrics = None
+
+            if os.path.exists(metrics_path):
+                with open(metrics_path) as f:
+                    worker_metrics = json.load(f)
+
+            metrics.merge_worker(shard, exit_code, worker_metrics)
+    finally:
+        shutil.rmtree(metrics_dir)
+
+    failed = [worker for worker in metrics.workers if worker['exit_code'] != 0]
+
+    # A worker's exit code is not an internal invariant, so this is checked
+    # with --skip-internal-checks too.
+    if len(failed) > 0:
+        raise AppError('Workers {0} of fetch_id {1} failed'.format(failed, fetch_id))
+
+
+async def handle_status(request):
+    status = request.app['status']
+
+    return web.json_response(status.to_json(), status=200 if status.is_healthy() else 503)
+
+
+async def start_status_server(status, port):
+    # Only listens on localhost, for supervisors and health checks on the
+    # same machine.
+    app = web.Application()
+    app['status'] = status
+    app.router.add_get('/status', handle_status)
+
+    handler = app.make_handler(access_log=None)
+    server = await loop.create_server(handler, '127.0.0.1', port)
+
+    return app, handler, server
+
+
+async def stop_status_server(app, handler, server):
+    server.close()
+    await server.wait_closed()
+    await app.shutdown()
+    await handler.shutdown(STATUS_SHUTDOWN_TIMEOUT)
+    await app.cleanup()
+
+
+async def run_cycle(pool, http_client, cache, args):
+    fetch_tax = 500 # cents
+    deadline = None if args.deadline is None else time.monotonic() + args.deadline
+
+    # Airlines and charging are taken care of once per fetch, by the
+    # coordinator when there are several workers and by the fetcher
+    # that queues the jobs in queue mode.
+    if args.queue_worker:
+        fetch_id = None
+    elif args.shard is None:
+        with metrics.phase('airline_sync'):
+            airline_sync = metrics.create_task(sync_airlines(pool, http_client, args.api_url, cache, args.airline_refresh))
+
+            # When the catalog was not due, the first page with an airline
+            # the cache does not know downloads it after all.
+            if await airline_sync:
+                cache.airline_sync = airline_sync
+
+        # A fetch left unfinished by an earlier run is completed
+        # before a new one is opened.
+        fetch_id = None
+
+        if not args.queue:
+            fetch_id = await resume_fetch(pool)
+
+        if fetch_id is None:
+            fetch_id = await open_fetch(pool, fetch_tax, args.queue, args.search_window, args.dormant_refresh)
+    else:
+        fetch_id = args.fetch_id
+        metrics.fetch_id = fetch_id
+
+    if response_recorder is not None:
+        response_recorder.start(fetch_id)
+
+    if args.queue or args.queue_worker:
+        await work_queue(pool, http_client, args.api_url, cache, args, deadline)
+
+        logger.info('Dimension cache {0}', cache.stats())
+        logger.info('Rate controller {0}', rate_controller.stats())
+
+        if response_cache is not None:
+            logger.info('Response cache {0}', response_cache.stats())
+
+        if response_replayer is not None:
+            logger.info('Replay {0}', response_replayer.stats())
+    elif args.shard is None and args.workers > 1:
+        await run_workers(args, fetch_id, deadline)
+    else:
+        if args.shard is None:
+            shard, shards = 0, 1
+        else:
+            shard, shards = args.shard, args.workers
+
+        planned_subscriptions = await select_planned_subscriptions(pool, cache, fetch_id, shard, shards)
+
+        with metrics.phase('subscription_load'):
+            date_windows = await select_date_windows(pool, [sub['subscription_fetch_id'] for sub in planned_subscriptions])
+
+        queries = plan_queries(planned_subscriptions, date_windows, args.max_destinations)
+
+        await fetch_subscriptions(pool, http_client, args.api_url, cache, queries, args.concurrency, args.db_connections, args.prefetch_pages, args.max_date_shards, deadline)
+
+        logger.info('Dimension cache {0}', cache.stats())
+        logger.info('Rate controller {0}', rate_controller.stats())
+
+        if response_cache is not None:
+            logger.info('Response cache {0}', response_cache.stats())
+
+        if response_replayer is not None:
+            logger.info('Replay {0}', response_replayer.stats())
+
+    metrics.finish()
+
+    logger.info('Phases {0}', metrics.summary())
+    logger.info('Done.')
+
+
+def out_of_time(deadline):
+    return stop_requested or (deadline is not None and time.monotonic() >= deadline)
+
+
+def request_stop(stopping):
+    global stop_requested
+
+    # Queries already running are finished and checkpointed. The handlers are
+    # removed, so a second signal stops the daemon right away.
+    logger.warning('Stopping once the running queries are done.')
+
+    stop_requested = True
+    stopping.set_result(None)
+
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.remove_signal_handler(signum)
+
+
+async def run_daemon(pool, http_client, cache, args):
+    global metrics
+
+    # The pool, the http session with its connections, the dimension cache and
+    # the learned rates are kept from one cycle to the next. Cycles start every
+    # args.interval seconds, a cycle that overruns delays the next one.
+    status = DaemonStatus(args.interval)
+    status_server = None
+    stopping = loop.create_future()
+
+    if args.status_port is not None:
+        status_server = await start_status_server(status, args.status_port)
+        logger.info('Serving the daemon status on http://127.0.0.1:{0}/status', args.status_port)
+
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, request_stop, stopping)
+
+    try:
+        while True:
+            started = time.monotonic()
+
+            # Every cycle has metrics of its own, the first one includes the
+            # start-up.
+            if status.cycles > 0:
+                metrics = Metrics()
+
+            status.start_cycle()
+            cache.start_cycle(DAEMON_MAX_CACHED_FLIGHTS)
+
+            # A failed cycle does not stop the daemon. Its fetch is left
+            # unfinished and is resumed by the next cycle.
+            try:
+                await run_cycle(pool, http_client, cache, args)
+                error = None
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                error = e.msg if isinstance(e, BaseError) else repr(e)
+
+                if not isinstance(e, BaseError):
+                    logger.error(traceback.format_exc())
+
+                logger.error('Cycle {0} failed: {1}', status.cycles, error)
+                metrics.finish()
+
+            metrics.write(args.metrics_json, args.metrics_prom, error is None)
+            status.finish_cycle(metrics, error)
+
+            if stop_requested:
+                break
+
+            next_cycle = started + args.interval
+            status.wait(next_cycle - time.monotonic())
+            logger.info('Next cycle in {0:.0f} seconds.', max(0, next_cycle - time.monotonic()))
+            logger.flush()
+
+            await asyncio.wait([stopping], timeout=max(0, next_cycle - time.monotonic()))
+
+            if stopping.done():
+                break
+    finally:
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.remove_signal_handler(signum)
+
+        if status_server is not None:
+            await stop_status_server(*status_server)
+
+    logger.info('Daemon stopped after {0} cycles.', status.cycles)
+
+
+async def start(args):
+    lock_conn = None
+    pool = None
+
+    # Only the fetcher that opens fetches takes the lock, workers and queue
+    # workers run next to it. The daemon holds it for as long as it runs.
+    if args.shard is None and not args.queue_worker:
+        lock_conn = await lock_fetches(args.database)
+
+        if lock_conn is None:
+            logger.warning('Another fetcher is still running, exiting.')
+
+            return False
+
+    # asyncpg opens 10 connections up front by default, which fails for
+    # smaller pools.
+    pool_size = args.concurrency * args.db_connections + 1
+
+    try:
+        pool = await asyncpg.create_pool(
+            database=args.database,
+            user='freefall',
+            password='freefall',
+            min_size=min(10, pool_size),
+            max_size=pool_size,
+            connection_class=InstrumentedConnection)
+        cache = DimensionCache()
+
+        with metrics.phase('cache_preload'):
+            try:
+                conn = await pool.acquire()
+                await cache.preload(conn)
             finally:
                 await pool.release(conn)
 
-            log('Done.')
+        async with aiohttp.ClientSession(conn_timeout=15) as http_client:
+            if args.daemon:
+                await run_daemon(pool, http_client, cache, args)
+            else:
+                await run_cycle(pool, http_client, cache, args)
+    finally:
+        if pool is not None:
+            await pool.close()
+
+        if lock_conn is not None:
+            await lock_conn.close()
+
+    # The daemon writes the metrics of every cycle itself.
+    return not args.daemon
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-c',
+        '--concurrency',
+        help='how many subscriptions to fetch at once.',
+        type=int,
+        default=SUBSCRIPTION_CONCURRENCY)
+    parser.add_argument(
+        '--db-connections',
+        help='how many database connections a single subscription may hold at once.',
+        type=int,
+        default=DB_CONNECTIONS_PER_SUBSCRIPTION)
+    parser.add_argument(
+        '--prefetch-pages',
+        help='how many pages of a subscription to download ahead of the database writes.',
+        type=int,
+        default=PREFETCH_PAGES)
+    parser.add_argument(
+        '--max-date-shards',
+        help='into how many date ranges to split a query with many pages in the previous fetch. The ranges are fetched at once. 1 disables splitting.',
+        type=int,
+        default=MAX_DATE_SHARDS)
+    parser.add_argument(
+        '--max-destinations',
+        help='how many subscriptions sharing an origin to fetch with one query. 1 disables coalescing.',
+        type=int,
+        default=MAX_DESTINATIONS_PER_QUERY)
+    parser.add_argument(
+        '-w',
+        '--workers',
+        help='how many processes to split the subscriptions between. Each worker uses --concurrency and its share of the API rate limits.',
+        type=int,
+        default=WORKERS)
+    parser.add_argument(
+        '--search-window',
+        help='hours for which a search keeps a subscription without subscribers in every fetch.',
+        type=int,
+        default=SEARCH_WINDOW)
+    parser.add_argument(
+        '--dormant-refresh',
+        help='hours after which subscriptions without subscribers or recent searches are fetched again. 0 fetches them every run.',
+        type=int,
+        default=DORMANT_REFRESH_INTERVAL)
+    parser.add_argument(
+        '--deadline',
+        help='seconds after which no more queries are started. Queries already running are finished, the remaining subscriptions are resumed by the next run.',
+        type=int)
+    parser.add_argument(
+        '--daemon',
+        help='keep running and start a fetch every --interval seconds, reusing the database pool, the http connections and the caches.',
+        action='store_true')
+    parser.add_argument(
+        '--interval',
+        help='seconds between the starts of two fetches of the daemon.',
+        type=int,
+        default=DAEMON_INTERVAL)
+    parser.add_argument(
+        '--airline-refresh',
+        help='hours after which the airline catalog is downloaded again, 0 downloads it on every run. Airlines that are flown before are synced right away.',
+        type=int,
+        default=AIRLINE_REFRESH_INTERVAL)
+    parser.add_argument(
+        '--status-port',
+        help='port on localhost on which the daemon serves its status as json at /status.',
+        type=int)
+    parser.add_argument(
+        '--queue',
+        help='queue a job per subscription of the new fetch and work the queue. More fetchers can help with --queue-worker.',
+        action='store_true')
+    parser.add_argument(
+        '--queue-worker',
+        help='work the queued jobs of earlier --queue runs until none are left, without starting a fetch.',
+        action='store_true')
+    parser.add_argument(
+        '--job-lease',
+        help='seconds a claimed job stays with this fetcher without being renewed, before other fetchers may claim it.',
+        type=int,
+        default=FETCH_JOB_LEASE)
+    # Set by the coordinator for the workers it starts.
+    parser.add_argument('--shard', help=argparse.SUPPRESS, type=int)
+    parser.add_argument('--fetch-id', help=argparse.SUPPRESS, type=int)
+    parser.add_argument(
+        '--api-url',
+        help='base url of the Kiwi API.',
+        default=KIWI_API_URL)
+    parser.add_argument(
+        '--database',
+        help='name of the database to write to.',
+        default=DATABASE)
+    parser.add_argument(
+        '--response-cache-dir',
+        help='directory of the cache of /airlines and /locations responses, shared by all fetchers.',
+        default=RESPONSE_CACHE_DIR)
+    parser.add_argument(
+        '--no-response-cache',
+        help='request /airlines and /locations every time they are needed.',
+        action='store_true')
+    parser.add_argument(
+        '--record',
+        help='directory to append every Kiwi API response to, as a gzip compressed NDJSON archive per fetch.')
+    parser.add_argument(
+        '--replay',
+        help='archives written with --record to take the Kiwi API responses from, instead of requesting them.',
+        nargs='+')
+    parser.add_argument(
+        '--skip-internal-checks',
+        help='do not run internal consistency asserts. Responses from the Kiwi API are still validated.',
+        action='store_true')
+    parser.add_argument(
+        '--log-level',
+        help='least severe messages to log.',
+        choices=sorted(LOG_LEVELS, key=LOG_LEVELS.get),
+        default='info')
+    parser.add_argument(
+        '--metrics-json',
+        help='file to write the timings and counts of each phase of the run to.')
+    parser.add_argument(
+        '--metrics-prom',
+        help='file to write the run metrics to in the Prometheus textfile collector format.')
+
+    args = parser.parse_args()
+
+    if args.workers < 1:
+        parser.error('--workers must be at least 1')
+
+    if args.max_date_shards < 1:
+        parser.error('--max-date-shards must be at least 1')
+
+    if (args.shard is None) != (args.fetch_id is None):
+        parser.error('--shard and --fetch-id must be given together')
+
+    if args.queue and args.queue_worker:
+        parser.error('--queue and --queue-worker are mutually exclusive')
+
+    if (args.queue or args.queue_worker) and args.workers > 1:
+        parser.error('--workers can not be combined with the job queue, start more --queue-worker fetchers instead')
+
+    if args.job_lease < 1:
+        parser.error('--job-lease must be at least 1')
+
+    if args.deadline is not None and args.deadline < 1:
+        parser.error('--deadline must be at least 1')
+
+    if args.interval < 1:
+        parser.error('--interval must be at least 1')
+
+    if args.status_port is not None and not args.daemon:
+        parser.error('--status-port requires --daemon')
+
+    if args.record is not None and args.replay is not None:
+        parser.error('--record and --replay are mutually exclusive')
+
+    if args.replay is not None and args.daemon:
+        parser.error('--replay can not be combined with --daemon, the archive is used up in the first cycle')
+
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    logger.level = LOG_LEVELS[args.log_level]
+    fetcher_common.internal_checks = not args.skip_internal_checks
+
+    if not args.no_response_cache:
+        response_cache = ResponseCache(args.response_cache_dir, RESPONSE_CACHE_TTLS, RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_MEMORY_ENTRIES)
+
+    if args.shard is not None:
+        logger.prefix = '[worker {0}/{1}] '.format(args.shard + 1, args.workers)
+        rate_controller = RateController(ENDPOINT_RATE_LIMITS, share=1 / args.workers)
+
+    if args.record is not None:
+        response_recorder = ResponseRecorder(args.record, '' if args.shard is None else '-worker-{0}'.format(args.shard + 1))
+
+    if args.replay is not None:
+        response_replayer = ResponseReplayer(args.replay)
+
+    success = False
+    write_metrics = True
+
+    try:
+        loop = asyncio.get_event_loop()
+        write_metrics = loop.run_until_complete(start(args))
+        success = True
+    except BaseError as e:
+        handle_error(e.msg)
     finally:
-        await pool.close()
+        # Also written when the run fails, so a failed run is not mistaken for the
+        # previous successful one. A run that found another fetcher running leaves
+        # the metrics to that fetcher, the daemon writes them after every cycle.
+        if write_metrics:
+            metrics.write(args.metrics_json, args.metrics_prom, success)
+        loop.close()
 
+        if response_recorder is not None:
+            response_recorder.close()
 
-try:
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(start())
-finally:
-    loop.close()
+        logger.close()
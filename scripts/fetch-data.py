@@ -1,110 +1,162 @@
 from urllib import error
 from urllib.parse import urlencode
+import argparse
+import hashlib
 import socket
 import urllib.request
 import json
 import psycopg2
-import sqlite3
-import sys
-import re
+import time
 from datetime import date, datetime
 from dateutil.relativedelta import relativedelta
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_values
+import fetcher_common
+from fetcher_common import (
+    ROUTES_LIMIT, SERVER_TIME_FORMAT, KIWI_API_DATE_FORMAT, TIMEOUT, KIWI_API_URL, DATABASE, ENDPOINT_RATE_LIMITS,
+    RESPONSE_CACHE_DIR, RESPONSE_CACHE_TTLS, RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_MEMORY_ENTRIES, LOG_LEVELS,
+    PROGRESS_INTERVAL, AIRLINE_REFRESH_INTERVAL, AIRLINE_CATALOG_STATE, FETCH_LOCK_KEY, AIRPORT_LOCATIONS_LIMIT,
+    BaseError, AppError, PeerError, assert_app, assert_peer, handle_error, logger, pick_location, RateController,
+    ResponseCache, ResponseRecorder, ResponseReplayer, record_response, check_flights_response,
+    check_locations_response, check_airlines_response, airport_reference_version, airport_reference,
+    stringify_columns,
+    to_smallest_currency_unit, parse_routes,
+)
+
+UPSERT_PAGE_SIZE = 1000 # rows per INSERT statement
+
+# Set once the airline catalog has been downloaded in this run.
+airline_catalog_synced = False
+rate_controller = RateController(ENDPOINT_RATE_LIMITS)
+
+# Set up from the command line arguments.
+response_cache = None
+response_recorder = None
+response_replayer = None
+
+
+def request(URL, params=None, max_retries=5, check_response=None, max_age=None):
+    assert_app(
+        isinstance(URL, str),
+        'Expected url to be str, but was {0}, value "{1}"'.format(type(URL), URL))
+    assert_app(
+        params is None or isinstance(params, dict),
+        'Expected params to be None or dict, but was {0}, value "{1}"'.format(type(params), params))
 
-ROUTES_LIMIT = 30
-SERVER_TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
-KIWI_API_DATE_FORMAT = '%d/%m/%Y'
-TIMEOUT = 15
+    uri = URL;
 
-class BaseError(Exception):
-    def __init__(self, msg):
-        super().__init__(msg)
-        self.msg = msg
-        handle_error(self.msg)
+    if '?' not in URL and params is not None:
+        uri += '?'
 
+    if params is not None:
+        uri += urlencode(params)
 
-class AppError(BaseError):
-    def __init__(self, msg):
-        super().__init__(msg)
+    if response_replayer is not None:
+        parsed = response_replayer.response(URL, params)
 
+        if check_response is not None:
+            check_response(parsed)
 
-class PeerError(BaseError):
-    def __init__(self, msg):
-        super().__init__(msg)
+        return parsed
 
+    # max_age overrides the TTL of the endpoint, 0 always revalidates.
+    cache_key = None
+    cached = None
 
-class UserError(BaseError):
-    def __init__(self, msg):
-        super().__init__(msg)
+    if response_cache is not None and response_cache.caches(URL):
+        cache_key = response_cache.key(URL, params)
+        cached = response_cache.get(cache_key)
 
+        if cached is not None and response_cache.is_fresh(URL, cached, max_age):
+            response_cache.hits += 1
+            record_response(response_recorder, URL, params, time.time(), time.monotonic(), None, json.dumps(cached['body']))
 
-def assert_app(condition, msg):
-    if not condition:
-        raise AppError(msg)
+            return cached['body']
 
+    headers = {} if cache_key is None else response_cache.conditional_headers(cached)
+    bucket = rate_controller.get_bucket(URL)
 
-def assert_peer(condition, msg):
-    if not condition:
-        raise PeerError(msg)
+    for attempt in range(max_retries + 1):
+        wait_time = bucket.reserve()
 
+        if wait_time > 0:
+            rate_controller.throttled_time += wait_time
+            time.sleep(wait_time)
 
-def assert_user(condition, msg):
-    if not condition:
-        raise UserError(msg)
+        logger.debug(uri)
 
+        started_at = time.time()
+        started = time.monotonic()
+        network_error = False
 
-def handle_error(error):
-    log(error)
-    sys.exit()
+        try:
+            with urllib.request.urlopen(urllib.request.Request(uri, headers=headers), timeout=TIMEOUT) as response:
+                body = response.read()
+                response_headers = response.headers
+                status = response.status
 
+            parsed = json.loads(body.decode('utf-8'))
+            bucket.on_success()
+            record_response(response_recorder, URL, params, started_at, started, status, body.decode('utf-8'))
 
-def log(msg):
-    print(msg)
+            if check_response is not None:
+                check_response(parsed)
 
+            if cache_key is not None:
+                response_cache.misses += 1
+                response_cache.put(cache_key, parsed, response_headers, cached)
 
-def request(URL, params=None, max_retries=5):
-    assert_app(
-        isinstance(URL, str),
-        'Expected url to be str, but was {0}, value "{1}"'.format(type(URL), URL))
-    assert_app(
-        params is None or isinstance(params, dict),
-        'Expected params to be None or dict, but was {0}, value "{1}"'.format(type(params), params))
+            return parsed
+        except error.HTTPError as e:
+            if e.code == 304 and cached is not None:
+                bucket.on_success()
+                response_cache.revalidated += 1
+                response_cache.put(cache_key, cached['body'], e.headers, cached)
+                record_response(response_recorder, URL, params, started_at, started, e.code, json.dumps(cached['body']))
 
-    uri = URL;
+                return cached['body']
 
-    if '?' not in URL and params is not None:
-        uri += '?'
+            if e.code != 429 and e.code < 500:
+                raise PeerError(e)
 
-    if params is not None:
-        uri += urlencode(params)
+            reason = 'status {0}'.format(e.code)
+            record_response(response_recorder, URL, params, started_at, started, e.code, None)
+        except error.URLError as e:
+            record_response(response_recorder, URL, params, started_at, started, None, None, str(e.reason))
 
-    log(uri)
+            if isinstance(e.reason, socket.timeout):
+                reason = 'timeout'
+            else:
+                # Connection resets and DNS failures are retried too, but they
+                # do not mean that the API wants fewer requests.
+                reason = str(e.reason)
+                network_error = True
+        except socket.timeout:
+            reason = 'timeout'
+            record_response(response_recorder, URL, params, started_at, started, None, None, reason)
+        except ConnectionError as e:
+            reason = '{0}: {1}'.format(type(e).__name__, e)
+            network_error = True
+            record_response(response_recorder, URL, params, started_at, started, None, None, reason)
+        except (UnicodeError, json.JSONDecodeError) as e:
+            raise PeerError(e)
 
-    try:
-        response = urllib.request.urlopen(uri, timeout=TIMEOUT).read()
-        parsed = json.loads(response.decode('utf-8'))
-    except (error.URLError, UnicodeError, json.JSONDecodeError) as e:
-        raise PeerError(e)
-    except socket.timeout as e:
-        print('Connection timed out. Error:', e)
-        print('Retrying')
-        return request(URL, params, max_retries-1)
+        if not network_error:
+            bucket.on_throttle()
 
-    return parsed
+        if attempt >= max_retries and response_cache is not None and response_cache.is_usable_stale(cached):
+            return response_cache.serve_stale(uri, cached, reason)
 
-def assert_db(conn, msg):
-    assert_app(isinstance(conn, psycopg2.extensions.connection), msg)
-    assert_app(conn.closed == 0, msg)
+        assert_peer(attempt < max_retries, 'Request to {0} failed after {1} retries ({2})'.format(uri, max_retries, reason))
 
-def stringify_columns(columns):
-    assert_app(isinstance(columns, list), 'Expected argument "columns" in stringify_columns function to be list, but was {0}'.format(type(columns)))
-    assert_app(len(columns) > 0, 'Expected list "columns" to have a length > 0, but length was {0}'.format(len(columns)))
-    assert_app(all(isinstance(col, str) for col in columns), 'All elements in arg "columns" in stringify_columns function are required to be str.')
+        retry_delay = rate_controller.retry_delay(attempt)
 
-    return ', '.join(columns)
+        logger.warning('Request to {0} failed ({1}). Retrying in {2:.2f}s', uri, reason, retry_delay)
 
-def to_smallest_currency_unit(quantity):
-    return quantity * 100
+        time.sleep(retry_delay)
+
+def assert_db(conn, msg):
+    assert_app(isinstance(conn, psycopg2.extensions.connection), msg)
+    assert_app(conn.closed == 0, msg)
 
 
 def select(conn, table, columns):
@@ -196,26 +248,108 @@ def insert_data_fetch(conn):
     return inserted_item['id']
 
 
-def insert_if_not_exists(conn, table, data, exists_check):
-    assert_db(conn, 'insert_if_not_exists function called without connection to db.')
-    assert_app(isinstance(table, str), 'Expected argument "table" in insert_if_not_exists function to be str, but was {0}'.format(type(table)))
-    assert_app(isinstance(data, dict), 'Expected argument "data" in insert_if_not_exists function to be dict, but was {0}'.format(type(data)))
-    assert_app(isinstance(exists_check, dict), 'Expected argument "exists_check" in insert_if_not_exists function to be dict, but was {0}'.format(type(exists_check)))
+def upsert(conn, table, columns, rows, key):
+    assert_db(conn, 'upsert function called without connection to db.')
+    assert_app(isinstance(table, str), 'Expected argument "table" in upsert function to be str, but was {0}'.format(type(table)))
+    assert_app(isinstance(rows, list), 'Expected argument "rows" in upsert function to be list, but was {0}'.format(type(rows)))
+    assert_app(key in columns, 'Expected key "{0}" to be one of the columns {1}'.format(key, columns))
 
-    found = select_where(conn, table, list(data.keys()), exists_check)
+    if len(rows) == 0:
+        return {}
 
-    assert_app(isinstance(found, list), 'Expected result after exist check in insert_if_not_exists function to be list, but was {0}'.format(type(found)))
+    key_index = columns.index(key)
+    keys = list({row[key_index] for row in rows})
 
-    if len(found) > 0:
-        assert_app(len(found) == 1, 'Expected length of found in insert_if_not_exists function to be 1, but was {0}'.format(len(found)))
+    c = conn.cursor()
 
-        return False
+    # Rows that are already stored, also by a concurrent fetcher, are left as
+    # they are. Rows are inserted in key order, so concurrent batches wait for
+    # each other instead of deadlocking.
+    execute_values(
+        c,
+        'INSERT INTO {0} ({1}) VALUES %s ON CONFLICT ({2}) DO NOTHING;'.format(table, stringify_columns(columns), key),
+        sorted(rows, key=lambda row: row[key_index]),
+        page_size=UPSERT_PAGE_SIZE)
+
+    c.execute('SELECT id, {0} FROM {1} WHERE {0} = ANY(%s);'.format(key, table), [keys])
+
+    result = c.fetchall()
+    c.close()
 
-    inserted = insert(conn, table, data)
+    assert_app(isinstance(result, list), 'Expected result in upsert function to be a list, but was {0}'.format(type(result)))
+    if len(result) != len(keys):
+        raise AppError('Expected {0} {1} after upsert, but got {2}'.format(len(keys), table, len(result)))
 
-    assert_app(isinstance(inserted, dict), 'Expected inserted to be an dict, but was {0}'.format(type(inserted)))
+    return {row[key]: row['id'] for row in result}
+
+
+def upsert_routes(conn, routes, subscription_fetch_id):
+    assert_db(conn, 'upsert_routes function called without connection to db.')
+    assert_app(isinstance(routes, list), 'Expected routes to be a list, but was "{0}"'.format(type(routes)))
+    assert_app(isinstance(subscription_fetch_id, int), 'Expected subscription_fetch_id to be int, but was "{0}"'.format(type(subscription_fetch_id)))
+
+    # ON CONFLICT DO UPDATE can not update the same row twice in a statement.
+    rows = sorted({
+        route.booking_token: (route.booking_token, to_smallest_currency_unit(route.price), subscription_fetch_id)
+        for route in routes
+    }.values())
+
+    if len(rows) == 0:
+        return {}
+
+    c = conn.cursor()
+
+    # A changed offer can come back with a booking_token that is already
+    # stored. Its row is taken over and its flights are rewritten.
+    execute_values(c, '''
+
+        INSERT INTO routes
+            (booking_token, price, subscription_fetch_id)
+        VALUES %s
+        ON CONFLICT (booking_token) DO UPDATE
+        SET
+            price = EXCLUDED.price,
+            subscription_fetch_id = EXCLUDED.subscription_fetch_id;
+
+    ''', rows, page_size=UPSERT_PAGE_SIZE)
+
+    c.execute('SELECT id, booking_token FROM routes WHERE booking_token = ANY(%s);', [[row[0] for row in rows]])
+
+    result = c.fetchall()
+    c.close()
+
+    if len(result) != len(rows):
+        raise AppError('Expected {0} routes after upsert, but got {1}'.format(len(rows), len(result)))
+
+    return {row['booking_token']: row['id'] for row in result}
 
-    return True
+
+def insert_routes_flights(conn, routes, route_ids, flight_ids):
+    assert_db(conn, 'insert_routes_flights function called without connection to db.')
+    assert_app(isinstance(route_ids, dict), 'Expected route_ids to be a dict, but was "{0}"'.format(type(route_ids)))
+    assert_app(isinstance(flight_ids, dict), 'Expected flight_ids to be a dict, but was "{0}"'.format(type(flight_ids)))
+
+    # A booking_token that is on a page twice keeps the flights of its last offer.
+    flights_by_route = {route_ids[route.booking_token]: route.flights for route in routes}
+    rows = [
+        (flight_ids[flight.remote_id], route_id, flight.is_return)
+        for route_id, flights in flights_by_route.items()
+        for flight in flights
+    ]
+
+    if len(rows) == 0:
+        return
+
+    c = conn.cursor()
+
+    c.execute('DELETE FROM routes_flights WHERE route_id = ANY(%s);', [list(flights_by_route.keys())])
+    execute_values(
+        c,
+        'INSERT INTO routes_flights (flight_id, route_id, is_return) VALUES %s;',
+        rows,
+        page_size=UPSERT_PAGE_SIZE)
+
+    c.close()
 
 
 def insert_if_not_exists_sub(conn, airport_from_id , airport_to_id):
@@ -245,7 +379,7 @@ def insert_if_not_exists_sub(conn, airport_from_id , airport_to_id):
     return True
 
 
-def get_subscription_data(conn, airport_end_points, subscription_fetch_id):
+def get_subscription_data(conn, api_url, airport_end_points, subscription_fetch_id):
     for label, end_point in airport_end_points.items():
         assert_app(
             isinstance(end_point, str),
@@ -255,12 +389,10 @@ def get_subscription_data(conn, airport_end_points, subscription_fetch_id):
     next_page_available = True
 
     while next_page_available:
-        next_page_available = False
-
         flights_dict = {}
         airports_set = set()
 
-        response = request('https://api.skypicker.com/flights', {
+        response = request(api_url + '/flights', {
             'flyFrom': airport_end_points['airport_from'],
             'to': airport_end_points['airport_to'],
             'dateFrom': date.today().strftime(KIWI_API_DATE_FORMAT),
@@ -273,208 +405,236 @@ def get_subscription_data(conn, airport_end_points, subscription_fetch_id):
             'curr': 'USD',
             'offset': offset,
             'limit': ROUTES_LIMIT,
-        })
+        }, check_response=check_flights_response)
 
-        assert_peer(
-            isinstance(response, dict),
-            'API sent invalid data response. Expected type dict but got {0}'.format(type(response)))
-        expect_response_keys = ['data', 'currency', '_next']
+        routes = parse_routes(response['data'])
+        next_page_available = isinstance(response['_next'], str)
+        response = None
 
-        for key in expect_response_keys:
-            assert_peer(key in response, 'Key {0} not found in response'.format(key))
-        assert_peer(isinstance(response['currency'], str), 'Expected currency in response to be str, but was {0}'.format(type(response['currency'])))
-        assert_peer(isinstance(response['data'], list), 'Expected data in response to be list, but was {0}'.format(type(response['data'])))
+        for route in routes:
+            for flight in route.flights:
+                if flight.remote_id not in flights_dict:
+                    flights_dict[flight.remote_id] = flight
+                airports_set.add(flight.airport_from)
+                airports_set.add(flight.airport_to)
 
-        for route in response['data']:
-            assert_peer(isinstance(route, dict), 'Expected route in data to be dict, but was {0}'.format(type(route)))
-            expect_route_keys = ['route', 'booking_token', 'price']
+        airline_codes = list({flight.airline for flight in flights_dict.values()})
 
-            for key in expect_route_keys:
-                assert_peer(key in route, 'Key {0} not found in route'.format(key))
+        logger.debug(
+            'From {0} to {1} (offset: {2}): data for {3} airports and {4} flights. Getting data...',
+            airport_end_points['airport_from'],
+            airport_end_points['airport_to'],
+            offset,
+            len(airports_set),
+            len(flights_dict))
+
+        # The ids are read and the transaction is ended before any request is
+        # made, so no locks are held while waiting for the API.
+        airport_ids = select_airports(conn, list(airports_set))
+        airline_ids = select_airline_ids(conn, airline_codes)
+        conn.commit()
+
+        airport_rows = lookup_airports(api_url, [iata_code for iata_code in airports_set if iata_code not in airport_ids])
+
+        # The airline catalog is downloaded only every few hours. Airlines
+        # added since then are synced once they are flown, at most once a
+        # run. Airlines the catalog does not have are stored under their code.
+        if len(airline_ids) < len(airline_codes) and not airline_catalog_synced:
+            logger.info('Syncing the airline catalog for unknown airlines {0}.', sorted(set(airline_codes) - set(airline_ids)))
+            sync_airlines(conn, api_url, None)
+            airline_ids = select_airline_ids(conn, airline_codes)
+
+        if len(airline_ids) < len(airline_codes):
+            airline_ids.update(insert_placeholder_airlines(conn, [code for code in airline_codes if code not in airline_ids]))
+
+        airport_ids.update(upsert(conn, 'airports', ['iata_code', 'name'], airport_rows, 'iata_code'))
+
+        logger.debug('Finished getting data for airports and airlines.')
+
+        for flight in flights_dict.values():
+            assert_app(flight.airline in airline_ids, 'Airline {0} of flight {1} not found in database.'.format(flight.airline, flight.remote_id))
+
+        flight_ids = upsert(conn, 'flights', [
+            'airline_id',
+            'airport_from_id',
+            'airport_to_id',
+            'dtime',
+            'atime',
+            'flight_number',
+            'remote_id',
+        ], [
+            (
+                airline_ids[flight.airline],
+                airport_ids[flight.airport_from],
+                airport_ids[flight.airport_to],
+                datetime.fromtimestamp(flight.dtime).strftime(SERVER_TIME_FORMAT),
+                datetime.fromtimestamp(flight.atime).strftime(SERVER_TIME_FORMAT),
+                flight.flight_no,
+                flight.remote_id,
+            ) for flight in flights_dict.values()
+        ], 'remote_id')
+
+        logger.debug('Finished getting data for flights')
+        logger.debug(
+            'From {0} to {1} (offset: {2}): data for {3} routes. Getting data...',
+            airport_end_points['airport_from'],
+            airport_end_points['airport_to'],
+            offset,
+            len(routes))
 
-            assert_peer(isinstance(route['booking_token'], str), 'Expected booking_token in route to be str, but was {0}'.format(type(route['booking_token'])))
-            assert_peer(isinstance(route['price'], int), 'Expected price in route to be int but was {0}'.format(type(route['price'])))
-            assert_peer(isinstance(route['route'], list), 'Expected route in route to be list, but was {0}'.format(type(route['route'])))
+        route_ids = upsert_routes(conn, routes, subscription_fetch_id)
+        insert_routes_flights(conn, routes, route_ids, flight_ids)
 
-            for flight in route['route']:
-                assert_peer(isinstance(flight, dict), 'Expected flight in route item to be dict, but was {0}'.format(type(flight)))
-                expect_flight_keys = ['flight_no', 'aTimeUTC', 'dTimeUTC', 'return', 'flyFrom', 'flyTo', 'airline', 'id']
+        # One transaction per page, a page is either stored whole or not at all.
+        conn.commit()
 
-                for key in expect_flight_keys:
-                    assert_peer(key in flight, 'Key {0} not found in flight'.format(key))
+        if next_page_available:
+            offset += ROUTES_LIMIT
 
-                integer_keys = ['flight_no', 'aTimeUTC', 'dTimeUTC']
 
-                for key in integer_keys:
-                    assert_peer(isinstance(flight[key], int), 'Expected {0} in flight to be int, but was {1}'.format(key, type(flight[key])))
+def select_airline_ids(conn, codes):
+    assert_db(conn, 'select_airline_ids function called without connection to db.')
 
-                string_keys = ['flyFrom', 'flyTo', 'airline', 'id']
+    if len(codes) == 0:
+        return {}
 
-                for key in string_keys:
-                    assert_peer(isinstance(flight[key], str), 'Expected {0} in flight to be str, but was {1}'.format(key, type(flight[key])))
+    c = conn.cursor()
+    c.execute('SELECT id, code FROM airlines WHERE code = ANY(%s);', [codes])
+    airline_ids = {airline['code']: airline['id'] for airline in c.fetchall()}
+    c.close()
 
-                assert_peer(flight['return'] in [0, 1], 'Expected return in flight to be 0 or 1, but was {0}'.format(flight['return']))
-                assert_peer(flight['flyFrom'] != flight['flyTo'], 'Expected different values for flyFrom and flyTo, but got {0} and {1}'.format(flight['flyFrom'], flight['flyTo']))
+    return airline_ids
 
-                if flight['id'] not in flights_dict:
-                    flights_dict[flight['id']] = flight
-                airports_set.add(flight['flyFrom'])
-                airports_set.add(flight['flyTo'])
 
-        log('From {0} to {1} (offset: {2}): data for {3} airports. Getting data...'.format(
-            airport_end_points['airport_from'],
-            airport_end_points['airport_to'],
-            offset,
-            len(airports_set)))
+def insert_placeholder_airlines(conn, codes):
+    assert_db(conn, 'insert_placeholder_airlines function called without connection to db.')
+    assert_app(isinstance(codes, list), 'Expected codes to be a list, but was "{0}"'.format(type(codes)))
 
-        for airport_iata_code in airports_set:
-            get_airport_if_not_exists(conn, airport_iata_code)
+    logger.warning('Airlines {0} are not in the airline catalog, storing them under their code.', sorted(codes))
 
-        log('Finished getting data for airports.')
-        log('From {0} to {1} (offset: {2}): data for {3} flights. Getting data...'.format(
-            airport_end_points['airport_from'],
-            airport_end_points['airport_to'],
-            offset,
-            len(flights_dict)))
-
-        for flight_id, flight in flights_dict.items():
-            airport_codes = [
-                flight['flyFrom'],
-                flight['flyTo']
-            ]
-
-            airport_ids = []
-
-            for iata_code in airport_codes:
-                select_result = select_where(conn, 'airports', ['id'], {
-                    'iata_code': iata_code
-                })
-
-                assert_app(isinstance(select_result, list), 'Expected airports select result to be a list, but was {0}'.format(type(select_result)))
-                assert_app(len(select_result) == 1, 'Expected only one airports select result, but got {0}'.format(len(select_result)))
-                assert_app(isinstance(select_result[0], psycopg2.extras.RealDictRow), 'Expected element in airport select result to be psycopg2.extras.RealDictRow, but was {0}'.format(select_result[0]))
-                assert_app('id' in select_result[0].keys(), 'Key "id" not found in airport select result.')
-                assert_app(isinstance(select_result[0]['id'], int), 'Expected id in airport select result element to be int, but was {0}'.format(select_result[0]['id']))
-
-                airport_ids.append(select_result[0]['id'])
-
-            airline_id_result = select_where(conn, 'airlines', ['id'], {
-                'code': flight['airline']
-            })
-
-            assert_app(isinstance(airline_id_result, list), 'Expected airline select result to be a list, but was {0}'.format(type(airline_id_result)))
-            assert_app(len(airline_id_result) == 1, 'Expected only one airline select result, but got {0}'.format(len(airline_id_result)))
-            assert_app(isinstance(airline_id_result[0], psycopg2.extras.RealDictRow), 'Expected element in airline select result to be psycopg2.extras.RealDictRow, but was {0}'.format(airline_id_result[0]))
-            assert_app('id' in airline_id_result[0].keys(), 'Key "id" not found in airline id result.')
-            assert_app(isinstance(airline_id_result[0]['id'], int), 'Expected id in airline select result element to be int, but was {0}'.format(airline_id_result[0]['id']))
-
-            log('Inserting if not exists flight {0} {1} from {2} to {3} departure time {4} ...'.format(
-                flight['airline'],
-                flight['flight_no'],
-                flight['flyFrom'],
-                flight['flyTo'],
-                datetime.fromtimestamp(flight['dTimeUTC']).strftime(SERVER_TIME_FORMAT)))
-
-            insert_if_not_exists(conn, 'flights', {
-                'airline_id': airline_id_result[0]['id'],
-                'airport_from_id': airport_ids[0],
-                'airport_to_id': airport_ids[1],
-                'dtime': datetime.fromtimestamp(flight['dTimeUTC']).strftime(SERVER_TIME_FORMAT),
-                'atime': datetime.fromtimestamp(flight['aTimeUTC']).strftime(SERVER_TIME_FORMAT),
-                'flight_number': flight['flight_no'],
-                'remote_id': flight['id']
-            }, {
-                'remote_id': flight['id']
-            })
-
-        log('Finished getting data for flights')
-        log('From {0} to {1} (offset: {2}): data for {3} routes. Getting data...'.format(
-            airport_end_points['airport_from'],
-            airport_end_points['airport_to'],
-            offset,
-            len(response['data'])))
-
-        for route in response['data']:
-            inserted_route = insert(conn, 'routes', {
-                'booking_token': route['booking_token'],
-                'price': to_smallest_currency_unit(route['price']),
-                'subscription_fetch_id': subscription_fetch_id
-            })
-
-            for flight in route['route']:
-                log('Inserting route {0} flight {1} {2} from {3} to {4} departure time {5} ...'.format(
-                    inserted_route['id'],
-                    flight['airline'],
-                    flight['flight_no'],
-                    flight['flyFrom'],
-                    flight['flyTo'],
-                    datetime.fromtimestamp(flight['dTimeUTC']).strftime(SERVER_TIME_FORMAT)))
-
-                flight_id_results = select_where(conn, 'flights', ['id'], {
-                    'remote_id': flight['id']
-                })
-
-                assert_app(isinstance(flight_id_results, list), 'Expected flight_id_results to be a list, but was {0}'.format(type(flight_id_results)))
-                assert_app(len(flight_id_results) == 1, 'Expected only one flight_id_result, but got {0}'.format(len(flight_id_results)))
-                assert_app(isinstance(flight_id_results[0], psycopg2.extras.RealDictRow), 'Expected element in flight_id_results to be psycopg2.extras.RealDictRow, but was {0}'.format(type(flight_id_results[0])))
-                assert_app('id' in flight_id_results[0].keys(), 'Key "id" not found in flight_id_results element')
-                assert_app(isinstance(flight_id_results[0]['id'], int), 'Flight id is not an int, but a {0}'.format(flight_id_results[0]['id']))
-
-                insert(conn, 'routes_flights', {
-                    'flight_id': flight_id_results[0]['id'],
-                    'route_id': inserted_route['id'],
-                    'is_return': bool(flight['return'])
-                })
-
-        if isinstance(response['_next'], str):
-            next_page_available = True
-            offset += ROUTES_LIMIT
+    # A later sync of a catalog that has them fills in their name and logo.
+    return upsert(conn, 'airlines', ['name', 'code'], [(code, code) for code in codes], 'code')
 
 
-def get_airport_if_not_exists(conn, iata_code):
-    airports = select_where(conn, 'airports', ['id'], {
-        'iata_code': iata_code
-    })
+def sync_airlines(conn, api_url, refresh_interval):
+    global airline_catalog_synced
 
-    assert_app(isinstance(airports, list), 'Expected array of airports from database but got {0}'.format(type(airports)))
+    assert_db(conn, 'sync_airlines function called without connection to db.')
 
-    if len(airports) > 0:
-        assert_app(len(airports) == 1, 'Expected one airport, but got {0}'.format(len(airports)))
-        assert_app(isinstance(airports[0], psycopg2.extras.RealDictRow), 'Expected airport data to be psycopg2.extras.RealDictRow, but got {0}'.format(type(airports[0])))
-        assert_app('id' in airports[0].keys(), 'Key "id" not found in dict airports[0]')
-        assert_app(
-            isinstance(airports[0]['id'], int),
-            'Expected id of airport data to be int, but got {0}'.format(type(airports[0]['id'])))
+    c = conn.cursor()
+    c.execute('''
 
-        return airports[0]['id']
+        SELECT value, extract(epoch FROM now() - updated_at) AS age
+        FROM fetcher_state
+        WHERE name = %s;
 
-    response = request('https://api.skypicker.com/locations', {
-        'term': iata_code,
-        'locale': 'en-US',
-        'location_types': 'airport',
-        'limit': 1
-    })
+    ''', [AIRLINE_CATALOG_STATE])
 
-    assert_peer(isinstance(response, dict), 'Expected airports response to be dict, but was {0}'.format(type(response)))
-    assert_peer('locations' in response, 'Key "locations" not found in dict airports response')
-    assert_peer(isinstance(response['locations'], list), 'Expected airports["locations"] to be list, but was {0}'.format(type(response['locations'])))
-    assert_peer(len(response['locations']) == 1, 'Expected only one location found for airport search but got {0}'.format(len(response['locations'])))
-    assert_peer(isinstance(response['locations'][0], dict), 'Expected location to be a dict, but was {0}'.format(type(response['locations'][0])))
+    state = c.fetchone()
+    c.close()
 
-    location = response['locations'][0]
+    # The read is ended before the download, so no locks are held while
+    # waiting for the API. The writes below are committed by the caller.
+    conn.commit()
 
-    expect_location_keys = ['code', 'name']
+    # refresh_interval is None when flown airlines are missing, then the
+    # catalog is downloaded regardless of when it was synced last.
+    if refresh_interval is not None and state is not None and state['age'] < refresh_interval * 3600:
+        logger.info('Airline catalog was synced {0:.1f} hours ago, not downloading it.', state['age'] / 3600)
+        return
+
+    airlines = request(
+        api_url + '/airlines',
+        check_response=check_airlines_response,
+        max_age=None if refresh_interval is not None else 0)
+    catalog_hash = hashlib.sha1(json.dumps(airlines, sort_keys=True).encode('utf-8')).hexdigest()
+    airline_catalog_synced = True
+    c = conn.cursor()
 
-    for key in expect_location_keys:
-        assert_peer(key in location, 'Key {0} not found in location')
-        assert_peer(isinstance(location[key], str), 'Expected location["{0}"] to be str, but was {1}'.format(key, type(location[key])))
+    if state is not None and state['value'] == catalog_hash:
+        logger.info('Airline catalog is unchanged.')
+    else:
+        c.execute('SELECT code, name, logo_url FROM airlines;')
+
+        stored = {airline['code']: airline for airline in c.fetchall()}
+        rows = []
+
+        for airline in airlines:
+            # check for FakeAirline:
+            if airline['id'] == '__':
+                continue
+
+            name = '{0} {1}'.format(airline['name'], airline['id'])
+            logo_url = 'https://images.kiwi.com/airlines/64/{0}.png'.format(airline['id'])
+
+            if airline['id'] not in stored or stored[airline['id']]['name'] != name or stored[airline['id']]['logo_url'] != logo_url:
+                rows.append((name, airline['id'], logo_url))
+
+        logger.info('Airline catalog changed, writing {0} of {1} airlines.', len(rows), len(airlines))
+
+        execute_values(c, '''
+
+            INSERT INTO airlines
+                (name, code, logo_url)
+            VALUES %s
+            ON CONFLICT (code) DO UPDATE
+            SET
+                name = EXCLUDED.name,
+                logo_url = EXCLUDED.logo_url;
+
+        ''', sorted(rows, key=lambda row: row[1]), page_size=UPSERT_PAGE_SIZE)
+
+    c.execute('''
+
+        INSERT INTO fetcher_state
+            (name, value, updated_at)
+        VALUES (%s, %s, now())
+        ON CONFLICT (name) DO UPDATE
+        SET
+            value = EXCLUDED.value,
+            updated_at = EXCLUDED.updated_at;
+
+    ''', [AIRLINE_CATALOG_STATE, catalog_hash])
+
+    c.close()
 
-    inserted_airport = insert(conn, 'airports', {
-        'iata_code': location['code'],
-        'name': '{0}, {1}'.format(location['name'], location['code'])
-    })
 
-    return inserted_airport
+def select_airports(conn, iata_codes):
+    assert_db(conn, 'select_airports function called without connection to db.')
+    assert_app(isinstance(iata_codes, list), 'Expected iata_codes to be a list, but got {0}'.format(type(iata_codes)))
+
+    if len(iata_codes) == 0:
+        return {}
+
+    c = conn.cursor()
+    c.execute('SELECT id, iata_code FROM airports WHERE iata_code = ANY(%s);', [iata_codes])
+    airport_ids = {airport['iata_code']: airport['id'] for airport in c.fetchall()}
+    c.close()
+
+    return airport_ids
+
+
+def lookup_airports(api_url, iata_codes):
+    assert_app(isinstance(iata_codes, list), 'Expected iata_codes to be a list, but got {0}'.format(type(iata_codes)))
+
+    rows = []
+
+    for iata_code in iata_codes:
+        if iata_code in airport_reference:
+            name = airport_reference[iata_code]
+        else:
+            response = request(api_url + '/locations', {
+                'term': iata_code,
+                'locale': 'en-US',
+                'location_types': 'airport',
+                'limit': AIRPORT_LOCATIONS_LIMIT
+            }, check_response=check_locations_response)
+
+            name = pick_location(response['locations'], iata_code)
+
+        rows.append((iata_code, iata_code if name is None else '{0}, {1}'.format(name, iata_code)))
+
+    return rows
 
 
 def charge_fetch_tax(conn, subscription_fetch, fetch_tax):
@@ -493,7 +653,7 @@ def charge_fetch_tax(conn, subscription_fetch, fetch_tax):
 
     c = conn.cursor()
 
-    log('Beginning transaction. Charging fetch_tax {0} for subscription_id {1}'.format(fetch_tax, subscription_fetch['subscription_id']))
+    logger.debug('Beginning transaction. Charging fetch_tax {0} for subscription_id {1}', fetch_tax, subscription_fetch['subscription_id'])
 
     c.execute('''
 
@@ -530,7 +690,7 @@ def charge_fetch_tax(conn, subscription_fetch, fetch_tax):
 
     assert_app(isinstance(users, list), 'Expected users to be list, but was {0}'.format(type(users)))
 
-    log('Charged {0} users with fetch_tax {1} for subscription_id {2}'.format(len(users), fetch_tax, subscription_fetch['subscription_id']))
+    logger.debug('Charged {0} users with fetch_tax {1} for subscription_id {2}', len(users), fetch_tax, subscription_fetch['subscription_id'])
 
     for user in users:
         assert_app(isinstance(user, psycopg2.extras.RealDictRow), 'Expected user to be psycopg2.extras.RealDictRow, but was {0}'.format(type(user)))
@@ -540,7 +700,7 @@ def charge_fetch_tax(conn, subscription_fetch, fetch_tax):
         for key in expect_user_keys:
             assert_app(key in user, 'Key "{0}" not found in user'.format(key))
 
-        log('Saving account transfer transfer_amount={0} for user_id={1}'.format(fetch_tax * -1, user['id']))
+        logger.debug('Saving account transfer transfer_amount={0} for user_id={1}', fetch_tax * -1, user['id'])
 
         c.execute('''
 
@@ -566,7 +726,7 @@ def charge_fetch_tax(conn, subscription_fetch, fetch_tax):
         for key in expect_inserted_account_transfer_keys:
             assert_app(key in inserted_account_transfer, 'Key "{0}" not found in inserted_account_transfer')
 
-        log('Saving account transfer with id={0} as subscription-related fetch')
+        logger.debug('Saving account transfer with id={0} as subscription-related fetch', inserted_account_transfer['id'])
 
         c.execute('''
 
@@ -579,53 +739,58 @@ def charge_fetch_tax(conn, subscription_fetch, fetch_tax):
 
     conn.commit()
 
-    log('End of transaction. Charged fetch taxes for subscription_id {0}'.format(subscription_fetch['subscription_id']))
+    logger.debug('End of transaction. Charged fetch taxes for subscription_id {0}', subscription_fetch['subscription_id'])
 
     c.close()
 
 
-def start():
-    fetch_tax = 500 # cents
+def complete_subscription_fetch(conn, subscription_fetch_id):
+    assert_db(conn, 'complete_subscription_fetch called without connection to db')
+    assert_app(isinstance(subscription_fetch_id, int), 'Expected subscription_fetch_id to be int, but was "{0}"'.format(type(subscription_fetch_id)))
 
-    conn = psycopg2.connect(dbname='freefall', user='freefall',
-            password='freefall', cursor_factory=RealDictCursor)
+    c = conn.cursor()
+
+    # fetch-data-async.py resumes fetches from the subscriptions_fetches
+    # without completed_at.
+    c.execute('''
 
-    airlines = request('https://api.skypicker.com/airlines')
+        UPDATE subscriptions_fetches
+        SET completed_at = now()
+        WHERE id = %s;
 
-    assert_peer(
-        isinstance(airlines, list),
-        'Expected airlines to be a list, but was "{0}"'.format(type(airlines)))
+    ''', [subscription_fetch_id])
+    conn.commit()
 
-    for airline in airlines:
-        assert_peer(
-            isinstance(airline, dict),
-            'Expected airline to be a dict, but was "{0}"'.format(type(airline)))
+    c.close()
 
-        expect_airline_keys = ['id', 'name']
 
-        for key in expect_airline_keys:
-            assert_peer(key in airline, 'Key "{0}" not found in airline'.format(key))
-            assert_peer(
-                isinstance(airline[key], str),
-                'Expected airline[{0}] "{1}" to be str, but was "{2}"'.format(key, airline[key], type(airline[key])))
+def lock_fetches(conn):
+    assert_db(conn, 'lock_fetches called without connection to db')
 
-        # check for FakeAirline:
-        if airline['id'] == '__':
-            continue
+    c = conn.cursor()
 
-        iata_code_pattern = re.compile('^[A-Z0-9]+$')
+    # Session level, so the lock is held until the connection is closed.
+    c.execute('SELECT pg_try_advisory_lock(%s) AS locked;', [FETCH_LOCK_KEY])
+    locked = c.fetchone()['locked']
+    conn.commit()
 
-        assert_peer(iata_code_pattern.match(airline['id']), 'Invalid iata code "{0}"'.format(airline['id']))
+    c.close()
 
-        log('Inserting if not exists airline {0} ({1})...'.format(airline['name'], airline['id']))
+    return locked
 
-        insert_if_not_exists(conn, 'airlines', {
-            'name': '{0} {1}'.format(airline['name'], airline['id']),
-            'code': airline['id'],
-            'logo_url': 'https://images.kiwi.com/airlines/64/{0}.png'.format(airline['id'])
-        }, {
-            'code': airline['id']
-        })
+
+def start(args):
+    fetch_tax = 500 # cents
+
+    conn = psycopg2.connect(dbname=args.database, user='freefall',
+            password='freefall', cursor_factory=RealDictCursor)
+
+    if not lock_fetches(conn):
+        logger.warning('Another fetcher is still running, exiting.')
+        return
+
+    sync_airlines(conn, args.api_url, args.airline_refresh)
+    conn.commit()
 
     subscriptions = select(conn, 'subscriptions', ['id', 'airport_from_id', 'airport_to_id'])
 
@@ -635,7 +800,14 @@ def start():
 
     fetch_id = insert_data_fetch(conn)
 
-    for sub in subscriptions:
+    if response_recorder is not None:
+        response_recorder.start(fetch_id)
+    progress_logged_at = time.monotonic()
+
+    logger.info('Airport reference {0} knows {1} airports.', airport_reference_version, len(airport_reference))
+    logger.info('Fetching {0} subscriptions.', len(subscriptions))
+
+    for index, sub in enumerate(subscriptions):
         assert_app(
             isinstance(sub, psycopg2.extras.RealDictRow),
             'Expected subscription to be psycopg2.extras.RealDictRow, but was "{0}"'.format(type(sub)))
@@ -675,12 +847,100 @@ def start():
 
         get_subscription_data(
             conn,
+            args.api_url,
             {
                 'airport_from': airport_from[0]['iata_code'],
                 'airport_to': airport_to[0]['iata_code']
             },
             subscription_fetch['id']
         )
-    log('Done.')
 
-start()
+        complete_subscription_fetch(conn, subscription_fetch['id'])
+
+        if time.monotonic() - progress_logged_at >= PROGRESS_INTERVAL:
+            logger.info('Progress: {0} of {1} subscriptions fetched, {2} retries.', index + 1, len(subscriptions), rate_controller.retries)
+            progress_logged_at = time.monotonic()
+
+    logger.info('Rate controller {0}', rate_controller.stats())
+
+    if response_cache is not None:
+        logger.info('Response cache {0}', response_cache.stats())
+
+    if response_replayer is not None:
+        logger.info('Replay {0}', response_replayer.stats())
+
+    logger.info('Done.')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--api-url',
+        help='base url of the Kiwi API.',
+        default=KIWI_API_URL)
+    parser.add_argument(
+        '--database',
+        help='name of the database to write to.',
+        default=DATABASE)
+    parser.add_argument(
+        '--response-cache-dir',
+        help='directory of the cache of /airlines and /locations responses, shared by all fetchers.',
+        default=RESPONSE_CACHE_DIR)
+    parser.add_argument(
+        '--no-response-cache',
+        help='request /airlines and /locations every time they are needed.',
+        action='store_true')
+    parser.add_argument(
+        '--record',
+        help='directory to append every Kiwi API response to, as a gzip compressed NDJSON archive per fetch.')
+    parser.add_argument(
+        '--replay',
+        help='archives written with --record to take the Kiwi API responses from, instead of requesting them.',
+        nargs='+')
+    parser.add_argument(
+        '--airline-refresh',
+        help='hours after which the airline catalog is downloaded again, 0 downloads it on every run. Airlines that are flown before are synced right away.',
+        type=int,
+        default=AIRLINE_REFRESH_INTERVAL)
+    parser.add_argument(
+        '--skip-internal-checks',
+        help='do not run internal consistency asserts. Responses from the Kiwi API are still validated.',
+        action='store_true')
+    parser.add_argument(
+        '--log-level',
+        help='least severe messages to log.',
+        choices=sorted(LOG_LEVELS, key=LOG_LEVELS.get),
+        default='info')
+
+    args = parser.parse_args()
+
+    if args.record is not None and args.replay is not None:
+        parser.error('--record and --replay are mutually exclusive')
+
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    logger.level = LOG_LEVELS[args.log_level]
+    logger.flush_periodically()
+    fetcher_common.internal_checks = not args.skip_internal_checks
+
+    if not args.no_response_cache:
+        response_cache = ResponseCache(args.response_cache_dir, RESPONSE_CACHE_TTLS, RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_MEMORY_ENTRIES)
+
+    if args.record is not None:
+        response_recorder = ResponseRecorder(args.record)
+
+    if args.replay is not None:
+        response_replayer = ResponseReplayer(args.replay)
+
+    try:
+        start(args)
+    except BaseError as e:
+        handle_error(e.msg)
+    finally:
+        if response_recorder is not None:
+            response_recorder.close()
+
+        logger.close()
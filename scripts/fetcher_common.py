@@ -0,0 +1,874 @@
+# Code shared by fetch-data.py and fetch-data-async.py.
+from urllib.parse import urlencode, urlparse
+from collections import OrderedDict
+import concurrent.futures
+import gzip
+import hashlib
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+from datetime import date, datetime
+
+ROUTES_LIMIT = 30
+SERVER_TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+KIWI_API_DATE_FORMAT = '%d/%m/%Y'
+TIMEOUT = 15
+KIWI_API_URL = 'https://api.skypicker.com'
+DATABASE = 'freefall'
+
+
+ENDPOINT_RATE_LIMITS = { # requests per second
+    '/flights': 10,
+    '/locations': 10,
+    '/airlines': 1,
+}
+DEFAULT_RATE_LIMIT = 5
+MIN_RATE = 0.5
+RATE_INCREASE = 0.5
+RATE_DECREASE_FACTOR = 0.5
+RETRY_BASE_DELAY = 0.5 # seconds
+RESPONSE_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'freefall', 'responses')
+RESPONSE_CACHE_TTLS = { # seconds, endpoints that are not listed, like /flights, are never cached
+    '/airlines': 60 * 60,
+    '/locations': 7 * 24 * 60 * 60,
+}
+RESPONSE_CACHE_MAX_STALE = 7 * 24 * 60 * 60 # seconds an expired response is still used while the API fails
+RESPONSE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+RESPONSE_CACHE_MEMORY_ENTRIES = 1000
+REPLAY_ROUTE_PARAMS = ['to', 'dateFrom', 'dateTo', 'offset', 'limit'] # /flights parameters answered from the archived routes
+REPLAY_SHIFTED_FIELDS = ['dTime', 'aTime', 'dTimeUTC', 'aTimeUTC'] # moved to the replay day, on routes and their flights
+REPLAY_MISSING_RESPONSES = { # served for requests that are not in the archive
+    '/flights': {'data': [], 'currency': 'USD', '_next': None},
+    '/locations': {'locations': []},
+    '/airlines': [],
+}
+LOG_LEVELS = {
+    'debug': 10,
+    'info': 20,
+    'warning': 30,
+    'error': 40,
+}
+LOG_BUFFER_SIZE = 1000 # lines
+LOG_FLUSH_INTERVAL = 1 # seconds
+PROGRESS_INTERVAL = 10 # seconds
+
+
+FETCH_LOCK_KEY = 42607 # pg advisory lock held by the fetcher that opens fetches
+
+
+AIRLINE_REFRESH_INTERVAL = 24 # hours
+AIRLINE_CATALOG_STATE = 'airline_catalog' # fetcher_state row with the hash of the last synced /airlines response
+
+
+AIRPORT_LOCATIONS_LIMIT = 5 # candidates asked from /locations for an unknown IATA code
+KIWI_SCHEMAS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'api_schemas', 'kiwi')
+AIRPORTS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'airports.json')
+JSON_TYPES = {
+    'string': str,
+    'integer': int,
+    'number': (int, float),
+    'boolean': bool,
+    'object': dict,
+    'array': list,
+    'null': type(None),
+}
+SCHEMA_KEYWORDS = ['$schema', '$id', 'title', 'type', 'required', 'properties', 'items', 'enum', 'pattern', 'minItems', 'maxItems']
+
+
+class BaseError(Exception):
+    def __init__(self, msg):
+        super().__init__(msg)
+        self.msg = msg
+
+
+class AppError(BaseError):
+    def __init__(self, msg):
+        super().__init__(msg)
+
+
+class PeerError(BaseError):
+    def __init__(self, msg):
+        super().__init__(msg)
+
+
+class UserError(BaseError):
+    def __init__(self, msg):
+        super().__init__(msg)
+
+
+# The message is only formatted with args when the check fails, so callers
+# pass the format arguments instead of a formatted message.
+def format_message(msg, args):
+    return msg.format(*args) if len(args) > 0 else msg
+
+
+def assert_app(condition, msg, *args):
+    if internal_checks and not condition:
+        raise AppError(format_message(msg, args))
+
+
+def assert_peer(condition, msg, *args):
+    if not condition:
+        raise PeerError(format_message(msg, args))
+
+
+def assert_user(condition, msg, *args):
+    if not condition:
+        raise UserError(format_message(msg, args))
+
+
+# Internal consistency checks, turned off with --skip-internal-checks.
+internal_checks = True
+
+
+def handle_error(error):
+    logger.error(error)
+    sys.exit(1)
+
+
+class Logger:
+    # Lines are buffered and written by a single background thread, so the
+    # event loop never blocks on stdout. Arguments are only formatted into
+    # the message when its level is enabled.
+    def __init__(self, stream, level):
+        self.stream = stream
+        self.level = level
+        self.prefix = ''
+        self.lines = []
+        self.lock = threading.Lock()
+        self.flushed_at = time.monotonic()
+        self.writer = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.flusher = None
+        self.closed = threading.Event()
+
+    def is_enabled(self, level):
+        return level >= self.level
+
+    def log(self, level, msg, *args):
+        if level < self.level:
+            return
+
+        if len(args) > 0:
+            msg = msg.format(*args)
+
+        with self.lock:
+            self.lines.append(self.prefix + str(msg))
+            due = len(self.lines) >= LOG_BUFFER_SIZE or time.monotonic() - self.flushed_at >= LOG_FLUSH_INTERVAL
+
+        if due:
+            self.flush()
+
+    def debug(self, msg, *args):
+        self.log(LOG_LEVELS['debug'], msg, *args)
+
+    def info(self, msg, *args):
+        self.log(LOG_LEVELS['info'], msg, *args)
+
+    def warning(self, msg, *args):
+        self.log(LOG_LEVELS['warning'], msg, *args)
+
+    def error(self, msg, *args):
+        self.log(LOG_LEVELS['error'], msg, *args)
+
+    def flush(self):
+        with self.lock:
+            self.flushed_at = time.monotonic()
+
+            if len(self.lines) == 0:
+                return
+
+            chunk = '\n'.join(self.lines) + '\n'
+            self.lines = []
+
+        self.writer.submit(self.write, chunk)
+
+    def flush_periodically(self):
+        # For callers that can block for long without logging, like the sync
+        # fetcher waiting on a request.
+        def run():
+            while not self.closed.wait(LOG_FLUSH_INTERVAL):
+                self.flush()
+
+        self.flusher = threading.Thread(target=run, daemon=True)
+        self.flusher.start()
+
+    def write(self, chunk):
+        self.stream.write(chunk)
+        self.stream.flush()
+
+    def close(self):
+        self.closed.set()
+
+        if self.flusher is not None:
+            self.flusher.join()
+
+        self.flush()
+        self.writer.shutdown(wait=True)
+
+
+logger = Logger(sys.stdout, LOG_LEVELS['info'])
+
+
+def invalid(path, expected, value):
+    raise PeerError('Expected {0} to be {1}, but got {2}'.format(path, expected, repr(value)[:100]))
+
+
+def compile_schema(schema, path):
+    # Turns a JSON schema into a chain of closures once, so checking a
+    # response is a walk over the data that only formats a message when a
+    # value does not match.
+    assert_app(isinstance(schema, dict), 'Expected schema at {0} to be a dict, but was "{1}"', path, type(schema))
+
+    unsupported = [keyword for keyword in schema if keyword not in SCHEMA_KEYWORDS]
+
+    assert_app(len(unsupported) == 0, 'Unsupported keywords {0} in schema at {1}', unsupported, path)
+
+    checks = []
+
+    if 'type' in schema:
+        type_names = schema['type'] if isinstance(schema['type'], list) else [schema['type']]
+        types = tuple(JSON_TYPES[type_name] for type_name in type_names)
+        # bool is a subclass of int in Python, but not an integer in JSON.
+        allows_bool = 'boolean' in type_names
+        expected = ' or '.join(type_names)
+
+        def check_type(value):
+            if not isinstance(value, types) or (isinstance(value, bool) and not allows_bool):
+                invalid(path, expected, value)
+
+        checks.append(check_type)
+
+    if 'enum' in schema:
+        values = schema['enum']
+
+        def check_enum(value):
+            if value not in values:
+                invalid(path, 'one of {0}'.format(values), value)
+
+        checks.append(check_enum)
+
+    if 'pattern' in schema:
+        pattern = re.compile(schema['pattern'])
+
+        def check_pattern(value):
+            if isinstance(value, str) and not pattern.search(value):
+                invalid(path, 'a match of {0}'.format(pattern.pattern), value)
+
+        checks.append(check_pattern)
+
+    if 'required' in schema or 'properties' in schema:
+        required = schema.get('required', [])
+        properties = [
+            (key, compile_schema(property_schema, '{0}.{1}'.format(path, key)))
+            for key, property_schema in schema.get('properties', {}).items()
+        ]
+
+        def check_object(value):
+            if not isinstance(value, dict):
+                return
+
+            for key in required:
+                if key not in value:
+                    invalid(path, 'an object with key "{0}"'.format(key), value)
+
+            for key, check_property in properties:
+                if key in value:
+                    check_property(value[key])
+
+        checks.append(check_object)
+
+    if 'minItems' in schema or 'maxItems' in schema:
+        min_items = schema.get('minItems', 0)
+        max_items = schema.get('maxItems')
+
+        if max_items is None:
+            expected = 'a list of at least {0} items'.format(min_items)
+        else:
+            expected = 'a list of {0} to {1} items'.format(min_items, max_items)
+
+        def check_length(value):
+            if isinstance(value, list) and (len(value) < min_items or (max_items is not None and len(value) > max_items)):
+                invalid(path, expected, value)
+
+        checks.append(check_length)
+
+    if 'items' in schema:
+        check_item = compile_schema(schema['items'], path + '[]')
+
+        def check_items(value):
+            if not isinstance(value, list):
+                return
+
+            for item in value:
+                check_item(item)
+
+        checks.append(check_items)
+
+    if len(checks) == 1:
+        return checks[0]
+
+    def check(value):
+        for check_value in checks:
+            check_value(value)
+
+    return check
+
+
+def load_schema(name):
+    with open(os.path.join(KIWI_SCHEMAS_DIR, name + '.json')) as f:
+        return compile_schema(json.load(f), name)
+
+
+def load_airport_reference(path):
+    with open(path, encoding='utf-8') as f:
+        reference = json.load(f)
+
+    assert_app(isinstance(reference.get('version'), str), 'Expected a version in airport reference {0}', path)
+    assert_app(isinstance(reference.get('airports'), list), 'Expected a list of airports in airport reference {0}', path)
+
+    names = {}
+
+    for airport in reference['airports']:
+        assert_app(
+            isinstance(airport.get('code'), str) and isinstance(airport.get('name'), str),
+            'Expected code and name of airport {0} in airport reference {1}', airport, path)
+
+        names[airport['code']] = airport['name']
+
+    return reference['version'], names
+
+
+def pick_location(locations, iata_code):
+    # A term can match several airports, or none when Kiwi does not know the
+    # code. Only an exact match is used, the rest are stored by their code.
+    for location in locations:
+        if location['code'] == iata_code:
+            return location['name']
+
+    logger.warning('No /locations match for airport {0}, storing it without a name.', iata_code)
+
+    return None
+
+
+class TokenBucket:
+    # Paces requests to a single endpoint. The refill rate is adjusted with
+    # AIMD: it grows by RATE_INCREASE after every successful request and is
+    # multiplied by RATE_DECREASE_FACTOR whenever the API pushes back.
+    def __init__(self, rate, capacity):
+        self.max_rate = rate
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def reserve(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        self.tokens -= 1
+
+        if self.tokens >= 0:
+            return 0
+
+        return -self.tokens / self.rate
+
+    def on_success(self):
+        self.rate = min(self.max_rate, self.rate + RATE_INCREASE)
+
+    def on_throttle(self):
+        self.rate = max(MIN_RATE, self.rate * RATE_DECREASE_FACTOR)
+
+
+class RateController:
+    # share is the fraction of the rate limits this process may use, when
+    # several workers fetch at the same time.
+    def __init__(self, rate_limits, share=1):
+        assert_app(isinstance(rate_limits, dict), 'Expected rate_limits to be dict, but was "{0}"', type(rate_limits))
+
+        self.share = share
+        self.buckets = {
+            endpoint: TokenBucket(rate * share, capacity=rate * share)
+            for endpoint, rate in rate_limits.items()
+        }
+        self.throttled_time = 0
+        self.backoff_time = 0
+        self.retries = 0
+
+    def get_bucket(self, URL):
+        endpoint = urlparse(URL).path
+
+        if endpoint not in self.buckets:
+            self.buckets[endpoint] = TokenBucket(DEFAULT_RATE_LIMIT * self.share, capacity=DEFAULT_RATE_LIMIT * self.share)
+
+        return self.buckets[endpoint]
+
+    def retry_delay(self, attempt):
+        self.retries += 1
+
+        delay = RETRY_BASE_DELAY * (2 ** attempt) * random.uniform(0.5, 1.5)
+        self.backoff_time += delay
+
+        return delay
+
+    def stats(self):
+        return 'throttled for {0:.2f}s, backed off for {1:.2f}s over {2} retries, rates: {3}'.format(
+            self.throttled_time,
+            self.backoff_time,
+            self.retries,
+            {endpoint: round(bucket.rate, 2) for endpoint, bucket in self.buckets.items()})
+
+
+class ResponseCache:
+    # Responses of the reference endpoints, kept in memory and on disk, so
+    # later runs and workers share them. An entry older than the TTL of its
+    # endpoint is revalidated with ETag/Last-Modified. The least recently used
+    # entries are evicted once the directory grows over max_bytes.
+    def __init__(self, directory, ttls, max_bytes, memory_entries):
+        self.directory = directory
+        self.ttls = ttls
+        self.max_bytes = max_bytes
+        self.memory_entries = memory_entries
+        self.memory = OrderedDict()
+        self.disk_bytes = None # summed up on the first write
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self.stale = 0
+
+        os.makedirs(directory, exist_ok=True)
+
+    def caches(self, URL):
+        return urlparse(URL).path in self.ttls
+
+    def key(self, URL, params):
+        canonical = URL
+
+        if params is not None:
+            canonical += '?' + urlencode(sorted(params.items()))
+
+        return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def get(self, key):
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return self.memory[key]
+
+        try:
+            with open(self.path(key), encoding='utf-8') as f:
+                entry = json.load(f)
+
+            # The modification time of an entry is when it was used last.
+            os.utime(self.path(key))
+        except (OSError, ValueError):
+            return None
+
+        self.remember(key, entry)
+
+        return entry
+
+    def is_fresh(self, URL, entry, max_age=None):
+        if max_age is None:
+            max_age = self.ttls[urlparse(URL).path]
+
+        return time.time() - entry['stored_at'] < max_age
+
+    def is_usable_stale(self, entry):
+        return entry is not None and time.time() - entry['stored_at'] < RESPONSE_CACHE_MAX_STALE
+
+    def conditional_headers(self, entry):
+        headers = {}
+
+        if entry is not None and entry['etag'] is not None:
+            headers['If-None-Match'] = entry['etag']
+        if entry is not None and entry['last_modified'] is not None:
+            headers['If-Modified-Since'] = entry['last_modified']
+
+        return headers
+
+    def remember(self, key, entry):
+        self.memory[key] = entry
+        self.memory.move_to_end(key)
+
+        while len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+
+    def put(self, key, body, headers, previous=None):
+        entry = {
+            'stored_at': time.time(),
+            'etag': headers.get('ETag', previous and previous['etag']),
+            'last_modified': headers.get('Last-Modified', previous and previous['last_modified']),
+            'body': body,
+        }
+
+        self.remember(key, entry)
+
+        data = json.dumps(entry).encode('utf-8')
+
+        # Written next to the entry and renamed, so other workers never read
+        # a partly written file.
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+
+        try:
+            replaced_bytes = os.path.getsize(self.path(key))
+        except OSError:
+            replaced_bytes = 0
+
+        os.replace(temp_path, self.path(key))
+
+        if self.disk_bytes is None:
+            self.disk_bytes = self.disk_usage()[0]
+        else:
+            self.disk_bytes += len(data) - replaced_bytes
+
+        if self.disk_bytes > self.max_bytes:
+            self.evict()
+
+    def disk_usage(self):
+        files = []
+
+        for dir_entry in os.scandir(self.directory):
+            if dir_entry.name.endswith('.json'):
+                try:
+                    stat = dir_entry.stat()
+                except FileNotFoundError:
+                    continue
+
+                files.append((stat.st_mtime, dir_entry.path, stat.st_size))
+
+        return sum(size for _, _, size in files), sorted(files)
+
+    def evict(self):
+        self.disk_bytes, files = self.disk_usage()
+
+        for _, path, size in files:
+            if self.disk_bytes <= self.max_bytes:
+                break
+
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # Evicted by another worker.
+                pass
+
+            self.disk_bytes -= size
+
+    def serve_stale(self, uri, entry, reason):
+        self.stale += 1
+
+        logger.warning(
+            'Request to {0} failed ({1}), using the response cached {2:.0f}s ago.',
+            uri,
+            reason,
+            time.time() - entry['stored_at'])
+
+        return entry['body']
+
+    def stats(self):
+        return '{0} hits, {1} revalidated, {2} misses, {3} served stale'.format(self.hits, self.revalidated, self.misses, self.stale)
+
+
+def archive_key(URL, params, ignored=()):
+    # The host is left out, so an archive replays against any --api-url.
+    params = sorted((key, value) for key, value in (params or {}).items() if key not in ignored)
+
+    return urlparse(URL).path + '?' + urlencode(params)
+
+
+class ResponseRecorder:
+    # Appends every response of the Kiwi API to a gzip compressed NDJSON
+    # archive, one per fetch. Responses received before the fetch is known,
+    # like the airline catalog, are held back until it is.
+    def __init__(self, directory, suffix=''):
+        self.directory = directory
+        self.suffix = suffix
+        self.file = None
+        self.path = None
+        self.pending = []
+        self.records = 0
+
+        os.makedirs(directory, exist_ok=True)
+
+    def start(self, fetch_id):
+        self.close()
+
+        if fetch_id is None:
+            name = 'queue-worker-{0}'.format(os.getpid())
+        else:
+            name = 'fetch-{0}{1}'.format(fetch_id, self.suffix)
+
+        self.path = os.path.join(self.directory, name + '.ndjson.gz')
+        # Appending adds a gzip member, a resumed fetch continues its archive.
+        self.file = gzip.open(self.path, 'at', encoding='utf-8')
+
+        for line in self.pending:
+            self.file.write(line)
+
+        self.pending = []
+
+    def record(self, URL, params, started_at, seconds, status, body, error=None):
+        line = json.dumps({
+            'url': URL,
+            'params': params,
+            'started_at': started_at,
+            'seconds': round(seconds, 6),
+            'status': status, # None when the response came from the response cache or there was none
+            'error': error,
+            'body': body,
+        }) + '\n'
+
+        self.records += 1
+
+        if self.file is None:
+            self.pending.append(line)
+        else:
+            self.file.write(line)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            logger.info('Recorded {0} responses to {1}.', self.records, self.path)
+
+
+class ResponseReplayer:
+    # Serves the responses of --record archives instead of requesting them.
+    # /flights requests are answered from the archived routes of the same
+    # origin, filtered by the requested destinations and departure dates, so
+    # queries that are planned differently than when the archive was recorded
+    # still replay. Archived routes are moved by whole days to the replay
+    # day. Other endpoints are matched on the whole request.
+    def __init__(self, paths):
+        self.responses = {}
+        self.routes = {}
+        self.currencies = {}
+        self.booking_tokens = set()
+        self.matches = {}
+        self.replayed = 0
+        self.missing = 0
+
+        today = date.today()
+
+        for path in paths:
+            count = 0
+
+            try:
+                with gzip.open(path, 'rt', encoding='utf-8') as f:
+                    for line in f:
+                        record = json.loads(line)
+
+                        if record['body'] is None:
+                            continue
+
+                        if urlparse(record['url']).path == '/flights':
+                            days = (today - date.fromtimestamp(record['started_at'])).days
+                            self.add_routes(archive_key(record['url'], record['params'], REPLAY_ROUTE_PARAMS), json.loads(record['body']), days)
+                        else:
+                            self.responses[archive_key(record['url'], record['params'])] = record['body']
+
+                        count += 1
+            except EOFError:
+                # The recording fetcher did not exit cleanly.
+                logger.warning('Archive {0} ends early, replaying the {1} responses before.', path, count)
+
+            logger.info('Loaded {0} responses from {1}.', count, path)
+
+    def add_routes(self, key, response, days):
+        try:
+            check_flights_response(response)
+        except PeerError as e:
+            logger.warning('Skipping an archived /flights response that is not valid: {0}', e.msg)
+            return
+
+        self.currencies.setdefault(key, response['currency'])
+        routes_by_destination = self.routes.setdefault(key, {})
+
+        for route in response['data']:
+            # Overlapping queries return the same route more than once.
+            if route['booking_token'] in self.booking_tokens:
+                continue
+
+            self.booking_tokens.add(route['booking_token'])
+            shift_route(route, days * 24 * 60 * 60)
+
+            outbound_flights = [flight for flight in route['route'] if not flight['return']]
+
+            if len(outbound_flights) == 0:
+                continue
+
+            departure = date.fromtimestamp(outbound_flights[0]['dTimeUTC'])
+            routes_by_destination.setdefault(outbound_flights[-1]['flyTo'], []).append((departure, route))
+
+    def match_routes(self, key, params):
+        routes_by_destination = self.routes[key]
+
+        if 'to' in params:
+            destinations = sorted(set(params['to'].split(',')))
+        else:
+            destinations = sorted(routes_by_destination)
+
+        date_from = None
+        date_to = None
+
+        if 'dateFrom' in params:
+            date_from = datetime.strptime(params['dateFrom'], KIWI_API_DATE_FORMAT).date()
+
+        if 'dateTo' in params:
+            date_to = datetime.strptime(params['dateTo'], KIWI_API_DATE_FORMAT).date()
+
+        return [
+            route
+            for destination in destinations
+            for departure, route in routes_by_destination.get(destination, [])
+            if (date_from is None or departure >= date_from) and (date_to is None or departure <= date_to)
+        ]
+
+    def flights_page(self, URL, params, key):
+        # Every page of a query is cut from the same list of matching routes.
+        query_key = archive_key(URL, params, ['offset', 'limit'])
+        routes = self.matches.get(query_key)
+
+        if routes is None:
+            routes = self.match_routes(key, params)
+            self.matches[query_key] = routes
+
+        offset = int(params.get('offset', 0))
+        limit = int(params.get('limit', ROUTES_LIMIT))
+        next_page = None
+
+        if offset + limit < len(routes):
+            next_params = dict(params)
+            next_params['offset'] = offset + limit
+            next_page = archive_key(URL, next_params)
+
+        return {
+            'data': routes[offset:offset + limit],
+            'currency': self.currencies[key],
+            '_next': next_page,
+        }
+
+    def response(self, URL, params):
+        endpoint = urlparse(URL).path
+        params = params or {}
+        response = None
+
+        if endpoint == '/flights':
+            key = archive_key(URL, params, REPLAY_ROUTE_PARAMS)
+
+            if key in self.routes:
+                response = self.flights_page(URL, params, key)
+        elif archive_key(URL, params) in self.responses:
+            response = json.loads(self.responses[archive_key(URL, params)])
+
+        if response is None:
+            assert_user(endpoint in REPLAY_MISSING_RESPONSES, 'Request to {0} is not in the archive.', endpoint)
+
+            self.missing += 1
+            logger.warning('Request to {0} with {1} is not in the archive, replaying an empty response.', endpoint, params)
+
+            return REPLAY_MISSING_RESPONSES[endpoint]
+
+        self.replayed += 1
+
+        return response
+
+    def stats(self):
+        return '{0} responses replayed, {1} requests not in the archive'.format(self.replayed, self.missing)
+
+
+def shift_route(route, seconds):
+    for item in [route] + route['route']:
+        for field in REPLAY_SHIFTED_FIELDS:
+            if isinstance(item.get(field), int):
+                item[field] += seconds
+
+
+def record_response(recorder, URL, params, started_at, started, status, body, error=None):
+    if recorder is not None:
+        recorder.record(URL, params, started_at, time.monotonic() - started, status, body, error)
+
+
+check_flights_response = load_schema('flights')
+check_locations_response = load_schema('locations')
+check_airlines_response = load_schema('airlines')
+
+airport_reference_version, airport_reference = load_airport_reference(AIRPORTS_FILE)
+
+
+def stringify_columns(columns):
+    assert_app(isinstance(columns, list), 'Expected argument "columns" in stringify_columns function to be list, but was {0}', type(columns))
+    assert_app(len(columns) > 0, 'Expected list "columns" to have a length > 0, but length was {0}', len(columns))
+    assert_app(all(isinstance(col, str) for col in columns), 'All elements in arg "columns" in stringify_columns function are required to be str.')
+
+    return ', '.join(columns)
+
+def to_smallest_currency_unit(quantity):
+    return quantity * 100
+
+
+class Flight:
+    __slots__ = ['remote_id', 'airline', 'flight_no', 'airport_from', 'airport_to', 'dtime', 'atime', 'is_return']
+
+    def __init__(self, remote_id, airline, flight_no, airport_from, airport_to, dtime, atime, is_return):
+        self.remote_id = remote_id
+        self.airline = airline
+        self.flight_no = flight_no
+        self.airport_from = airport_from
+        self.airport_to = airport_to
+        self.dtime = dtime # UTC unix timestamps, as sent by Kiwi
+        self.atime = atime
+        self.is_return = is_return
+
+
+class Route:
+    __slots__ = ['booking_token', 'price', 'flights']
+
+    def __init__(self, booking_token, price, flights):
+        self.booking_token = booking_token
+        self.price = price
+        self.flights = flights
+
+
+def parse_routes(data):
+    # Keeps only the fields that are stored, so the decoded page can be
+    # dropped as soon as it is validated. A flight that is part of several
+    # routes on the page is shared between them.
+    flights_by_remote_id = {}
+    routes = []
+
+    for route in data:
+        flights = []
+
+        for flight in route['route']:
+            if flight['flyFrom'] == flight['flyTo']:
+                raise PeerError('Expected different values for flyFrom and flyTo, but got {0} and {1}'.format(flight['flyFrom'], flight['flyTo']))
+
+            parsed_flight = flights_by_remote_id.get(flight['id'])
+
+            if parsed_flight is None or parsed_flight.is_return != bool(flight['return']):
+                parsed_flight = Flight(
+                    flight['id'],
+                    flight['airline'],
+                    str(flight['flight_no']),
+                    flight['flyFrom'],
+                    flight['flyTo'],
+                    flight['dTimeUTC'],
+                    flight['aTimeUTC'],
+                    bool(flight['return']))
+                flights_by_remote_id[flight['id']] = parsed_flight
+
+            flights.append(parsed_flight)
+
+        routes.append(Route(route['booking_token'], route['price'], tuple(flights)))
+
+    return routes
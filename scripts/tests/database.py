@@ -0,0 +1,69 @@
+# The tables of create-database.sql in a schema of their own, for tests that
+# run the fetcher's SQL. The tests are skipped when PostgreSQL is not reachable.
+import asyncio
+import os
+import unittest
+
+import asyncpg
+
+import fetcher_common
+
+SCRIPTS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CREATE_DATABASE_SQL = os.path.join(SCRIPTS_DIR, 'create-database.sql')
+
+
+class DatabaseTestCase(unittest.TestCase):
+    def setUp(self):
+        # Pools are created on the loop that is current.
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(self.close_loop)
+
+        self.schema = 'test_{0}'.format(os.getpid())
+
+        try:
+            self.conn = self.wait(asyncpg.connect(database=fetcher_common.DATABASE, user='freefall', password='freefall'))
+        except (OSError, asyncpg.PostgresError) as e:
+            self.skipTest('PostgreSQL is not reachable: {0}'.format(e))
+
+        self.addCleanup(lambda: self.wait(self.conn.close()))
+        self.wait(self.conn.execute('CREATE SCHEMA {0}; SET search_path TO {0};'.format(self.schema)))
+        self.addCleanup(lambda: self.wait(self.conn.execute('DROP SCHEMA {0} CASCADE;'.format(self.schema))))
+
+        with open(CREATE_DATABASE_SQL) as sql:
+            self.wait(self.conn.execute(sql.read()))
+
+        self.pool = self.wait(asyncpg.create_pool(
+            database=fetcher_common.DATABASE,
+            user='freefall',
+            password='freefall',
+            min_size=1,
+            max_size=2,
+            server_settings={'search_path': self.schema}))
+        self.addCleanup(lambda: self.wait(self.pool.close()))
+
+    def close_loop(self):
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+    def wait(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def fetch(self, query, *args):
+        return [tuple(row) for row in self.wait(self.conn.fetch(query, *args))]
+
+    def insert(self, table, **columns):
+        names = sorted(columns.keys())
+
+        return self.wait(self.conn.fetchval(
+            'INSERT INTO {0} ({1}) VALUES ({2}) RETURNING id;'.format(
+                table,
+                ', '.join(names),
+                ', '.join('${0}'.format(index + 1) for index in range(len(names)))),
+            *[columns[name] for name in names]))
+
+    def insert_airport(self, iata_code):
+        return self.insert('airports', iata_code=iata_code, name='Airport ' + iata_code)
+
+    def insert_user(self, email, credits):
+        return self.insert('users', email=email, password='password', api_key='key-' + email, role='customer', credits=credits)
@@ -0,0 +1,123 @@
+# Run with: python -m unittest discover scripts/tests
+from datetime import date, datetime, timedelta
+import importlib.util
+import os
+import sys
+import unittest
+
+SCRIPTS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.insert(0, SCRIPTS_DIR)
+
+import fetcher_common
+from database import DatabaseTestCase
+
+spec = importlib.util.spec_from_file_location('fetch_data_async', os.path.join(SCRIPTS_DIR, 'fetch-data-async.py'))
+fetch_data_async = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(fetch_data_async)
+
+FETCH_TAX = 100
+
+
+class ChargeFetchTaxTest(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.log_level = fetcher_common.logger.level
+        fetcher_common.logger.level = fetcher_common.LOG_LEVELS['error']
+
+        sof = self.insert_airport('SOF')
+        self.subscription_ids = [
+            self.insert('subscriptions', airport_from_id=sof, airport_to_id=self.insert_airport(iata_code))
+            for iata_code in ['LHR', 'JFK', 'SFO']
+        ]
+        self.fetch_id = self.insert('fetches', fetch_time=datetime.now())
+
+        # subscriptions_fetches are numbered in subscription order.
+        self.subscription_fetch_ids = [
+            self.insert('subscriptions_fetches', subscription_id=subscription_id, fetch_id=self.fetch_id)
+            for subscription_id in self.subscription_ids
+        ]
+
+    def tearDown(self):
+        fetcher_common.logger.level = self.log_level
+
+        super().tearDown()
+
+    def subscribe(self, user_id, subscription_index, days=10, active=True):
+        return self.insert(
+            'users_subscriptions',
+            user_id=user_id,
+            subscription_id=self.subscription_ids[subscription_index],
+            date_from=date.today(),
+            date_to=date.today() + timedelta(days=days),
+            active=active)
+
+    def charge(self):
+        async def charge():
+            async with self.conn.transaction():
+                await fetch_data_async.charge_fetch_tax(self.conn, self.fetch_id, FETCH_TAX)
+
+        self.wait(charge())
+
+    def charges(self):
+        return set(self.fetch('''
+
+            SELECT account_transfers.user_id, subscriptions_fetches_account_transfers.subscription_fetch_id, account_transfers.transfer_amount
+            FROM account_transfers
+            JOIN subscriptions_fetches_account_transfers ON subscriptions_fetches_account_transfers.account_transfer_id = account_transfers.id;
+
+        '''))
+
+    def credits(self, user_id):
+        return self.fetch('SELECT credits FROM users WHERE id = $1;', user_id)[0][0]
+
+    def active(self, user_id):
+        return [active for active, in self.fetch('SELECT active FROM users_subscriptions WHERE user_id = $1 ORDER BY id;', user_id)]
+
+    def test_charges_every_subscription_fetch_once(self):
+        user_id = self.insert_user('rich@example.com', 1000)
+
+        for index in range(3):
+            self.subscribe(user_id, index)
+
+        # Two date windows of the same subscription are paid for once.
+        self.subscribe(user_id, 0, days=20)
+
+        self.charge()
+
+        self.assertEqual(self.charges(), {(user_id, subscription_fetch_id, -FETCH_TAX) for subscription_fetch_id in self.subscription_fetch_ids})
+        self.assertEqual(self.credits(user_id), 700)
+        self.assertEqual(self.active(user_id), [True] * 4)
+
+    def test_charges_in_subscription_fetch_order_while_credits_last(self):
+        user_id = self.insert_user('poor@example.com', 250)
+
+        # The order of subscribing does not matter.
+        for index in [2, 0, 1]:
+            self.subscribe(user_id, index)
+
+        self.charge()
+
+        self.assertEqual(self.charges(), {(user_id, subscription_fetch_id, -FETCH_TAX) for subscription_fetch_id in self.subscription_fetch_ids[:2]})
+        self.assertEqual(self.credits(user_id), 50)
+        self.assertEqual(self.active(user_id), [False] * 3)
+
+    def test_skips_users_who_can_not_pay(self):
+        paying_id = self.insert_user('paying@example.com', 100)
+        broke_id = self.insert_user('broke@example.com', 99)
+        inactive_id = self.insert_user('inactive@example.com', 1000)
+
+        self.subscribe(paying_id, 0)
+        self.subscribe(broke_id, 0)
+        self.subscribe(inactive_id, 0, active=False)
+
+        self.charge()
+
+        self.assertEqual(self.charges(), {(paying_id, self.subscription_fetch_ids[0], -FETCH_TAX)})
+        self.assertEqual([self.credits(user_id) for user_id in [paying_id, broke_id, inactive_id]], [0, 99, 1000])
+        self.assertEqual([self.active(user_id) for user_id in [paying_id, broke_id, inactive_id]], [[False], [False], [False]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+# Run with: python -m unittest discover scripts/tests
+from datetime import date, timedelta
+import importlib.util
+import math
+import os
+import sys
+import unittest
+
+SCRIPTS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.insert(0, SCRIPTS_DIR)
+
+import fetcher_common
+
+spec = importlib.util.spec_from_file_location('fetch_data_async', os.path.join(SCRIPTS_DIR, 'fetch-data-async.py'))
+fetch_data_async = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(fetch_data_async)
+
+TODAY = date(2026, 10, 18)
+
+
+def day(days):
+    return TODAY + timedelta(days=days)
+
+
+def subscription(subscription_fetch_id, airport_from, airport_to):
+    return {
+        'subscription_fetch_id': subscription_fetch_id,
+        'airport_from': airport_from,
+        'airport_to': airport_to,
+    }
+
+
+def pages(queries):
+    # One route a day to every destination, like the stub in test_replay.
+    return sum(
+        math.ceil(len(query['destinations']) * ((query['date_to'] - query['date_from']).days + 1) / fetcher_common.ROUTES_LIMIT)
+        for query in queries
+    )
+
+
+def spans(queries):
+    return [
+        (sorted(query['destinations']), query['date_from'], query['date_to'])
+        for query in queries
+    ]
+
+
+class MergeDateWindowsTest(unittest.TestCase):
+    def test_merges_overlapping_and_adjacent_windows(self):
+        self.assertEqual(
+            fetch_data_async.merge_date_windows([(day(5), day(9)), (day(0), day(3)), (day(4), day(6)), (day(12), day(14))], TODAY),
+            [(day(0), day(9)), (day(12), day(14))])
+
+    def test_clips_windows_to_today(self):
+        self.assertEqual(
+            fetch_data_async.merge_date_windows([(day(-10), day(-1)), (day(-3), day(2))], TODAY),
+            [(day(0), day(2))])
+
+
+class PlanQueriesTest(unittest.TestCase):
+    def test_coalesces_destinations_with_the_same_window(self):
+        subscriptions = [subscription(1, 'SOF', 'LHR'), subscription(2, 'SOF', 'JFK'), subscription(3, 'LHR', 'SOF')]
+        date_windows = {1: [(day(0), day(29))], 2: [(day(0), day(29))], 3: [(day(0), day(29))]}
+
+        queries = fetch_data_async.plan_queries(subscriptions, date_windows, 10)
+
+        self.assertEqual(spans(queries), [(['JFK', 'LHR'], day(0), day(29)), (['SOF'], day(0), day(29))])
+        self.assertEqual(queries[0]['destinations'], {'LHR': 1, 'JFK': 2})
+
+    def test_queries_distinct_windows_apart(self):
+        subscriptions = [subscription(1, 'SOF', 'LHR'), subscription(2, 'SOF', 'JFK'), subscription(3, 'SOF', 'SFO')]
+        date_windows = {1: [(day(0), day(59))], 2: [(day(50), day(59))], 3: [(day(52), day(61))]}
+
+        queries = fetch_data_async.plan_queries(subscriptions, date_windows, 10)
+
+        # Querying the short windows over the long one, or over each other,
+        # would ask for days nobody subscribed to.
+        self.assertEqual(spans(queries), [(['LHR'], day(0), day(59)), (['JFK'], day(50), day(59)), (['SFO'], day(52), day(61))])
+
+    def test_splits_routes_back_by_window(self):
+        subscriptions = [subscription(1, 'SOF', 'LHR'), subscription(2, 'SOF', 'JFK')]
+        date_windows = {1: [(day(0), day(4)), (day(20), day(24))], 2: [(day(0), day(24))]}
+
+        queries = fetch_data_async.plan_queries(subscriptions, date_windows, 10)
+
+        self.assertEqual(spans(queries), [(['JFK', 'LHR'], day(0), day(24))])
+        self.assertEqual(queries[0]['windows'], {1: [(day(0), day(4)), (day(20), day(24))], 2: [(day(0), day(24))]})
+
+    def test_limits_destinations_per_query(self):
+        subscriptions = [subscription(subscription_fetch_id, 'SOF', airport_to) for subscription_fetch_id, airport_to in enumerate(['LHR', 'JFK', 'SFO'])]
+        date_windows = {subscription_fetch_id: [(day(0), day(9))] for subscription_fetch_id in range(3)}
+
+        queries = fetch_data_async.plan_queries(subscriptions, date_windows, 2)
+
+        self.assertEqual(spans(queries), [(['JFK', 'LHR'], day(0), day(9)), (['SFO'], day(0), day(9))])
+
+    def test_does_not_page_more_than_separate_queries(self):
+        airports = ['LHR', 'JFK', 'SFO', 'CDG', 'FRA', 'AMS', 'MAD', 'FCO']
+        subscriptions = [subscription(subscription_fetch_id, 'SOF', airport_to) for subscription_fetch_id, airport_to in enumerate(airports)]
+        date_windows = {
+            0: [(day(0), day(89))],
+            1: [(day(0), day(6))],
+            2: [(day(80), day(89))],
+            3: [(day(30), day(59))],
+            4: [(day(31), day(58))],
+            5: [(day(0), day(2)), (day(85), day(89))],
+            6: [(day(40), day(44))],
+            7: [(day(0), day(89))],
+        }
+
+        coalesced = fetch_data_async.plan_queries(subscriptions, date_windows, 10)
+        separate = fetch_data_async.plan_queries(subscriptions, date_windows, 1)
+
+        self.assertLess(len(coalesced), len(separate))
+        self.assertLessEqual(pages(coalesced), pages(separate))
+
+
+if __name__ == '__main__':
+    unittest.main()
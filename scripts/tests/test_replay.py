@@ -0,0 +1,207 @@
+# Run with: python -m unittest discover scripts/tests
+from datetime import date, datetime, timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qsl, urlparse
+import importlib.util
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+SCRIPTS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.insert(0, SCRIPTS_DIR)
+
+import fetcher_common
+
+spec = importlib.util.spec_from_file_location('fetch_data', os.path.join(SCRIPTS_DIR, 'fetch-data.py'))
+fetch_data = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(fetch_data)
+
+
+def flights_response(params):
+    # One route a day to every destination, paginated like the Kiwi API.
+    day_from = datetime.strptime(params['dateFrom'], fetcher_common.KIWI_API_DATE_FORMAT).date()
+    day_to = datetime.strptime(params['dateTo'], fetcher_common.KIWI_API_DATE_FORMAT).date()
+    routes = []
+
+    for destination in sorted(params['to'].split(',')):
+        day = day_from
+
+        while day <= day_to:
+            departure = int(time.mktime(day.timetuple())) + 10 * 60 * 60
+            routes.append({
+                'booking_token': '{0}-{1}-{2}'.format(params['flyFrom'], destination, day.isoformat()),
+                'price': 100,
+                'route': [{
+                    'id': '{0}-{1}-{2}'.format(params['flyFrom'], destination, departure),
+                    'flight_no': 1,
+                    'airline': 'FB',
+                    'flyFrom': params['flyFrom'],
+                    'flyTo': destination,
+                    'dTimeUTC': departure,
+                    'aTimeUTC': departure + 2 * 60 * 60,
+                    'return': 0,
+                }],
+            })
+            day += timedelta(days=1)
+
+    offset = int(params['offset'])
+    limit = int(params['limit'])
+
+    return {
+        'data': routes[offset:offset + limit],
+        'currency': 'USD',
+        '_next': 'next' if offset + limit < len(routes) else None,
+    }
+
+
+class KiwiStub(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = dict(parse_qsl(url.query))
+
+        if url.path == '/flights':
+            response = flights_response(params)
+        elif url.path == '/locations':
+            response = {'locations': [{'code': params['term'], 'name': 'Airport ' + params['term']}]}
+        else:
+            self.send_error(404)
+            return
+
+        body = json.dumps(response).encode('utf-8')
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def query(airport_from, airport_to, date_from, date_to, limit):
+    return {
+        'flyFrom': airport_from,
+        'to': airport_to,
+        'dateFrom': date_from.strftime(fetcher_common.KIWI_API_DATE_FORMAT),
+        'dateTo': date_to.strftime(fetcher_common.KIWI_API_DATE_FORMAT),
+        'typeFlight': 'oneway',
+        'curr': 'USD',
+        'offset': 0,
+        'limit': limit,
+    }
+
+
+def fetch_routes(api_url, params):
+    params = dict(params)
+    routes = []
+
+    while True:
+        response = fetch_data.request(api_url + '/flights', dict(params), check_response=fetcher_common.check_flights_response)
+        routes.extend(response['data'])
+
+        if response['_next'] is None:
+            return routes
+
+        params['offset'] += params['limit']
+
+
+class ReplayTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), KiwiStub)
+        self.api_url = 'http://127.0.0.1:{0}'.format(self.server.server_address[1])
+        self.log_level = fetcher_common.logger.level
+        self.today = date.today()
+
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        fetcher_common.logger.level = fetcher_common.LOG_LEVELS['error']
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+        fetch_data.response_recorder = None
+        fetch_data.response_replayer = None
+        fetcher_common.logger.level = self.log_level
+
+    def record(self):
+        fetch_data.response_recorder = fetcher_common.ResponseRecorder(self.directory)
+
+        routes = fetch_routes(self.api_url, query('SOF', 'JFK,LHR', self.today, self.today + timedelta(days=9), 4))
+        locations = fetch_data.request(self.api_url + '/locations', {'term': 'SOF'})
+
+        fetch_data.response_recorder.start(1)
+        fetch_data.response_recorder.close()
+        fetch_data.response_recorder = None
+
+        # Nothing is requested from the API while replaying.
+        self.server.shutdown()
+
+        return routes, locations
+
+    def replay(self):
+        fetch_data.response_replayer = fetcher_common.ResponseReplayer([os.path.join(self.directory, 'fetch-1.ndjson.gz')])
+
+        return fetch_data.response_replayer
+
+    def test_replays_replanned_queries(self):
+        recorded_routes, recorded_locations = self.record()
+        replayer = self.replay()
+
+        self.assertEqual(
+            fetch_routes(self.api_url, query('SOF', 'JFK,LHR', self.today, self.today + timedelta(days=9), 4)),
+            recorded_routes)
+
+        # A different destination split, window and page size is cut from the same routes.
+        routes = fetch_routes(self.api_url, query('SOF', 'LHR', self.today + timedelta(days=2), self.today + timedelta(days=4), 2))
+
+        self.assertEqual(
+            [route['booking_token'] for route in routes],
+            ['SOF-LHR-{0}'.format((self.today + timedelta(days=days)).isoformat()) for days in [2, 3, 4]])
+        self.assertEqual(fetch_data.request(self.api_url + '/locations', {'term': 'SOF'}), recorded_locations)
+        self.assertEqual(replayer.missing, 0)
+
+        self.assertEqual(fetch_routes(self.api_url, query('VAR', 'LHR', self.today, self.today, 4)), [])
+        self.assertEqual(replayer.missing, 1)
+
+    def test_moves_routes_to_the_replay_day(self):
+        recorder = fetcher_common.ResponseRecorder(self.directory)
+        recorded_on = self.today - timedelta(days=2)
+        params = query('SOF', 'LHR', recorded_on, recorded_on + timedelta(days=4), 30)
+
+        recorder.record(
+            self.api_url + '/flights',
+            params,
+            time.mktime(recorded_on.timetuple()) + 12 * 60 * 60,
+            0,
+            200,
+            json.dumps(flights_response(params)))
+        recorder.start(1)
+        recorder.close()
+        self.server.shutdown()
+        self.replay()
+
+        routes = fetch_routes(self.api_url, query('SOF', 'LHR', self.today + timedelta(days=2), self.today + timedelta(days=4), 30))
+
+        self.assertEqual(
+            [route['booking_token'] for route in routes],
+            ['SOF-LHR-{0}'.format((recorded_on + timedelta(days=days)).isoformat()) for days in [2, 3, 4]])
+        self.assertEqual(
+            [date.fromtimestamp(route['route'][0]['dTimeUTC']) for route in routes],
+            [self.today + timedelta(days=days) for days in [2, 3, 4]])
+
+
+if __name__ == '__main__':
+    unittest.main()
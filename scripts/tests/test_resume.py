@@ -0,0 +1,131 @@
+# Run with: python -m unittest discover scripts/tests
+from datetime import datetime, timedelta
+import importlib.util
+import os
+import sys
+import unittest
+
+SCRIPTS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.insert(0, SCRIPTS_DIR)
+
+import fetcher_common
+from database import DatabaseTestCase
+
+spec = importlib.util.spec_from_file_location('fetch_data_async', os.path.join(SCRIPTS_DIR, 'fetch-data-async.py'))
+fetch_data_async = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(fetch_data_async)
+
+
+class ResumeTest(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.log_level = fetcher_common.logger.level
+        fetcher_common.logger.level = fetcher_common.LOG_LEVELS['error']
+
+        sof = self.insert_airport('SOF')
+        self.subscription_ids = [
+            self.insert('subscriptions', airport_from_id=sof, airport_to_id=self.insert_airport(iata_code))
+            for iata_code in ['LHR', 'JFK', 'SFO', 'CDG']
+        ]
+
+    def tearDown(self):
+        fetcher_common.logger.level = self.log_level
+
+        super().tearDown()
+
+    def insert_fetch(self, runs=1):
+        fetch_id = self.insert('fetches', fetch_time=datetime.now(), runs=runs)
+        subscription_fetch_ids = [
+            self.insert('subscriptions_fetches', subscription_id=subscription_id, fetch_id=fetch_id)
+            for subscription_id in self.subscription_ids
+        ]
+
+        return fetch_id, subscription_fetch_ids
+
+    def complete(self, subscription_fetch_ids):
+        self.wait(fetch_data_async.complete_subscriptions_fetches(self.pool, subscription_fetch_ids))
+
+    def resume(self):
+        return self.wait(fetch_data_async.resume_fetch(self.pool))
+
+    def plan(self, fetch_id, shard=0, shards=1):
+        planned = self.wait(fetch_data_async.select_planned_subscriptions(self.pool, fetch_data_async.DimensionCache(), fetch_id, shard, shards))
+
+        return [sub['airport_to'] for sub in planned]
+
+    def runs(self, fetch_id):
+        return self.fetch('SELECT runs FROM fetches WHERE id = $1;', fetch_id)[0][0]
+
+    def test_resumes_the_latest_unfinished_fetch(self):
+        old_fetch_id, _ = self.insert_fetch()
+        fetch_id, subscription_fetch_ids = self.insert_fetch()
+
+        self.complete(subscription_fetch_ids[:2])
+
+        self.assertEqual(self.resume(), fetch_id)
+        self.assertEqual(self.runs(fetch_id), 2)
+        self.assertEqual(self.runs(old_fetch_id), 1)
+        self.assertEqual(self.plan(fetch_id), ['SFO', 'CDG'])
+
+    def test_does_not_resume_a_completed_fetch(self):
+        self.insert_fetch()
+        fetch_id, subscription_fetch_ids = self.insert_fetch()
+
+        self.complete(subscription_fetch_ids)
+
+        self.assertIsNone(self.resume())
+        self.assertEqual(self.plan(fetch_id), [])
+
+    def test_gives_up_after_the_last_run(self):
+        fetch_id, _ = self.insert_fetch(runs=fetch_data_async.FETCH_MAX_RUNS)
+
+        self.assertIsNone(self.resume())
+        self.assertEqual(self.runs(fetch_id), fetch_data_async.FETCH_MAX_RUNS)
+
+    def test_leaves_queued_subscriptions_to_their_jobs(self):
+        fetch_id, subscription_fetch_ids = self.insert_fetch()
+
+        self.complete(subscription_fetch_ids[:2])
+
+        for subscription_fetch_id in subscription_fetch_ids[2:]:
+            self.insert('fetch_jobs', subscription_fetch_id=subscription_fetch_id)
+
+        self.assertIsNone(self.resume())
+
+    def test_plans_paid_and_stale_subscriptions_first(self):
+        _, previous_ids = self.insert_fetch()
+        fetch_id, subscription_fetch_ids = self.insert_fetch()
+
+        # SFO was fetched long ago, LHR and JFK recently, CDG never.
+        self.wait(self.conn.execute('DELETE FROM subscriptions_fetches WHERE id = $1;', previous_ids[3]))
+        self.wait(self.conn.execute(
+            'UPDATE subscriptions_fetches SET completed_at = $2 WHERE id = ANY($1::integer[]);',
+            previous_ids[:2],
+            datetime.now()))
+        self.wait(self.conn.execute(
+            'UPDATE subscriptions_fetches SET completed_at = $2 WHERE id = $1;',
+            previous_ids[2],
+            datetime.now() - timedelta(days=1)))
+
+        # JFK has a paying subscriber in this fetch.
+        user_id = self.insert_user('paying@example.com', 0)
+        account_transfer_id = self.insert('account_transfers', user_id=user_id, transfer_amount=-100, transferred_at=datetime.now())
+        self.insert('subscriptions_fetches_account_transfers', account_transfer_id=account_transfer_id, subscription_fetch_id=subscription_fetch_ids[1])
+
+        self.assertEqual(self.plan(fetch_id), ['JFK', 'CDG', 'SFO', 'LHR'])
+
+    def test_splits_subscriptions_between_shards(self):
+        fetch_id, _ = self.insert_fetch()
+
+        shards = [self.plan(fetch_id, shard, 2) for shard in range(2)]
+
+        self.assertEqual(sorted(shards[0] + shards[1]), ['CDG', 'JFK', 'LHR', 'SFO'])
+        self.assertEqual(shards, [self.plan(fetch_id, shard, 2) for shard in range(2)])
+        self.assertNotEqual(shards[0], [])
+        self.assertNotEqual(shards[1], [])
+
+
+if __name__ == '__main__':
+    unittest.main()